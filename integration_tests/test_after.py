@@ -55,7 +55,8 @@ class AfterTestCase(integration_tests.TestCase):
         self.assertEqual(1, exception.returncode)
         expected = (
             'Issue detected while analyzing snapcraft.yaml: '
-            'circular dependency chain found in parts definition\n')
+            'circular dependency chain found in parts definition: '
+            'p1 -> p3 -> p2 -> p1\n')
         self.assertEqual(expected, exception.output)
 
     def test_build_with_missing_dependencies(self):
@@ -24,6 +24,14 @@ from snapcraft.internal import common, sources
 
 class BasePlugin:
 
+    # Plugins setting this build from sourcedir directly instead of from a
+    # copy of it, and keep builddir between builds of changed sources.
+    out_of_tree_build = False
+
+    # Plugins setting this install files that refer to the absolute path of
+    # installdir, so their builds can only be reused from the same location.
+    embeds_installdir = False
+
     @classmethod
     def schema(cls):
         """Return a json-schema for the plugin's properties as a dictionary.
@@ -54,6 +62,15 @@ class BasePlugin:
                     'type:': 'string',
                     'default': '',
                 },
+                'source-commit': {
+                    'type': 'string',
+                    'pattern': '^[0-9a-fA-F]{40}$',
+                    'default': '',
+                },
+                'source-checksum': {
+                    'type': 'string',
+                    'default': '',
+                },
                 'source-subdir': {
                     'type': 'string',
                     'default': None,
@@ -67,7 +84,8 @@ class BasePlugin:
                 'source',
             ],
             'pull-properties': ['source', 'source-type', 'source-branch',
-                                'source-tag', 'source-subdir'],
+                                'source-tag', 'source-commit',
+                                'source-checksum', 'source-subdir'],
             'build-properties': ['disable-parallel']
         }
 
@@ -145,13 +163,15 @@ class BasePlugin:
     def build(self):
         """Build the source code retrieved from the pull phase.
 
-        The base implementation only copies sourcedir to build_basedir.
+        The base implementation only copies sourcedir to build_basedir, or
+        creates builddir for out of tree builds.
         Override this method if you need to process the source code to make it
         runnable.
         """
 
-        if os.path.exists(self.build_basedir):
-            shutil.rmtree(self.build_basedir)
+        if self.out_of_tree_build:
+            os.makedirs(self.builddir, exist_ok=True)
+            return
 
         # FIXME: It's not necessary to ignore here anymore since it's now done
         # in the Local source. However, it's left here so that it continues to
@@ -167,7 +187,8 @@ class BasePlugin:
             else:
                 return []
 
-        shutil.copytree(
+        # Only what changed since the last build is copied again.
+        common.sync_tree(
             self.sourcedir, self.build_basedir, symlinks=True, ignore=ignore)
 
     def clean_build(self):
@@ -87,6 +87,10 @@ class ProjectOptions:
 
         return build_count
 
+    @property
+    def jobs(self):
+        return self.__jobs
+
     @property
     def is_cross_compiling(self):
         return self.__target_machine != self.__host_machine
@@ -137,12 +141,16 @@ class ProjectOptions:
         return os.path.join(self.__project_dir, 'prime')
 
     def __init__(self, use_geoip=False, parallel_builds=True,
-                 target_deb_arch=None):
+                 target_deb_arch=None, jobs=1):
         # TODO: allow setting a different project dir and check for
         #       snapcraft.yaml
         self.__project_dir = os.getcwd()
         self.__use_geoip = use_geoip
         self.__parallel_builds = parallel_builds
+        if jobs < 1:
+            raise EnvironmentError(
+                'The number of jobs must be at least 1, not {}'.format(jobs))
+        self.__jobs = jobs
         self._set_machine(target_deb_arch)
 
     def _set_machine(self, target_deb_arch):
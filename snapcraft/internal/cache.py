@@ -0,0 +1,535 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright (C) 2016 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Caches shared by every project built by the current user.
+
+Entries live under $XDG_CACHE_HOME/snapcraft and are evicted least recently
+used first once the cache grows over its size cap.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+
+import requests
+from xdg import BaseDirectory
+
+from snapcraft.internal import common
+from snapcraft.internal.indicators import read_requests_stream
+
+
+logger = logging.getLogger(__name__)
+
+_BUILD_CACHE_SIZE_ENV = 'SNAPCRAFT_BUILD_CACHE_SIZE'
+_DOWNLOAD_CACHE_SIZE_ENV = 'SNAPCRAFT_DOWNLOAD_CACHE_SIZE'
+_DEFAULT_DOWNLOAD_CACHE_SIZE = 2048
+_GIT_CACHE_SIZE_ENV = 'SNAPCRAFT_GIT_CACHE_SIZE'
+_EXTRACTED_DEBS_CACHE_SIZE_ENV = 'SNAPCRAFT_EXTRACTED_DEBS_CACHE_SIZE'
+_DEFAULT_EXTRACTED_DEBS_CACHE_SIZE = 2048
+
+_CHUNK_SIZE = 64 * 1024
+
+
+def get_build_cache():
+    """Return the build cache, or None if it hasn't been enabled.
+
+    The build cache is opt-in: it is enabled by setting
+    SNAPCRAFT_BUILD_CACHE_SIZE to the maximum size of the cache in megabytes.
+    """
+    size = _get_size(_BUILD_CACHE_SIZE_ENV, 0)
+    if size < 1:
+        return None
+
+    return BuildCache(size * 1024 * 1024)
+
+
+def get_download_cache():
+    """Return the download cache, or None if it has been disabled.
+
+    The maximum size of the cache is set in megabytes by
+    SNAPCRAFT_DOWNLOAD_CACHE_SIZE, setting it to 0 disables the cache.
+    """
+    size = _get_size(_DOWNLOAD_CACHE_SIZE_ENV, _DEFAULT_DOWNLOAD_CACHE_SIZE)
+    if size < 1:
+        return None
+
+    return DownloadCache(size * 1024 * 1024)
+
+
+def get_git_cache():
+    """Return the cache of git mirrors, or None if it hasn't been enabled.
+
+    The git cache is opt-in, as mirrors hold the full history of the
+    repositories which are otherwise cloned shallowly: it is enabled by
+    setting SNAPCRAFT_GIT_CACHE_SIZE to the maximum size of the cache in
+    megabytes.
+    """
+    size = _get_size(_GIT_CACHE_SIZE_ENV, 0)
+    if size < 1:
+        return None
+
+    return GitCache(size * 1024 * 1024)
+
+
+def evict_extracted_debs(cache_dir, in_use):
+    """Evict the least recently used packages extracted into cache_dir.
+
+    The maximum size of the cache is set in megabytes by
+    SNAPCRAFT_EXTRACTED_DEBS_CACHE_SIZE. The entries in use are never evicted.
+    """
+    max_size = _get_size(_EXTRACTED_DEBS_CACHE_SIZE_ENV,
+                         _DEFAULT_EXTRACTED_DEBS_CACHE_SIZE) * 1024 * 1024
+    in_use = set(in_use)
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.startswith('.'):
+            continue
+        with contextlib.suppress(OSError):
+            size = _entry_size(entry.path)
+            if entry.path in in_use:
+                max_size -= size
+            else:
+                entries.append((entry.stat().st_mtime, size, entry.path))
+
+    _evict(entries, max_size, 'extracted packages')
+
+
+def _get_size(env, default):
+    size = os.environ.get(env)
+    if not size:
+        return default
+
+    try:
+        return int(size)
+    except ValueError:
+        raise EnvironmentError(
+            '{} must be a size in megabytes, not {!r}'.format(env, size))
+
+
+class BuildCache:
+    """Installed trees of built parts, keyed by a hash of their inputs."""
+
+    def __init__(self, max_size, cache_dir=None):
+        if not cache_dir:
+            cache_dir = os.path.join(
+                BaseDirectory.xdg_cache_home, 'snapcraft', 'build')
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def restore(self, key, installdir):
+        """Replace installdir with the cached tree for key.
+
+        :returns: True on a cache hit, False otherwise.
+        """
+        entry = self._entry(key)
+        if not os.path.isdir(entry):
+            return False
+
+        try:
+            # Mark the entry as recently used before anything else, so that
+            # a concurrent eviction leaves it alone.
+            os.utime(entry)
+            if os.path.exists(installdir):
+                shutil.rmtree(installdir)
+            shutil.copytree(os.path.join(entry, 'install'), installdir,
+                            symlinks=True)
+        except OSError as e:
+            logger.warning('Unable to restore build from cache: %s', e)
+            with contextlib.suppress(FileNotFoundError):
+                shutil.rmtree(installdir)
+            os.makedirs(installdir)
+            return False
+
+        return True
+
+    def store(self, key, installdir):
+        """Add a copy of installdir to the cache under key."""
+        entry = self._entry(key)
+        if os.path.isdir(entry):
+            return
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmpdir = tempfile.mkdtemp(prefix='.tmp-', dir=self.cache_dir)
+        try:
+            # The tree is copied rather than linked: later steps may modify
+            # the files of installdir in place.
+            shutil.copytree(installdir, os.path.join(tmpdir, 'install'),
+                            symlinks=True)
+            with open(os.path.join(tmpdir, 'size'), 'w') as f:
+                f.write(str(_tree_size(tmpdir)))
+            # Renaming is atomic, so concurrent builds never see a partial
+            # entry. If another one got there first, keep theirs.
+            os.rename(tmpdir, entry)
+        except OSError as e:
+            logger.debug('Not caching build %s: %s', key, e)
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                shutil.rmtree(tmpdir)
+
+        self._evict()
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.startswith('.'):
+                continue
+            entry = self._entry(name)
+            with contextlib.suppress(OSError, ValueError):
+                with open(os.path.join(entry, 'size')) as f:
+                    size = int(f.read())
+                entries.append((os.stat(entry).st_mtime, size, entry))
+
+        _evict(entries, self.max_size, 'build')
+
+
+class DownloadCache:
+    """Downloaded files, stored by the sha256 of their content.
+
+    Each URL records the file it was last downloaded as, along with the
+    validators sent by the server to revalidate it with on the next
+    download.
+    """
+
+    def __init__(self, max_size, cache_dir=None):
+        if not cache_dir:
+            cache_dir = os.path.join(
+                BaseDirectory.xdg_cache_home, 'snapcraft', 'download')
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._files_dir = os.path.join(cache_dir, 'files')
+        self._urls_dir = os.path.join(cache_dir, 'urls')
+
+    def fetch(self, url, destination, checksum=None, message=None):
+        """Download url to destination, hard-linked from the cache.
+
+        :param str checksum: the expected checksum of the file, as
+                             <algorithm>/<digest>.
+        """
+        with self.open(url, checksum, message) as f:
+            while f.read(_CHUNK_SIZE):
+                pass
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(destination)
+            common.link_or_copy(f.name, destination)
+
+    @contextlib.contextmanager
+    def open(self, url, checksum=None, message=None):
+        """Yield a binary file object reading url through the cache.
+
+        A file that is not cached is added to it as it is read, and only
+        once it is read to the end.
+
+        :raises EnvironmentError: if the file does not match checksum.
+        """
+        path = self._find_by_checksum(checksum)
+        if path:
+            # Files are stored by their sha256, no need to ask anyone.
+            with _open_cached(path) as f:
+                yield f
+            return
+
+        path, headers = self._find_by_url(url)
+        if not message:
+            message = 'Downloading {!r}'.format(os.path.basename(url))
+        request = requests.get(url, stream=True, allow_redirects=True,
+                               headers=headers)
+        try:
+            if path and request.status_code == 304:
+                logger.debug('%s has not been modified', url)
+                if checksum:
+                    verify_checksum(path, checksum)
+                with _open_cached(path) as f:
+                    yield f
+                return
+
+            request.raise_for_status()
+            os.makedirs(self._files_dir, exist_ok=True)
+            with read_requests_stream(request, message) as stream:
+                with _CachingReader(stream, self._files_dir,
+                                    checksum) as reader:
+                    yield reader
+            if not reader.name:
+                logger.debug('%s was not read to the end, not caching it',
+                             url)
+                return
+            self._save_validators(url, {
+                'sha256': reader.sha256,
+                'etag': request.headers.get('ETag'),
+                'last-modified': request.headers.get('Last-Modified'),
+            })
+        finally:
+            request.close()
+
+        self._evict()
+
+    def _find_by_checksum(self, checksum):
+        if not checksum:
+            return None
+
+        algorithm, digest = parse_checksum(checksum)
+        if algorithm != 'sha256':
+            return None
+        path = self._file(digest)
+
+        return path if os.path.exists(path) else None
+
+    def _find_by_url(self, url):
+        """Return the file last downloaded from url, if still cached.
+
+        It is returned along with the headers asking the server whether it
+        has changed since.
+        """
+        validators = self._load_validators(url)
+        if not validators:
+            return None, {}
+        path = self._file(validators['sha256'])
+        if not os.path.exists(path):
+            return None, {}
+
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last-modified'):
+            headers['If-Modified-Since'] = validators['last-modified']
+
+        return path, headers
+
+    def _file(self, sha256):
+        return os.path.join(self._files_dir, sha256)
+
+    def _validators_file(self, url):
+        return os.path.join(self._urls_dir, hashlib.sha256(
+            url.encode()).hexdigest())
+
+    def _load_validators(self, url):
+        try:
+            with open(self._validators_file(url)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_validators(self, url, validators):
+        os.makedirs(self._urls_dir, exist_ok=True)
+        validators_file = self._validators_file(url)
+        with open(validators_file + '.tmp', 'w') as f:
+            json.dump(validators, f)
+        os.replace(validators_file + '.tmp', validators_file)
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self._files_dir):
+            if entry.name.startswith('.'):
+                continue
+            with contextlib.suppress(OSError):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+
+        _evict(entries, self.max_size, 'download')
+
+
+def _open_cached(path):
+    # Using a file counts for eviction, like adding it does.
+    os.utime(path)
+    return open(path, 'rb')
+
+
+class GitCache:
+    """Bare mirrors of git repositories, keyed by their URL."""
+
+    def __init__(self, max_size, cache_dir=None):
+        if not cache_dir:
+            cache_dir = os.path.join(
+                BaseDirectory.xdg_cache_home, 'snapcraft', 'git')
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def mirror(self, url, ref=None):
+        """Return the path to an up to date mirror of url.
+
+        A mirror that already has ref (a tag or a commit) is not updated.
+        """
+        name = hashlib.sha256(url.encode()).hexdigest()
+        mirror = os.path.join(self.cache_dir, name + '.git')
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Parts built in parallel may share a repository.
+        with _lock(os.path.join(self.cache_dir, '.{}.lock'.format(name))):
+            if not os.path.isdir(mirror):
+                self._clone(url, mirror)
+            elif not ref or not _has_ref(mirror, ref):
+                subprocess.check_call(['git', '-C', mirror, 'fetch',
+                                       '--prune', 'origin'])
+            os.utime(mirror)
+
+        self._evict(mirror)
+        return mirror
+
+    def _clone(self, url, mirror):
+        # Clone aside so that an interrupted clone isn't taken for a mirror.
+        tmpdir = tempfile.mkdtemp(prefix='.tmp-', dir=self.cache_dir)
+        try:
+            subprocess.check_call(['git', 'clone', '--mirror', url, tmpdir])
+            # Commits are fetched from the mirror by their sha, whether or
+            # not a ref points to them.
+            subprocess.check_call(['git', '-C', tmpdir, 'config',
+                                   'uploadpack.allowAnySHA1InWant', 'true'])
+            os.rename(tmpdir, mirror)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def _evict(self, mirror):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.startswith('.') or entry.path == mirror:
+                continue
+            with contextlib.suppress(OSError):
+                entries.append((entry.stat().st_mtime,
+                                _tree_size(entry.path), entry.path))
+
+        # The mirror in use is never evicted.
+        _evict(entries, self.max_size - _tree_size(mirror), 'git')
+
+
+@contextlib.contextmanager
+def _lock(path):
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def _has_ref(repository, ref):
+    return subprocess.call(
+        ['git', '-C', repository, 'rev-parse', '--verify', '--quiet',
+         ref + '^{commit}'], stdout=subprocess.DEVNULL) == 0
+
+
+class _CachingReader:
+    """Read a file object while adding it to the cache."""
+
+    def __init__(self, fileobj, files_dir, checksum=None):
+        self._fileobj = fileobj
+        self._files_dir = files_dir
+        self._checksum = checksum
+        self._hashes = {'sha256': hashlib.sha256()}
+        if checksum:
+            algorithm, _ = parse_checksum(checksum)
+            self._hashes.setdefault(algorithm, hashlib.new(algorithm))
+        self.name = None
+        self.sha256 = None
+
+    def __enter__(self):
+        self._tmp = tempfile.NamedTemporaryFile(
+            prefix='.tmp-', dir=self._files_dir, delete=False)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._tmp.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._tmp.name)
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        if data:
+            self._tmp.write(data)
+            for checksum in self._hashes.values():
+                checksum.update(data)
+        elif not self.name:
+            self._store()
+        return data
+
+    def _store(self):
+        if self._checksum:
+            algorithm, digest = parse_checksum(self._checksum)
+            if self._hashes[algorithm].hexdigest() != digest:
+                raise EnvironmentError(
+                    'The {} checksum of the download does not match {}, '
+                    'it is {}'.format(algorithm, digest,
+                                      self._hashes[algorithm].hexdigest()))
+        self._tmp.close()
+        self.sha256 = self._hashes['sha256'].hexdigest()
+        self.name = os.path.join(self._files_dir, self.sha256)
+        os.replace(self._tmp.name, self.name)
+
+
+def parse_checksum(checksum):
+    """Split checksum into its algorithm and digest.
+
+    :raises EnvironmentError: if checksum is not <algorithm>/<digest>.
+    """
+    algorithm, _, digest = checksum.partition('/')
+    if not digest or algorithm not in hashlib.algorithms_guaranteed:
+        raise EnvironmentError(
+            'Invalid checksum {!r}, it must be <algorithm>/<digest> with '
+            'one of {}'.format(checksum, ', '.join(
+                sorted(hashlib.algorithms_guaranteed))))
+    return algorithm, digest.lower()
+
+
+def verify_checksum(path, checksum):
+    """Raise EnvironmentError if the file at path does not match checksum."""
+    algorithm, digest = parse_checksum(checksum)
+    file_hash = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(_CHUNK_SIZE), b''):
+            file_hash.update(data)
+
+    if file_hash.hexdigest() != digest:
+        raise EnvironmentError(
+            'The {} checksum of {!r} does not match {}, it is {}'.format(
+                algorithm, path, digest, file_hash.hexdigest()))
+
+
+def _evict(entries, max_size, name):
+    """Remove the least recently used entries until under max_size.
+
+    :param entries: (mtime, size, path) tuples.
+    """
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total_size <= max_size:
+            break
+        logger.debug('Evicting %s from the %s cache', entry, name)
+        if os.path.isdir(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+        else:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(entry)
+        total_size -= size
+
+
+def _entry_size(entry):
+    try:
+        with open(os.path.join(entry, 'size')) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return _tree_size(entry)
+
+
+def _tree_size(path):
+    size = 0
+    for root, directories, files in os.walk(path):
+        for name in directories + files:
+            size += os.lstat(os.path.join(root, name)).st_size
+
+    return size
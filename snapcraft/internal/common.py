@@ -17,16 +17,22 @@
 # Data/methods shared between plugins and snapcraft
 
 from contextlib import suppress
+import errno
+import fcntl
 import glob
+import hashlib
 import logging
 import math
 import os
 import shutil
+import stat
 import subprocess
 import sys
 import tempfile
 import urllib
 
+from xdg import BaseDirectory
+
 
 SNAPCRAFT_FILES = ['snapcraft.yaml', '.snapcraft.yaml', 'parts', 'stage',
                    'prime', 'snap']
@@ -42,6 +48,8 @@ _tourdir = _DEFAULT_TOURDIR
 
 MAX_CHARACTERS_WRAP = 120
 
+_MAX_ENV_SCRIPTS = 100
+
 env = []
 
 logger = logging.getLogger(__name__)
@@ -53,30 +61,90 @@ def assemble_env():
 
 def run(cmd, **kwargs):
     assert isinstance(cmd, list), 'run command must be a list'
-    # FIXME: This is gross to keep writing this, even when env is the same
-    with tempfile.NamedTemporaryFile(mode='w+') as f:
-        f.write(assemble_env())
-        f.write('\n')
-        f.write('exec "$@"')
-        f.flush()
-        subprocess.check_call(['/bin/sh', f.name] + cmd, **kwargs)
+    subprocess.check_call(['/bin/sh', _get_env_script()] + cmd, **kwargs)
 
 
 def run_output(cmd, **kwargs):
     assert isinstance(cmd, list), 'run command must be a list'
-    # FIXME: This is gross to keep writing this, even when env is the same
-    with tempfile.NamedTemporaryFile(mode='w+') as f:
-        f.write(assemble_env())
-        f.write('\n')
-        f.write('exec "$@"')
-        f.flush()
-        output = subprocess.check_output(['/bin/sh', f.name] + cmd, **kwargs)
-        try:
-            return output.decode(sys.getfilesystemencoding()).strip()
-        except UnicodeEncodeError:
-            logger.warning('Could not decode output for {!r} correctly'.format(
-                cmd))
-            return output.decode('latin-1', 'surrogateescape').strip()
+    # Rather than going through the shell for every command, the environment
+    # it would set up is computed once.
+    run_env = _get_run_env(kwargs.get('env'))
+    run_env['PWD'] = os.path.abspath(kwargs.get('cwd') or os.getcwd())
+    kwargs['env'] = run_env
+    output = subprocess.check_output(cmd, **kwargs)
+    try:
+        return output.decode(sys.getfilesystemencoding()).strip()
+    except UnicodeEncodeError:
+        logger.warning('Could not decode output for {!r} correctly'.format(
+            cmd))
+        return output.decode('latin-1', 'surrogateescape').strip()
+
+
+def _get_env_script():
+    """Return the path to a script running its arguments within env.
+
+    Scripts are named after the hash of their content and kept in the cache,
+    so each environment is only written once. Only the most recently used
+    ones are kept.
+    """
+    content = assemble_env() + '\nexec "$@"\n'
+    script = os.path.join(
+        BaseDirectory.xdg_cache_home, 'snapcraft', 'env',
+        hashlib.sha256(content.encode()).hexdigest() + '.sh')
+    try:
+        os.utime(script)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(script), exist_ok=True)
+        # Parts may be built in parallel, so the script only appears once
+        # it is complete.
+        with tempfile.NamedTemporaryFile(
+                mode='w', dir=os.path.dirname(script), prefix='.tmp-',
+                delete=False) as f:
+            f.write(content)
+        os.replace(f.name, script)
+        _evict_env_scripts(os.path.dirname(script))
+
+    return script
+
+
+def _evict_env_scripts(env_dir):
+    scripts = []
+    for entry in os.scandir(env_dir):
+        if entry.name.startswith('.'):
+            continue
+        with suppress(FileNotFoundError):
+            scripts.append((entry.stat().st_mtime, entry.path))
+
+    scripts.sort()
+    for _, path in scripts[:-_MAX_ENV_SCRIPTS]:
+        with suppress(FileNotFoundError):
+            os.remove(path)
+
+
+# Set by the shell itself rather than by env.
+_SHELL_VARIABLES = ('PWD', 'OLDPWD', 'SHLVL', '_')
+
+_run_envs = {}
+
+
+def _get_run_env(base_env=None):
+    """Return the environment commands are run in, on top of base_env."""
+    if base_env is None:
+        base_env = os.environ
+    script = _get_env_script()
+    key = (script, tuple(sorted(base_env.items())))
+    if key not in _run_envs:
+        output = subprocess.check_output(
+            ['/bin/sh', script, 'env', '-0'], env=base_env)
+        run_env = dict(os.fsdecode(entry).partition('=')[::2]
+                       for entry in output.split(b'\0') if entry)
+        for name in _SHELL_VARIABLES:
+            run_env.pop(name, None)
+            if name in base_env:
+                run_env[name] = base_env[name]
+        _run_envs[key] = run_env
+
+    return dict(_run_envs[key])
 
 
 def format_snap_name(snap):
@@ -167,7 +235,7 @@ def link_or_copy(source, destination, follow_symlinks=False):
     """Hard-link source and destination files. Copy if it fails to link.
 
     Hard-linking may fail (e.g. a cross-device link, or permission denied), so
-    as a backup plan we just copy it.
+    as a backup plan we just copy it, as cheaply as the filesystems allow.
 
     :param str source: The source to which destination will be linked.
     :param str destination: The destination to be linked to source.
@@ -186,14 +254,203 @@ def link_or_copy(source, destination, follow_symlinks=False):
         # symlinks.
         os.link(source_path, destination, follow_symlinks=False)
     except OSError:
+        copy(source, destination, follow_symlinks=follow_symlinks)
+
+
+def copy(source, destination, follow_symlinks=False):
+    """Copy source to destination with its metadata, like shutil.copy2.
+
+    If destination is a directory, the copy is made inside it.
+
+    The content of regular files is copied with the cheapest method the
+    filesystems support: a reflink, then a copy in the kernel, and only as a
+    last resort through userspace. Methods found not to work between two
+    filesystems are not tried again for them.
+
+    :param str source: The file to copy.
+    :param str destination: The copy to make.
+    :param bool follow_symlinks: Whether or not symlinks should be followed.
+    """
+    if os.path.isdir(destination):
+        destination = os.path.join(destination, os.path.basename(source))
+
+    source_stat = os.stat(source, follow_symlinks=follow_symlinks)
+    if stat.S_ISREG(source_stat.st_mode):
+        # Opening destination truncates it, and source with it if they are
+        # the same file.
+        if os.path.exists(destination) and os.path.samefile(
+                source, destination):
+            raise shutil.SameFileError(
+                '{!r} and {!r} are the same file'.format(source, destination))
+        _copy_content(source, destination)
+        shutil.copystat(source, destination, follow_symlinks=follow_symlinks)
+    else:
+        # Symlinks and special files.
         shutil.copy2(source, destination, follow_symlinks=follow_symlinks)
-        uid = os.stat(source, follow_symlinks=follow_symlinks).st_uid
-        gid = os.stat(source, follow_symlinks=follow_symlinks).st_gid
-        try:
-            os.chown(destination, uid, gid, follow_symlinks=follow_symlinks)
-        except PermissionError as e:
-            logger.warning('unable to chown {destination}: {error}'.format(
-                destination=destination, error=e))
+
+    try:
+        os.chown(destination, source_stat.st_uid, source_stat.st_gid,
+                 follow_symlinks=follow_symlinks)
+    except PermissionError as e:
+        logger.warning('unable to chown {destination}: {error}'.format(
+            destination=destination, error=e))
+
+
+def sync_tree(source, destination, symlinks=False, ignore=None,
+              copy_function=shutil.copy2):
+    """Make destination a copy of the source tree, like shutil.copytree.
+
+    Unlike shutil.copytree, destination may already exist: only what
+    differs from source, going by file type, mode, size and modification
+    time, is copied again, and what is not in source is removed.
+
+    :param str source: The tree to copy.
+    :param str destination: The copy to update.
+    :param bool symlinks: Whether symlinks are copied as symlinks or
+                          followed, as for shutil.copytree.
+    :param ignore: A callable returning the names to leave out of each
+                   directory, as for shutil.copytree.
+    :param copy_function: The function copying files, as for
+                          shutil.copytree.
+    """
+    if os.path.islink(destination) or (
+            os.path.exists(destination) and not os.path.isdir(destination)):
+        os.remove(destination)
+    os.makedirs(destination, exist_ok=True)
+
+    entries = {entry.name: entry for entry in os.scandir(source)}
+    if ignore:
+        for name in ignore(source, list(entries)):
+            entries.pop(name, None)
+
+    for entry in os.scandir(destination):
+        source_entry = entries.get(entry.name)
+        if not source_entry or not _is_synced(source_entry, entry, symlinks):
+            _remove(entry)
+        elif not source_entry.is_dir(follow_symlinks=not symlinks):
+            # Up to date, directories are still synced below.
+            del entries[entry.name]
+
+    for name, entry in sorted(entries.items()):
+        path = os.path.join(destination, name)
+        if symlinks and entry.is_symlink():
+            os.symlink(os.readlink(entry.path), path)
+        elif entry.is_dir():
+            sync_tree(entry.path, path, symlinks=symlinks, ignore=ignore,
+                      copy_function=copy_function)
+        else:
+            copy_function(entry.path, path)
+
+    shutil.copystat(source, destination)
+
+
+def _is_synced(source_entry, entry, symlinks):
+    if source_entry.is_dir(follow_symlinks=not symlinks):
+        return entry.is_dir(follow_symlinks=False)
+    if symlinks and source_entry.is_symlink():
+        return (entry.is_symlink() and
+                os.readlink(source_entry.path) == os.readlink(entry.path))
+
+    source_stat = source_entry.stat(follow_symlinks=False)
+    entry_stat = entry.stat(follow_symlinks=False)
+    return (source_stat.st_mode == entry_stat.st_mode and
+            source_stat.st_size == entry_stat.st_size and
+            source_stat.st_mtime_ns == entry_stat.st_mtime_ns)
+
+
+def _remove(entry):
+    if entry.is_dir(follow_symlinks=False):
+        shutil.rmtree(entry.path)
+    else:
+        os.remove(entry.path)
+
+
+_COPY_CHUNK_SIZE = 1024 * 1024 * 1024
+_BUFFER_SIZE = 1024 * 1024
+# The errors telling that a copy method isn't supported between two files.
+_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY,
+                       errno.EINVAL, errno.ENOSYS}
+
+
+def _reflink(source_fd, destination_fd):
+    ficlone = getattr(fcntl, 'FICLONE', None)
+    if ficlone is None:
+        raise OSError(errno.ENOSYS, 'FICLONE is not available')
+    fcntl.ioctl(destination_fd, ficlone, source_fd)
+
+
+def _copy_file_range(source_fd, destination_fd):
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, 'copy_file_range is not available')
+    offset = 0
+    while True:
+        copied = os.copy_file_range(
+            source_fd, destination_fd, _COPY_CHUNK_SIZE, offset, offset)
+        if not copied:
+            break
+        offset += copied
+
+    _check_copied_size(source_fd, offset)
+
+
+def _sendfile(source_fd, destination_fd):
+    offset = 0
+    while True:
+        copied = os.sendfile(
+            destination_fd, source_fd, offset, _COPY_CHUNK_SIZE)
+        if not copied:
+            break
+        offset += copied
+
+    _check_copied_size(source_fd, offset)
+
+
+def _check_copied_size(source_fd, size):
+    # Some filesystems report an early end of file to in-kernel copies.
+    if size < os.fstat(source_fd).st_size:
+        raise OSError(errno.EINVAL, 'short in-kernel copy')
+
+
+def _buffered_copy(source_fd, destination_fd):
+    while True:
+        data = memoryview(os.read(source_fd, _BUFFER_SIZE))
+        if not data:
+            break
+        while data:
+            data = data[os.write(destination_fd, data):]
+
+
+_COPY_METHODS = [_reflink, _copy_file_range, _sendfile, _buffered_copy]
+# The copy methods that failed, by (source device, destination device).
+_unsupported_copy_methods = {}
+
+
+def _copy_content(source, destination):
+    with open(source, 'rb', buffering=0) as source_file, \
+            open(destination, 'wb', buffering=0) as destination_file:
+        source_fd = source_file.fileno()
+        destination_fd = destination_file.fileno()
+        devices = (os.fstat(source_fd).st_dev,
+                   os.fstat(destination_fd).st_dev)
+        unsupported = _unsupported_copy_methods.setdefault(devices, set())
+        for copy_method in _COPY_METHODS:
+            if copy_method in unsupported:
+                continue
+            try:
+                copy_method(source_fd, destination_fd)
+                return
+            except OSError as e:
+                if (e.errno not in _UNSUPPORTED_ERRNOS or
+                        copy_method is _buffered_copy):
+                    raise
+                logger.debug('Unable to copy with {} from device {} to {}: '
+                             '{}'.format(copy_method.__name__, devices[0],
+                                         devices[1], e))
+                unsupported.add(copy_method)
+                # Start over from a clean slate.
+                os.ftruncate(destination_fd, 0)
+                os.lseek(source_fd, 0, os.SEEK_SET)
+                os.lseek(destination_fd, 0, os.SEEK_SET)
 
 
 def replace_in_file(directory, file_pattern, search_pattern, replacement):
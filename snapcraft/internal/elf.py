@@ -0,0 +1,259 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright (C) 2016 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Read the dynamic linking information of ELF files.
+
+Only what is needed to find the libraries an ELF file needs at runtime is
+read: the program headers and the dynamic section.
+"""
+
+import collections
+import os
+import re
+import struct
+
+
+_ELF_MAGIC = b'\x7fELF'
+
+_ELFCLASS32 = 1
+_ELFCLASS64 = 2
+_ELFDATA2LSB = 1
+_ELFDATA2MSB = 2
+
+_PT_LOAD = 1
+_PT_DYNAMIC = 2
+_PT_INTERP = 3
+
+_DT_NULL = 0
+_DT_NEEDED = 1
+_DT_STRTAB = 5
+_DT_STRSZ = 10
+_DT_RPATH = 15
+_DT_RUNPATH = 29
+
+# The dynamic linker is needed by libc, but it is provided by the system the
+# snap runs on, whatever the architecture.
+_DYNAMIC_LINKER = re.compile(r'^ld(-linux[\w-]*|64)?\.so(\.\d+)*$')
+
+# The formats of the ELF header (after e_ident), of a program header and of
+# a dynamic section entry, for each ELF class.
+_FORMATS = {
+    _ELFCLASS32: ('HHIIIIIHHHHHH', 'IIIIIIII', 'iI'),
+    _ELFCLASS64: ('HHIQQQIHHHHHH', 'IIQQQQQQ', 'qQ'),
+}
+
+
+class ElfError(Exception):
+    pass
+
+
+class ElfFile:
+    """The dynamic linking information of an ELF file.
+
+    :ivar bool is_dynamic: whether the file is dynamically linked.
+    :ivar str interpreter: the dynamic linker requested by the file, if any.
+    :ivar list needed: the DT_NEEDED entries.
+    :ivar list rpath: the DT_RPATH directories.
+    :ivar list runpath: the DT_RUNPATH directories.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.is_dynamic = False
+        self.interpreter = None
+        self.needed = []
+        self.rpath = []
+        self.runpath = []
+
+        try:
+            with open(path, 'rb') as f:
+                self._read(f)
+        except (OSError, struct.error) as e:
+            raise ElfError('Unable to read {!r}: {}'.format(path, e)) from e
+
+    def is_compatible(self, other):
+        """Return true if both files can be loaded in the same process."""
+        return (self._elf_class == other._elf_class and
+                self._byte_order == other._byte_order and
+                self._machine == other._machine)
+
+    def _read(self, f):
+        ident = f.read(16)
+        if ident[:4] != _ELF_MAGIC:
+            raise ElfError('{!r} is not an ELF file'.format(self.path))
+        self._elf_class = ident[4]
+        if ident[5] == _ELFDATA2LSB:
+            self._byte_order = '<'
+        elif ident[5] == _ELFDATA2MSB:
+            self._byte_order = '>'
+        else:
+            raise ElfError('Unknown byte order for {!r}'.format(self.path))
+        try:
+            header_fmt, phdr_fmt, dyn_fmt = _FORMATS[self._elf_class]
+        except KeyError:
+            raise ElfError('Unknown ELF class for {!r}'.format(self.path))
+
+        header = self._unpack(header_fmt, f.read(self._size(header_fmt)))
+        self._machine = header[1]
+        phoff, phentsize, phnum = header[4], header[8], header[9]
+
+        f.seek(phoff)
+        segments = [self._unpack(phdr_fmt, f.read(phentsize)[
+            :self._size(phdr_fmt)]) for _ in range(phnum)]
+        if self._elf_class == _ELFCLASS64:
+            # p_flags comes second in 64 bit program headers.
+            segments = [(s[0], s[2], s[3], s[5]) for s in segments]
+        else:
+            segments = [(s[0], s[1], s[2], s[4]) for s in segments]
+
+        for p_type, p_offset, p_vaddr, p_filesz in segments:
+            if p_type == _PT_INTERP:
+                f.seek(p_offset)
+                self.interpreter = os.fsdecode(
+                    f.read(p_filesz).rstrip(b'\0'))
+            elif p_type == _PT_DYNAMIC:
+                self.is_dynamic = True
+                f.seek(p_offset)
+                self._read_dynamic(f, f.read(p_filesz), dyn_fmt, segments)
+
+    def _read_dynamic(self, f, data, dyn_fmt, segments):
+        entry_size = self._size(dyn_fmt)
+        entries = collections.defaultdict(list)
+        for offset in range(0, len(data) - entry_size + 1, entry_size):
+            tag, value = self._unpack(
+                dyn_fmt, data[offset:offset + entry_size])
+            if tag == _DT_NULL:
+                break
+            entries[tag].append(value)
+
+        if not entries[_DT_STRTAB] or not entries[_DT_STRSZ]:
+            return
+
+        # The string table is given as an address, which has to be mapped
+        # back to an offset in the file through the loadable segments.
+        address = entries[_DT_STRTAB][0]
+        for p_type, p_offset, p_vaddr, p_filesz in segments:
+            if p_type == _PT_LOAD and p_vaddr <= address < p_vaddr + p_filesz:
+                f.seek(address - p_vaddr + p_offset)
+                break
+        else:
+            raise ElfError('Unable to find the string table of {!r}'.format(
+                self.path))
+        strings = f.read(entries[_DT_STRSZ][0])
+
+        def string(offset):
+            end = strings.find(b'\0', offset)
+            return os.fsdecode(strings[offset:end if end >= 0 else None])
+
+        self.needed = [string(o) for o in entries[_DT_NEEDED]]
+        self.rpath = [p for o in entries[_DT_RPATH]
+                      for p in string(o).split(':') if p]
+        self.runpath = [p for o in entries[_DT_RUNPATH]
+                        for p in string(o).split(':') if p]
+
+    def _size(self, fmt):
+        return struct.calcsize(self._byte_order + fmt)
+
+    def _unpack(self, fmt, data):
+        return struct.unpack(self._byte_order + fmt, data)
+
+
+def is_elf(path):
+    """Return true if path is an ELF file."""
+    try:
+        with open(path, 'rb') as f:
+            return f.read(4) == _ELF_MAGIC
+    except OSError:
+        return False
+
+
+_elf_files = {}
+
+
+def get_elf_file(path):
+    """Return the ElfFile for path, reading it only if it changed."""
+    try:
+        stat = os.stat(path)
+    except OSError as e:
+        raise ElfError('Unable to read {!r}: {}'.format(path, e)) from e
+    signature = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    cached = _elf_files.get(path)
+    if not cached or cached[0] != signature:
+        cached = (signature, ElfFile(path))
+        _elf_files[path] = cached
+
+    return cached[1]
+
+
+def find_libraries(path, library_paths, system_paths):
+    """Return the paths of the libraries path needs, recursively.
+
+    Libraries are searched for the way the dynamic linker does: in the
+    DT_RPATH of the object and of those that loaded it, then in
+    library_paths (as if they were in LD_LIBRARY_PATH), then in the
+    DT_RUNPATH of the object and finally in system_paths. Libraries that
+    cannot be found are left out, and so is the dynamic linker.
+
+    :raises ElfError: if path itself cannot be read.
+    """
+    elf_file = get_elf_file(path)
+    found = collections.OrderedDict()
+    unvisited = collections.deque([(elf_file, [])])
+    while unvisited:
+        elf_file, loader_rpath = unvisited.popleft()
+        if elf_file.runpath:
+            rpath = []
+            runpath = _expand_origin(elf_file.runpath, elf_file.path)
+        else:
+            rpath = _expand_origin(elf_file.rpath, elf_file.path)
+            rpath += loader_rpath
+            runpath = []
+
+        search_paths = rpath + library_paths + runpath + system_paths
+        for name in elf_file.needed:
+            if name in found or _DYNAMIC_LINKER.match(name):
+                continue
+            library = _find_library(name, elf_file, search_paths)
+            if library:
+                found[name] = library.path
+                unvisited.append((library, rpath))
+
+    return list(found.values())
+
+
+def _find_library(name, elf_file, search_paths):
+    if '/' in name:
+        candidates = [name]
+    else:
+        candidates = (os.path.join(d, name) for d in search_paths)
+
+    for candidate in candidates:
+        if not os.path.exists(candidate):
+            continue
+        try:
+            library = get_elf_file(candidate)
+        except ElfError:
+            continue
+        if library.is_compatible(elf_file):
+            return library
+
+    return None
+
+
+def _expand_origin(paths, path):
+    origin = os.path.dirname(os.path.abspath(path))
+    return [p.replace('${ORIGIN}', origin).replace('$ORIGIN', origin)
+            for p in paths]
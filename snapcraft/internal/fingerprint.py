@@ -0,0 +1,155 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright (C) 2016 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Content fingerprints for the inputs of the lifecycle steps.
+
+A fingerprint is a hex digest that changes whenever the content it was
+computed from changes. Trees are hashed as Merkle trees: the digest of a
+directory is computed from the names, types, modes and digests of its
+entries, so that renaming, editing, adding or removing any file changes the
+digest of every directory above it. The metadata directories of version
+control systems are left out, as they change without the tree changing.
+
+The digests of files can be kept in a DigestCache, so that only the files
+which changed since are read again.
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import stat
+
+
+_CHUNK_SIZE = 1024 * 1024
+
+_VCS_METADATA = ('.bzr', '.git', '.hg', '.svn')
+
+
+class DigestCache:
+    """The digests of files, keyed by their path, size, mtime and inode."""
+
+    def __init__(self, cache_file):
+        self._cache_file = cache_file
+        self._entries = {}
+        self._used_entries = {}
+
+        with contextlib.suppress(OSError, ValueError):
+            with open(cache_file) as f:
+                self._entries = json.load(f).get('files', {})
+
+    def get(self, path, st):
+        """Return the digest of the file at path, whose lstat is st."""
+        key = [st.st_size, st.st_mtime_ns, st.st_ino]
+        entry = self._entries.get(path)
+        if not entry or entry[:3] != key:
+            entry = key + [_hash_file(path)]
+
+        self._used_entries[path] = entry
+        return entry[3]
+
+    def save(self):
+        if not (self._entries or self._used_entries):
+            return
+
+        # Only keep the files that were hashed, so that the cache doesn't
+        # grow forever.
+        tmp_file = self._cache_file + '.tmp'
+        os.makedirs(os.path.dirname(tmp_file), exist_ok=True)
+        with open(tmp_file, 'w') as f:
+            json.dump({'files': self._used_entries}, f)
+        os.replace(tmp_file, self._cache_file)
+
+
+def hash_tree(path, ignore=None, digests=None):
+    """Return the Merkle hash of the tree rooted at path.
+
+    :param str path: The directory to hash.
+    :param ignore: A callable taking a directory and the list of its entries
+                   and returning the entries to leave out, as taken by
+                   shutil.copytree.
+    :param DigestCache digests: The cache of file digests to use, if any.
+    """
+    digest = hashlib.sha256()
+    entries = sorted(os.listdir(path))
+    ignored = set(ignore(path, entries)) if ignore else set()
+    ignored.update(_VCS_METADATA)
+    for entry in entries:
+        if entry in ignored:
+            continue
+        entry_path = os.path.join(path, entry)
+        digest.update(_encode(_hash_entry(entry_path, entry, ignore,
+                                          digests)))
+
+    return digest.hexdigest()
+
+
+def hash_files(root, files, digests=None):
+    """Return a hash of the given files relative to root.
+
+    Files that do not exist are hashed as missing instead of failing, since
+    they are just a different input.
+    """
+    digest = hashlib.sha256()
+    for file_name in sorted(files):
+        file_path = os.path.join(root, file_name)
+        if os.path.lexists(file_path):
+            digest.update(_encode(_hash_entry(file_path, file_name,
+                                              digests=digests)))
+        else:
+            digest.update(_encode('missing {}\n'.format(file_name)))
+
+    return digest.hexdigest()
+
+
+def combine(*digests):
+    """Return a hash of several fingerprints."""
+    digest = hashlib.sha256()
+    for d in digests:
+        digest.update('{}\n'.format(d).encode())
+
+    return digest.hexdigest()
+
+
+def _hash_entry(path, name, ignore=None, digests=None):
+    st = os.lstat(path)
+    mode = stat.S_IMODE(st.st_mode)
+    if stat.S_ISLNK(st.st_mode):
+        kind, content = 'link', hashlib.sha256(
+            _encode(os.readlink(path))).hexdigest()
+    elif stat.S_ISDIR(st.st_mode):
+        kind, content = 'dir', hash_tree(path, ignore, digests)
+    elif stat.S_ISREG(st.st_mode):
+        kind = 'file'
+        content = digests.get(path, st) if digests else _hash_file(path)
+    else:
+        # Sockets, pipes and devices have no content worth reading.
+        kind, content = 'special', ''
+
+    return '{} {} {:o} {}\n'.format(kind, name, mode, content)
+
+
+def _encode(text):
+    return text.encode('utf-8', 'surrogateescape')
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import contextlib
 import os
 
 from progressbar import (
@@ -30,23 +31,57 @@ def download_requests_stream(request_stream, destination, message=None):
     if not message:
         message = 'Downloading {!r}'.format(os.path.basename(destination))
 
+    total_read = 0
+    progress_bar = _get_progress_bar(request_stream, message)
+    progress_bar.start()
+    with open(destination, 'wb') as destination_file:
+        for buf in request_stream.iter_content(1024):
+            destination_file.write(buf)
+            total_read += len(buf)
+            progress_bar.update(total_read)
+    progress_bar.finish()
+
+
+@contextlib.contextmanager
+def read_requests_stream(request_stream, message):
+    """Yield a file object reading request_stream with a progress bar.
+
+    The content is read as it was sent, with only its Content-Encoding
+    undone.
+    """
+    request_stream.raw.decode_content = True
+    reader = _ProgressReader(request_stream.raw,
+                             _get_progress_bar(request_stream, message))
+    reader.progress_bar.start()
+    yield reader
+    reader.progress_bar.finish()
+
+
+class _ProgressReader:
+
+    def __init__(self, raw, progress_bar):
+        self._raw = raw
+        self._total_read = 0
+        self.progress_bar = progress_bar
+
+    def read(self, size=-1):
+        buf = self._raw.read(size)
+        self._total_read += len(buf)
+        if (self.progress_bar.maxval is UnknownLength or
+                self._total_read <= self.progress_bar.maxval):
+            self.progress_bar.update(self._total_read)
+        return buf
+
+
+def _get_progress_bar(request_stream, message):
     total_length = int(request_stream.headers.get('Content-Length', '0'))
     if total_length:
-        progress_bar = ProgressBar(
+        return ProgressBar(
             widgets=[message,
                      Bar(marker='=', left='[', right=']'),
                      ' ', Percentage()],
             maxval=total_length)
     else:
-        progress_bar = ProgressBar(
+        return ProgressBar(
             widgets=[message, AnimatedMarker()],
             maxval=UnknownLength)
-
-    total_read = 0
-    progress_bar.start()
-    with open(destination, 'wb') as destination_file:
-        for buf in request_stream.iter_content(1024):
-            destination_file.write(buf)
-            total_read += len(buf)
-            progress_bar.update(total_read)
-    progress_bar.finish()
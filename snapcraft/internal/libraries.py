@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import contextlib
 import re
 import glob
 import logging
@@ -22,6 +23,7 @@ import platform
 import subprocess
 
 from snapcraft.internal import common
+from snapcraft.internal import elf as elf_utils
 
 
 logger = logging.getLogger(__name__)
@@ -80,12 +82,63 @@ def _get_system_libs():
     return _libraries
 
 
-def get_dependencies(elf):
+def get_system_library_paths():
+    """Return the directories the dynamic linker searches by default."""
+    global _system_library_paths
+    if _system_library_paths is None:
+        _system_library_paths = _parse_ld_so_conf('/etc/ld.so.conf')
+        # The trusted directories are always searched last.
+        _system_library_paths += ['/lib', '/usr/lib', '/lib64', '/usr/lib64']
+
+    return _system_library_paths
+
+
+_system_library_paths = None
+
+
+def _parse_ld_so_conf(conf_file):
+    paths = []
+    with contextlib.suppress(OSError):
+        with open(conf_file) as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if line.startswith('include'):
+                    for pattern in line.split()[1:]:
+                        pattern = os.path.join(os.path.dirname(conf_file),
+                                               pattern)
+                        for include in sorted(glob.glob(pattern)):
+                            paths += _parse_ld_so_conf(include)
+                elif line:
+                    paths += [p for p in re.split(r'[:\s,]', line) if p]
+
+    return paths
+
+
+def get_dependencies(elf, library_paths=None):
     """Return a list of libraries that are needed to satisfy elf's runtime.
 
     This may include libraries contained within the project.
+
+    :param str elf: The path to the ELF file.
+    :param list library_paths: Directories searched for libraries before the
+                               system ones, as with LD_LIBRARY_PATH.
     """
     logger.debug('Getting dependencies for {!r}'.format(elf))
+    try:
+        libs = elf_utils.find_libraries(
+            elf, library_paths or [], get_system_library_paths())
+    except elf_utils.ElfError as e:
+        logger.debug('Falling back to ldd: {}'.format(e))
+        libs = _get_dependencies_from_ldd(elf)
+
+    # Now lets filter out what would be on the system
+    system_libs = _get_system_libs()
+    libs = [l for l in libs if not os.path.basename(l) in system_libs]
+
+    return libs
+
+
+def _get_dependencies_from_ldd(elf):
     ldd_out = ''
     try:
         ldd_out = common.run_output(['ldd', elf]).split('\n')
@@ -94,10 +147,5 @@ def get_dependencies(elf):
             'Unable to determine library dependencies for {!r}'.format(elf))
         return []
     ldd_out = [l.split() for l in ldd_out]
-    ldd_out = [l[2] for l in ldd_out if len(l) > 2 and os.path.exists(l[2])]
 
-    # Now lets filter out what would be on the system
-    system_libs = _get_system_libs()
-    libs = [l for l in ldd_out if not os.path.basename(l) in system_libs]
-
-    return libs
+    return [l[2] for l in ldd_out if len(l) > 2 and os.path.exists(l[2])]
@@ -14,9 +14,12 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
 import contextlib
 import logging
+import multiprocessing
 import os
+import queue
 import shutil
 import sys
 import tarfile
@@ -59,6 +62,11 @@ parts:
 
 _STEPS_TO_AUTOMATICALLY_CLEAN_IF_DIRTY = {'stage', 'prime'}
 
+# Steps that only write into the part's own directories and can therefore run
+# for several parts at the same time. The remaining steps write into the
+# shared stage and prime directories.
+_CONCURRENT_STEPS = ('pull', 'build')
+
 
 def init():
     """Initialize a snapcraft project."""
@@ -119,6 +127,14 @@ class _Executor:
             parts = self.config.all_parts
             part_names = self.config.part_names
 
+        if not recursed:
+            self._fetch_stage_packages(parts)
+
+        if self.project_options.jobs > 1 and not recursed:
+            self._run_scheduled(step, parts, part_names)
+            self._create_meta(step, part_names)
+            return
+
         dirty = {p.name for p in parts if p.should_step_run('stage')}
         step_index = common.COMMAND_ORDER.index(step) + 1
 
@@ -130,18 +146,52 @@ class _Executor:
 
         self._create_meta(step, part_names)
 
+    def _run_scheduled(self, step, parts, part_names):
+        """Run the lifecycle up to step, pipelining the steps of the parts.
+
+        Prerequisites are always taken up to the stage step before the parts
+        that depend upon them are pulled. The prime step, if requested, runs
+        once every part is staged.
+        """
+        prereqs = {}
+        for part in parts:
+            part_prereqs = self.config.part_prereqs(part.name)
+            if not part_prereqs.issubset(part_names):
+                self._verify_prereqs_staged(step, part, part_prereqs)
+            prereqs[part.name] = part_prereqs & set(part_names)
+        required = set().union(*prereqs.values())
+
+        step_index = common.COMMAND_ORDER.index(step)
+        stage_index = common.COMMAND_ORDER.index('stage')
+        part_steps = collections.OrderedDict()
+        for part in [p for p in self.config.all_parts if p in parts]:
+            last_index = min(step_index, stage_index)
+            if part.name in required:
+                last_index = stage_index
+            part_steps[part] = common.COMMAND_ORDER[:last_index + 1]
+
+        _Pipeline(self, part_steps, prereqs).run(self.project_options.jobs)
+
+        if step == 'prime':
+            for part in part_steps:
+                if self._should_run_step(step, part):
+                    self._execute_step(step, part)
+
+    def _fetch_stage_packages(self, parts):
+        # Fetching the stage packages of every part about to be pulled up
+        # front lets them share the apt updates and downloads.
+        with repo.shared_sessions():
+            for part in self.config.all_parts:
+                if part in parts and part.should_step_run('pull'):
+                    part.fetch_stage_packages()
+
     def _run_step(self, step, part, part_names, dirty, recursed):
         common.reset_env()
         prereqs = self.config.part_prereqs(part.name)
         if recursed:
             prereqs = prereqs & dirty
         if prereqs and not prereqs.issubset(part_names):
-            for prereq in self.config.all_parts:
-                if prereq.name in prereqs and prereq.should_step_run('stage'):
-                    raise RuntimeError(
-                        'Requested {!r} of {!r} but there are unsatisfied '
-                        'prerequisites: {!r}'.format(
-                            step, part.name, ' '.join(prereqs)))
+            self._verify_prereqs_staged(step, part, prereqs)
         elif prereqs:
             # prerequisites need to build all the way to the staging
             # step to be able to share the common assets that make them
@@ -151,17 +201,37 @@ class _Executor:
                 '{}'.format(part.name, ' '.join(prereqs)))
             self.run('stage', prereqs, recursed=True)
 
+        if self._should_run_step(step, part):
+            self._execute_step(step, part)
+
+    def _verify_prereqs_staged(self, step, part, prereqs):
+        for prereq in self.config.all_parts:
+            if prereq.name in prereqs and prereq.should_step_run('stage'):
+                raise RuntimeError(
+                    'Requested {!r} of {!r} but there are unsatisfied '
+                    'prerequisites: {!r}'.format(
+                        step, part.name, ' '.join(prereqs)))
+
+    def _should_run_step(self, step, part):
         if part.is_dirty(step):
             self._handle_dirty(part, step)
+        elif part.is_outdated(step):
+            self._handle_outdated(part, step)
 
         if not part.should_step_run(step):
             part.notify_part_progress('Skipping {}'.format(step),
                                       '(already ran)')
-            return
+            return False
+
+        return True
+
+    def _execute_step(self, step, part, prepare=True):
+        common.reset_env()
 
         # Run the preparation function for this step (if implemented)
-        with contextlib.suppress(AttributeError):
-            getattr(part, 'prepare_{}'.format(step))()
+        if prepare:
+            with contextlib.suppress(AttributeError):
+                getattr(part, 'prepare_{}'.format(step))()
 
         common.env = self.config.build_env_for_part(part)
         getattr(part, step)()
@@ -204,6 +274,126 @@ class _Executor:
 
         part.clean(staged_state, primed_state, step, '(out of date)')
 
+    def _handle_outdated(self, part, step):
+        # Unlike dirty steps, there's no need to ask for the dependents to be
+        # cleaned: what they depend upon is part of their own fingerprint, so
+        # they will be rebuilt once this part is staged again. Their options
+        # are unchanged, so the source and build directories are kept for
+        # the steps to only redo what changed.
+        staged_state = self.config.get_project_state('stage')
+        primed_state = self.config.get_project_state('prime')
+        part.clean(staged_state, primed_state, step, '(inputs changed)',
+                   keep_dirs=True)
+
+
+class _Pipeline:
+    """Take each part through its steps as soon as they can run.
+
+    A part starts once all of its prerequisites are done, and then moves on
+    to its next step as soon as the previous one finishes instead of waiting
+    for the other parts to catch up. The concurrent steps run in worker
+    processes, while the steps writing into the shared directories run in
+    this process in between.
+    """
+
+    def __init__(self, executor, part_steps, prereqs):
+        self._executor = executor
+        self._part_steps = collections.OrderedDict(
+            (part, list(steps)) for part, steps in part_steps.items())
+        self._prereqs = prereqs
+        self._done = set()
+        self._running = set()
+        self._finished = queue.Queue()
+
+    def run(self, jobs):
+        # Forking (as opposed to spawning) hands the executor over to the
+        # workers without having to pickle it.
+        context = multiprocessing.get_context('fork')
+        jobs = min(jobs, len(self._part_steps)) or 1
+        first_error = None
+        with context.Pool(jobs, initializer=_init_worker,
+                          initargs=(self._executor,)) as pool:
+            first_error = self._try_dispatch(pool)
+            while self._running:
+                part, error = self._finished.get()
+                self._running.remove(part)
+                if error:
+                    first_error = first_error or error
+                elif not first_error:
+                    self._part_steps[part].pop(0)
+                    first_error = self._try_dispatch(pool)
+            pool.close()
+            pool.join()
+
+        if first_error:
+            raise first_error
+
+    def _try_dispatch(self, pool):
+        # Whether a step fails in a worker or in this process, the steps
+        # already running are left to finish rather than being killed
+        # halfway, and nothing new is started.
+        try:
+            self._dispatch(pool)
+        except Exception as error:
+            return error
+
+        return None
+
+    def _dispatch(self, pool):
+        # Parts are sorted so that prerequisites come before their dependents,
+        # so a single pass picks up the parts unblocked along the way.
+        for part in self._part_steps:
+            if part in self._running or part.name in self._done:
+                continue
+            if self._prereqs[part.name].issubset(self._done):
+                self._advance(part, pool)
+
+    def _advance(self, part, pool):
+        steps = self._part_steps[part]
+        while steps:
+            step = steps[0]
+            if self._executor._should_run_step(step, part):
+                if step in _CONCURRENT_STEPS:
+                    self._start(step, part, pool)
+                    return
+                if step == 'stage':
+                    # Parts that are still pulling or building are left out
+                    # since their files are not in place yet.
+                    pluginhandler.check_for_collisions(
+                        [p for p in self._executor.config.all_parts
+                         if p not in self._running])
+                self._executor._execute_step(step, part)
+            steps.pop(0)
+
+        self._done.add(part.name)
+
+    def _start(self, step, part, pool):
+        prepare = step != 'pull'
+        if not prepare:
+            # Stage packages are fetched through an apt cache that is shared
+            # by all the parts, so that is done here one part at a time.
+            common.reset_env()
+            part.prepare_pull()
+
+        self._running.add(part)
+        pool.apply_async(
+            _run_step_in_worker, (step, part.name, prepare),
+            callback=lambda result: self._finished.put((part, None)),
+            error_callback=lambda error: self._finished.put((part, error)))
+
+
+_worker_executor = None
+
+
+def _init_worker(executor):
+    global _worker_executor
+    _worker_executor = executor
+
+
+def _run_step_in_worker(step, part_name, prepare):
+    part = _worker_executor.config.get_part(part_name)
+    _worker_executor._execute_step(step, part, prepare=prepare)
+
 
 def _create_tar_filter(tar_filename):
     def _tar_filter(tarinfo):
@@ -300,11 +490,13 @@ def snap(project_options, directory=None, output=None):
 
 
 def _reverse_dependency_tree(config, part_name):
-    dependents = config.part_dependents(part_name)
-    for dependent in dependents.copy():
-        # No need to worry about infinite recursion due to circular
-        # dependencies since the YAML validation won't allow it.
-        dependents |= _reverse_dependency_tree(config, dependent)
+    dependents = set()
+    unvisited = [part_name]
+    while unvisited:
+        for dependent in config.part_dependents(unvisited.pop()):
+            if dependent not in dependents:
+                dependents.add(dependent)
+                unvisited.append(dependent)
 
     return dependents
 
@@ -14,25 +14,33 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
 import contextlib
 import filecmp
+import fnmatch
 import glob
 import importlib
-import itertools
+import inspect
+import json
 import logging
 import os
+import re
 import shutil
+import stat
 import sys
 
 import jsonschema
-import magic
 import yaml
 
 import snapcraft
 from snapcraft.internal import (
+    cache,
     common,
+    elf,
+    fingerprint,
     libraries,
     repo,
+    sources,
     states,
 )
 
@@ -74,7 +82,9 @@ class PluginHandler:
         self.code = None
         self.config = {}
         self._name = part_name
+        self._part_properties = properties
         self._ubuntu = None
+        self._stage_packages_fetched = False
         self._project_options = project_options
         self.deps = []
 
@@ -84,6 +94,10 @@ class PluginHandler:
         parts_dir = project_options.parts_dir
         self.ubuntudir = os.path.join(parts_dir, part_name, 'ubuntu')
         self.statedir = os.path.join(parts_dir, part_name, 'state')
+        self._dependency_cache_file = os.path.join(
+            parts_dir, part_name, 'dependency-cache.json')
+        self._digests_file = os.path.join(
+            parts_dir, part_name, 'digests-{}.json')
 
         self._migrate_state_file()
 
@@ -210,6 +224,66 @@ class PluginHandler:
 
         return False
 
+    def is_outdated(self, step):
+        """Return true if the inputs of the given step changed since it ran.
+
+        Only steps that recorded a fingerprint of their inputs can be
+        outdated.
+        """
+
+        fingerprint = getattr(self.get_state(step), 'fingerprint', None)
+        if not fingerprint:
+            return False
+
+        return fingerprint != self._step_fingerprint(step)
+
+    def _step_fingerprint(self, step):
+        # The digests of the files hashed are kept from one run to the next,
+        # so that only the files which changed since are read again.
+        if step == 'pull':
+            digests = fingerprint.DigestCache(self._digests_file.format(step))
+            step_fingerprint = sources.get_fingerprint(
+                self.code.sourcedir, self.code.options, digests)
+        elif step == 'build':
+            digests = fingerprint.DigestCache(self._digests_file.format(step))
+            step_fingerprint = self._build_fingerprint(digests)
+        else:
+            return None
+
+        digests.save()
+        return step_fingerprint
+
+    def _build_fingerprint(self, digests=None):
+        # The build step depends upon the pulled source and on whatever the
+        # prerequisites staged.
+        fingerprints = []
+        if os.path.isdir(self.code.sourcedir):
+            fingerprints.append(fingerprint.hash_tree(self.code.sourcedir,
+                                                      digests=digests))
+        for dep in sorted(self.deps, key=lambda d: d.name):
+            staged_files = getattr(dep.get_state('stage'), 'files', set())
+            fingerprints.append(dep.name)
+            fingerprints.append(fingerprint.hash_files(
+                self.stagedir, staged_files, digests))
+
+        return fingerprint.combine(*fingerprints)
+
+    def _build_cache_key(self):
+        # The same part built the same way from the same source is expected
+        # to install the same files. The install directory is only part of
+        # the key for plugins embedding it in what they install.
+        plugin_files = _get_source_files(type(self.code))
+        if not plugin_files:
+            return None
+
+        installdir = self.installdir if self.code.embeds_installdir else ''
+        return fingerprint.combine(
+            fingerprint.hash_files(os.sep, plugin_files),
+            json.dumps(self._part_properties, sort_keys=True, default=str),
+            self._project_options.arch_triplet,
+            installdir,
+            self._step_fingerprint('build'))
+
     def should_step_run(self, step, force=False):
         return force or self.is_clean(step)
 
@@ -248,8 +322,9 @@ class PluginHandler:
     def _step_state_file(self, step):
         return os.path.join(self.statedir, step)
 
-    def _fetch_stage_packages(self):
-        if not self.code.stage_packages:
+    def fetch_stage_packages(self):
+        """Download the stage packages, unless that has already been done."""
+        if not self.code.stage_packages or self._stage_packages_fetched:
             return
 
         try:
@@ -258,6 +333,7 @@ class PluginHandler:
             raise RuntimeError("Error downloading stage packages for part "
                                "{!r}: no such package {!r}".format(
                                    self.name, e.package_name))
+        self._stage_packages_fetched = True
 
     def _unpack_stage_packages(self):
         if self.code.stage_packages:
@@ -266,17 +342,19 @@ class PluginHandler:
     def prepare_pull(self, force=False):
         self.makedirs()
         self.notify_part_progress('Preparing to pull')
-        self._fetch_stage_packages()
+        self.fetch_stage_packages()
         self._unpack_stage_packages()
 
     def pull(self, force=False):
         self.makedirs()
         self.notify_part_progress('Pulling')
+        pull_fingerprint = self._step_fingerprint('pull')
         self.code.pull()
         self.mark_done('pull', states.PullState(
-            self.pull_properties, self.code.options, self._project_options))
+            self.pull_properties, self.code.options, self._project_options,
+            pull_fingerprint))
 
-    def clean_pull(self, hint=''):
+    def clean_pull(self, hint='', keep_dirs=False):
         if self.is_clean('pull'):
             hint = '{} {}'.format(hint, '(already clean)').strip()
             self.notify_part_progress('Skipping cleaning pulled source for',
@@ -287,8 +365,12 @@ class PluginHandler:
         # Remove ubuntu cache (where stage packages are fetched)
         if os.path.exists(self.ubuntudir):
             shutil.rmtree(self.ubuntudir)
+        self._stage_packages_fetched = False
 
-        self.code.clean_pull()
+        # Only local sources can tell that they changed, and they are pulled
+        # again on top of what was pulled, copying only what changed.
+        if not keep_dirs:
+            self.code.clean_pull()
         self.mark_cleaned('pull')
 
     def prepare_build(self, force=False):
@@ -300,12 +382,22 @@ class PluginHandler:
 
     def build(self, force=False):
         self.makedirs()
-        self.notify_part_progress('Building')
-        self.code.build()
+        build_cache = cache.get_build_cache()
+        cache_key = self._build_cache_key() if build_cache else None
+        if cache_key and build_cache.restore(cache_key, self.installdir):
+            self.notify_part_progress('Restoring cached build for')
+        else:
+            self.notify_part_progress('Building')
+            self.code.build()
+            if cache_key:
+                build_cache.store(cache_key, self.installdir)
+        # Some plugins write into the source directory while building, so the
+        # fingerprint is only taken once they are done.
         self.mark_done('build', states.BuildState(
-            self.build_properties, self.code.options, self._project_options))
+            self.build_properties, self.code.options, self._project_options,
+            self._step_fingerprint('build')))
 
-    def clean_build(self, hint=''):
+    def clean_build(self, hint='', keep_dirs=False):
         if self.is_clean('build'):
             hint = '{} {}'.format(hint, '(already clean)').strip()
             self.notify_part_progress('Skipping cleaning build for',
@@ -313,7 +405,13 @@ class PluginHandler:
             return
 
         self.notify_part_progress('Cleaning build for', hint)
-        self.code.clean_build()
+        if keep_dirs:
+            # The build directory is kept for the sources to be synced into
+            # it and for the build system to only rebuild what changed.
+            if os.path.exists(self.code.installdir):
+                shutil.rmtree(self.code.installdir)
+        else:
+            self.code.clean_build()
         self.mark_cleaned('build')
 
     def migratable_fileset_for(self, step):
@@ -357,6 +455,10 @@ class PluginHandler:
 
         _migrate_files(snap_files, snap_dirs, self.code.installdir,
                        self.stagedir, fixup_func=fixup_func)
+        # Files may have been added deep into the stage directory without
+        # changing its mtime, which is what invalidates the build
+        # environments computed from it.
+        os.utime(self.stagedir)
         # TODO once `snappy try` is in place we will need to copy
         # dependencies here too
 
@@ -382,6 +484,8 @@ class PluginHandler:
                 "Failed to clean step 'stage': Missing necessary state. "
                 "This won't work until a complete clean has occurred.")
 
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(self.stagedir)
         self.mark_cleaned('stage')
 
     def prime(self, force=False):
@@ -389,7 +493,11 @@ class PluginHandler:
         self.notify_part_progress('Priming')
         snap_files, snap_dirs = self.migratable_fileset_for('snap')
         _migrate_files(snap_files, snap_dirs, self.stagedir, self.snapdir)
-        dependencies = _find_dependencies(self.snapdir)
+        # Only the files of this part are looked at, the ones of the other
+        # parts have had their dependencies primed with them.
+        dependencies = _find_dependencies(
+            self.snapdir, snap_files, self._library_paths(),
+            self._dependency_cache_file)
 
         # Split the necessary dependencies into their corresponding location.
         # We'll both migrate and track the system dependencies, but we'll only
@@ -429,6 +537,17 @@ class PluginHandler:
             snap_files, snap_dirs, dependency_paths, self.code.options,
             self._project_options))
 
+    def _library_paths(self):
+        # Libraries are searched for in this part, then in what has been
+        # staged and primed, before the system.
+        paths = []
+        for root in (self.installdir, self.stagedir, self.snapdir):
+            paths += libraries.determine_ld_library_path(root)
+            paths += common.get_library_paths(
+                root, self._project_options.arch_triplet)
+
+        return paths
+
     def clean_prime(self, project_primed_state, hint=''):
         if self.is_clean('prime'):
             hint = '{} {}'.format(hint, '(already clean)').strip()
@@ -482,7 +601,7 @@ class PluginHandler:
         return self.code.env(root)
 
     def clean(self, project_staged_state=None, project_primed_state=None,
-              step=None, hint=''):
+              step=None, hint='', keep_dirs=False):
         if not project_staged_state:
             project_staged_state = {}
 
@@ -491,7 +610,7 @@ class PluginHandler:
 
         try:
             self._clean_steps(project_staged_state, project_primed_state,
-                              step, hint)
+                              step, hint, keep_dirs)
         except MissingState:
             # If one of the step cleaning rules is missing state, it must be
             # running on the output of an old Snapcraft. In that case, if we
@@ -505,6 +624,13 @@ class PluginHandler:
             if os.path.exists(self.code.partdir):
                 shutil.rmtree(self.code.partdir)
 
+        if self.is_clean('pull'):
+            for cache_file in (self._dependency_cache_file,
+                               self._digests_file.format('pull'),
+                               self._digests_file.format('build')):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(cache_file)
+
         # Remove the part directory if it's completely empty (i.e. all steps
         # have been cleaned).
         if (os.path.exists(self.code.partdir) and
@@ -512,7 +638,7 @@ class PluginHandler:
             os.rmdir(self.code.partdir)
 
     def _clean_steps(self, project_staged_state, project_primed_state,
-                     step=None, hint=None):
+                     step=None, hint=None, keep_dirs=False):
         index = None
         if step:
             if step not in common.COMMAND_ORDER:
@@ -529,10 +655,10 @@ class PluginHandler:
             self.clean_stage(project_staged_state, hint)
 
         if not index or index <= common.COMMAND_ORDER.index('build'):
-            self.clean_build(hint)
+            self.clean_build(hint, keep_dirs)
 
         if not index or index <= common.COMMAND_ORDER.index('pull'):
-            self.clean_pull(hint)
+            self.clean_pull(hint, keep_dirs)
 
 
 def _validate_step_properties(step, plugin_schema):
@@ -625,20 +751,7 @@ def load_plugin(part_name, plugin_name, properties=None,
 def _migratable_filesets(fileset, srcdir):
     includes, excludes = _get_file_list(fileset)
 
-    include_files = _generate_include_set(srcdir, includes)
-    exclude_files, exclude_dirs = _generate_exclude_set(srcdir, excludes)
-
-    # And chop files, including whole trees if any dirs are mentioned
-    snap_files = include_files - exclude_files
-    for exclude_dir in exclude_dirs:
-        snap_files = set([x for x in snap_files
-                          if not x.startswith(exclude_dir + '/')])
-
-    # Separate dirs from files
-    snap_dirs = set([x for x in snap_files
-                     if os.path.isdir(os.path.join(srcdir, x)) and
-                     not os.path.islink(os.path.join(srcdir, x))])
-    snap_files = snap_files - snap_dirs
+    snap_files, snap_dirs = _FilesetMatcher(includes, excludes).match(srcdir)
 
     # Make sure we also obtain the parent directories of files
     for snap_file in snap_files:
@@ -650,6 +763,142 @@ def _migratable_filesets(fileset, srcdir):
     return snap_files, snap_dirs
 
 
+class _FilesetMatcher:
+    """Match include and exclude globs in a single walk of a tree.
+
+    Globs are matched one path component at a time, the way glob.glob does,
+    and included directories bring in everything below them, the way os.walk
+    does. Nothing is walked below an excluded directory. Includes without a
+    '*' are taken literally, even when they don't exist.
+    """
+
+    def __init__(self, includes, excludes):
+        self._literal_includes = [os.path.normpath(i) for i in includes
+                                  if '*' not in i]
+        patterns = [(True, i, '*' in i) for i in includes]
+        patterns += [(False, e, True) for e in excludes]
+        self._patterns = []
+        for is_include, pattern, magic in patterns:
+            components, dir_only = _compile_glob(pattern, magic)
+            if components:
+                self._patterns.append((is_include, components, dir_only))
+
+    def match(self, srcdir):
+        """Return the files and directories of srcdir that match.
+
+        Both are returned as sets of paths relative to srcdir.
+        """
+        self._files = set()
+        self._dirs = set()
+        self._excluded_dirs = set()
+        self._walk(srcdir, '', [(p, 0) for p in self._patterns], False)
+
+        for include in self._literal_includes:
+            if (not os.path.lexists(os.path.join(srcdir, include)) and
+                    not self._is_excluded(include)):
+                self._files.add(include)
+
+        return self._files, self._dirs
+
+    def _walk(self, path, relpath, states, expanded):
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            # Like glob and os.walk, skip what cannot be read.
+            return
+
+        for entry in entries:
+            entry_relpath = os.path.join(relpath, entry.name)
+            is_dir = _is_dir(entry)
+            child_states, included_root, excluded = self._match(
+                entry.name, is_dir, states)
+            included = expanded or included_root
+            if excluded:
+                if is_dir:
+                    self._excluded_dirs.add(entry_relpath)
+                continue
+
+            is_real_dir = entry.is_dir(follow_symlinks=False)
+            if included:
+                if is_real_dir:
+                    self._dirs.add(entry_relpath)
+                else:
+                    self._files.add(entry_relpath)
+
+            # An included directory is walked as a whole, following it if
+            # it is a symlink, but not the symlinks found inside it.
+            expand = included and (is_real_dir or
+                                   (included_root and is_dir))
+            if not is_dir:
+                child_states = []
+            if child_states or expand:
+                self._walk(entry.path, entry_relpath, child_states, expand)
+
+    def _match(self, name, is_dir, states):
+        """Match an entry against the patterns that got to its directory.
+
+        Return the patterns left to match below it, and whether it was
+        included or excluded by a pattern ending with it.
+        """
+        child_states = []
+        included = excluded = False
+        for pattern, position in states:
+            is_include, components, dir_only = pattern
+            if not _component_matches(components[position], name):
+                continue
+            if position + 1 < len(components):
+                child_states.append((pattern, position + 1))
+            elif not dir_only or is_dir:
+                if is_include:
+                    included = True
+                else:
+                    excluded = True
+
+        return child_states, included, excluded
+
+    def _is_excluded(self, relpath):
+        dirname = os.path.dirname(relpath)
+        while dirname:
+            if dirname in self._excluded_dirs:
+                return True
+            dirname = os.path.dirname(dirname)
+
+        return False
+
+
+def _is_dir(entry):
+    try:
+        return entry.is_dir()
+    except OSError:
+        # Symlink loops, like os.path.isdir does.
+        return False
+
+
+def _compile_glob(pattern, magic=True):
+    components = []
+    for component in pattern.split('/'):
+        if component in ('', '.'):
+            continue
+        if magic and glob.has_magic(component):
+            # Like glob, wildcards only match hidden files when the
+            # pattern itself starts with a dot.
+            components.append((re.compile(fnmatch.translate(component)),
+                               component.startswith('.')))
+        else:
+            components.append(component)
+
+    return components, magic and pattern.endswith('/')
+
+
+def _component_matches(component, name):
+    if isinstance(component, str):
+        return component == name
+
+    regex, match_hidden = component
+    return (match_hidden or not name.startswith('.')) and bool(
+        regex.match(name))
+
+
 def _create_dirs(srcdir, dstdir, follow_symlinks=False):
     dir_stat = os.stat(srcdir, follow_symlinks=follow_symlinks)
     uid = dir_stat.st_uid
@@ -666,38 +915,106 @@ def _create_dirs(srcdir, dstdir, follow_symlinks=False):
 
 def _migrate_files(snap_files, snap_dirs, srcdir, dstdir, missing_ok=False,
                    follow_symlinks=False, fixup_func=lambda *args: None):
+    """Hard-link or copy snap_files and snap_dirs from srcdir into dstdir.
+
+    Each directory is created once, files are linked and only the ones that
+    cannot be linked are copied, in parallel.
+
+    :returns: the number of files that were linked and that were copied.
+    """
+    # Parents sort before their subdirectories.
+    directories = set(snap_dirs) | {os.path.dirname(f) for f in snap_files}
+    for directory in sorted(directories):
+        _create_dirs(os.path.join(srcdir, directory),
+                     os.path.join(dstdir, directory),
+                     follow_symlinks=follow_symlinks)
 
-    for directory in snap_dirs:
-        src = os.path.join(srcdir, directory)
-        dst = os.path.join(dstdir, directory)
-
-        _create_dirs(src, dst, follow_symlinks=follow_symlinks)
-
+    linked = []
+    copies = []
     for snap_file in snap_files:
         src = os.path.join(srcdir, snap_file)
         dst = os.path.join(dstdir, snap_file)
 
-        _create_dirs(os.path.dirname(src), os.path.dirname(dst),
-                     follow_symlinks=follow_symlinks)
-
         if missing_ok and not os.path.exists(src):
             continue
 
-        # If the file is already here and it's a symlink, leave it alone.
-        if os.path.islink(dst):
+        if src.endswith('.pc'):
+            if _remove_migrated_file(dst):
+                copies.append((shutil.copy2, src, dst))
             continue
 
-        # Otherwise, remove and re-link it.
-        if os.path.exists(dst):
-            os.remove(dst)
+        result = _link_migrated_file(src, dst, follow_symlinks)
+        if result:
+            linked.append(dst)
+        elif result is not None:
+            copies.append((common.link_or_copy, src, dst))
 
-        if src.endswith('.pc'):
-            shutil.copy2(src, dst, follow_symlinks=follow_symlinks)
-        else:
-            common.link_or_copy(src, dst, follow_symlinks=follow_symlinks)
+    _copy_files(copies, follow_symlinks)
 
+    for dst in linked + [dst for _, _, dst in copies]:
         fixup_func(dst)
 
+    logger.debug('Migrated {} files from {!r} to {!r}: {} linked, {} '
+                 'copied'.format(len(linked) + len(copies), srcdir, dstdir,
+                                 len(linked), len(copies)))
+    return len(linked), len(copies)
+
+
+def _remove_migrated_file(dst):
+    # If the file is already here and it's a symlink, leave it alone.
+    # Otherwise, remove it so that it can be replaced.
+    try:
+        if os.path.islink(dst):
+            return False
+        os.remove(dst)
+    except FileNotFoundError:
+        pass
+
+    return True
+
+
+def _link_migrated_file(src, dst, follow_symlinks):
+    """Hard-link dst to src, replacing dst unless it is a symlink.
+
+    :returns: True if dst was linked, False if it has to be copied instead
+              and None if it was left alone.
+    """
+    # os.link doesn't follow symlinks reliably, hence realpath.
+    source_path = os.path.realpath(src) if follow_symlinks else src
+    try:
+        os.link(source_path, dst, follow_symlinks=False)
+        return True
+    except FileExistsError:
+        if not _remove_migrated_file(dst):
+            return None
+    except OSError:
+        return False
+
+    try:
+        os.link(source_path, dst, follow_symlinks=False)
+        return True
+    except OSError:
+        return False
+
+
+_MAX_COPY_WORKERS = 8
+
+
+def _copy_files(copies, follow_symlinks):
+    if len(copies) < 2:
+        for copy_function, src, dst in copies:
+            copy_function(src, dst, follow_symlinks=follow_symlinks)
+        return
+
+    workers = min(len(copies), _MAX_COPY_WORKERS)
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(copy_function, src, dst,
+                                   follow_symlinks=follow_symlinks)
+                   for copy_function, src, dst in copies]
+        for future in futures:
+            # Raise the first error, if any.
+            future.result()
+
 
 def _clean_migrated_files(snap_files, snap_dirs, directory):
     for snap_file in snap_files:
@@ -714,33 +1031,151 @@ def _clean_migrated_files(snap_files, snap_dirs, directory):
             os.rmdir(migrated_directory)
 
 
-def _find_dependencies(workdir):
-    ms = magic.open(magic.NONE)
-    if ms.load() != 0:
-        raise RuntimeError('Cannot load magic header detection')
+def _get_source_files(cls):
+    # The plugin's behaviour also comes from the classes it derives from,
+    # BasePlugin included.
+    source_files = []
+    if not inspect.getsourcefile(cls):
+        return source_files
 
-    elf_files = set()
-    fs_encoding = sys.getfilesystemencoding()
+    for base in cls.__mro__:
+        with contextlib.suppress(TypeError):
+            source_file = inspect.getsourcefile(base)
+            if source_file and source_file not in source_files:
+                source_files.append(source_file)
 
-    for root, dirs, files in os.walk(workdir.encode(fs_encoding)):
+    return source_files
+
+
+def _find_dependencies(workdir, files, library_paths=None, cache_file=None):
+    """Return the libraries needed by files, relative to workdir.
+
+    The dependencies found are saved to cache_file, if given, so that files
+    which haven't changed since the last run aren't read again.
+    """
+    cache = _DependencyCache(cache_file, workdir, library_paths)
+    dependencies = set()
+    for file_name in files:
         # Filter out object (*.o) files-- we only care about binaries.
-        entries = (entry for entry in itertools.chain(files, dirs)
-                   if not entry.endswith(b'.o'))
-        for entry in entries:
-            path = os.path.join(root, entry)
-            if os.path.islink(path):
-                logger.debug('Skipped link {!r} when parsing {!r}'.format(
-                    path, workdir))
-                continue
-            file_m = ms.file(path)
-            if file_m.startswith('ELF') and 'dynamically linked' in file_m:
-                elf_files.add(path)
+        if not file_name.endswith('.o'):
+            dependencies.update(cache.get(os.path.join(workdir, file_name)))
+
+    cache.save()
+    return dependencies
+
+
+class _DependencyCache:
+    """The libraries needed by files, keyed by their path, size and mtime.
+
+    An entry is only reused if the libraries it resolved to are unchanged,
+    none of them is now shadowed by a library earlier in the search path
+    and none of the libraries it couldn't find is now in the search path.
+    The directories under workdir are left out of the shadowing check, as
+    priming copies the libraries found there itself.
+    """
+
+    def __init__(self, cache_file, workdir, library_paths):
+        self._cache_file = cache_file
+        self._workdir = os.path.join(workdir, '')
+        self._library_paths = library_paths
+        self._search_paths = (
+            (library_paths or []) + libraries.get_system_library_paths())
+        self._entries = {}
+        self._used_entries = {}
+
+        if cache_file:
+            with contextlib.suppress(OSError, ValueError):
+                with open(cache_file) as f:
+                    self._entries = json.load(f).get('entries', {})
+
+    def get(self, path):
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            return []
+        if not stat.S_ISREG(st.st_mode):
+            logger.debug('Skipped {!r} when looking for dependencies'.format(
+                path))
+            return []
+
+        key = [st.st_size, st.st_mtime_ns]
+        entry = self._entries.get(path)
+        if not (entry and len(entry) == 3 and entry[0] == key and
+                self._is_valid(entry[1], entry[2])):
+            if _is_dynamically_linked(path):
+                dependencies = libraries.get_dependencies(
+                    path, self._library_paths)
+            else:
+                dependencies = []
+            entry = [key, [[d] + _file_key(d) for d in dependencies],
+                     self._unresolved(path, dependencies)]
+
+        self._used_entries[path] = entry
+        return [d[0] for d in entry[1]]
+
+    def _unresolved(self, path, dependencies):
+        """Return the names of the libraries needed but not found."""
+        resolved = {os.path.basename(d) for d in dependencies}
+        needed = set()
+        for elf_path in [path] + dependencies:
+            with contextlib.suppress(elf.ElfError):
+                needed.update(elf.get_elf_file(elf_path).needed)
+
+        return sorted(name for name in needed - resolved
+                      if not self._is_in_search_paths(name))
+
+    def _is_in_search_paths(self, name):
+        return any(os.path.exists(os.path.join(search_path, name))
+                   for search_path in self._search_paths)
+
+    def _is_valid(self, dependencies, unresolved):
+        if any(self._is_in_search_paths(name) for name in unresolved):
+            return False
+
+        for dependency, *key in dependencies:
+            if _file_key(dependency) != key:
+                return False
+            directory, name = os.path.split(dependency)
+            with contextlib.suppress(ValueError):
+                index = self._search_paths.index(directory)
+                for search_path in self._search_paths[:index]:
+                    if (not search_path.startswith(self._workdir) and
+                            os.path.exists(os.path.join(search_path, name))):
+                        return False
+
+        return True
 
-    dependencies = []
-    for elf_file in elf_files:
-        dependencies += libraries.get_dependencies(elf_file)
+    def save(self):
+        if not self._cache_file:
+            return
 
-    return set(dependencies)
+        # Only keep the files that are still there, so that the cache
+        # doesn't grow forever.
+        tmp_file = self._cache_file + '.tmp'
+        os.makedirs(os.path.dirname(tmp_file), exist_ok=True)
+        with open(tmp_file, 'w') as f:
+            json.dump({'entries': self._used_entries}, f)
+        os.replace(tmp_file, self._cache_file)
+
+
+def _file_key(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return [None, None]
+
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _is_dynamically_linked(path):
+    if not elf.is_elf(path):
+        return False
+
+    try:
+        return elf.get_elf_file(path).is_dynamic
+    except elf.ElfError:
+        # Let libraries.get_dependencies fall back to ldd for these.
+        return True
 
 
 def _get_file_list(stage_set):
@@ -762,47 +1197,6 @@ def _get_file_list(stage_set):
     return includes, excludes
 
 
-def _generate_include_set(directory, includes):
-    include_files = set()
-    for include in includes:
-        if '*' in include:
-            matches = glob.glob(os.path.join(directory, include))
-            include_files |= set(matches)
-        else:
-            include_files |= set([os.path.join(directory, include), ])
-
-    include_dirs = [x for x in include_files if os.path.isdir(x)]
-    include_files = set([os.path.relpath(x, directory) for x in include_files])
-
-    # Expand includeFiles, so that an exclude like '*/*.so' will still match
-    # files from an include like 'lib'
-    for include_dir in include_dirs:
-        for root, dirs, files in os.walk(include_dir):
-            include_files |= \
-                set([os.path.relpath(os.path.join(root, d), directory)
-                     for d in dirs])
-            include_files |= \
-                set([os.path.relpath(os.path.join(root, f), directory)
-                     for f in files])
-
-    return include_files
-
-
-def _generate_exclude_set(directory, excludes):
-    exclude_files = set()
-
-    for exclude in excludes:
-        matches = glob.glob(os.path.join(directory, exclude))
-        exclude_files |= set(matches)
-
-    exclude_dirs = [os.path.relpath(x, directory)
-                    for x in exclude_files if os.path.isdir(x)]
-    exclude_files = set([os.path.relpath(x, directory)
-                         for x in exclude_files])
-
-    return exclude_files, exclude_dirs
-
-
 def _validate_relative_paths(files):
     for d in files:
         if os.path.isabs(d):
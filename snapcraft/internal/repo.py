@@ -14,11 +14,15 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+import concurrent.futures
 import fileinput
 import glob
 import hashlib
 import itertools
+import json
 import logging
+import multiprocessing
 import os
 import platform
 import re
@@ -27,17 +31,24 @@ import stat
 import string
 import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
+import time
 import urllib
 import urllib.request
 from distutils.dir_util import copy_tree
-from contextlib import contextmanager
+from contextlib import contextmanager, ExitStack, suppress
 
 import apt
+import requests
+from progressbar import Bar, Percentage, ProgressBar
+from requests.adapters import HTTPAdapter
 from xml.etree import ElementTree
 from xdg import BaseDirectory
 
 import snapcraft
-from snapcraft.internal import common
+from snapcraft.internal import cache, common
 
 
 _BIN_PATHS = (
@@ -61,6 +72,15 @@ deb http://${security}.ubuntu.com/${suffix} ${release}-security universe
 deb http://${security}.ubuntu.com/${suffix} ${release}-security multiverse
 '''
 _GEOIP_SERVER = "http://geoip.ubuntu.com/lookup"
+_DPKG_STATUS = '/var/lib/dpkg/status'
+
+_MAX_DOWNLOAD_WORKERS = 8
+_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+_DOWNLOAD_TIMEOUT = 60
+
+_APT_CACHE_TTL_ENV = 'SNAPCRAFT_APT_CACHE_TTL'
+# Package lists updated less than this many seconds ago are used as they are.
+_DEFAULT_APT_CACHE_TTL = 300
 
 
 def is_package_installed(package):
@@ -75,6 +95,13 @@ def is_package_installed(package):
 
 def install_build_packages(packages):
     unique_packages = set(packages)
+    try:
+        if unique_packages <= _get_installed_packages():
+            # Opening the apt cache takes a while, skip it.
+            return
+    except OSError as e:
+        logger.debug('Unable to read {}: {}'.format(_DPKG_STATUS, e))
+
     new_packages = []
     with apt.Cache() as apt_cache:
         for pkg in unique_packages:
@@ -99,6 +126,33 @@ def install_build_packages(packages):
                                'install'] + new_packages, env=env)
 
 
+def _get_installed_packages():
+    """Return the names of the installed packages, read from dpkg's status.
+
+    Packages are named with and without their architecture, but only those
+    of the native architecture can go without.
+    """
+    native_arch = apt.apt_pkg.config.find('APT::Architecture')
+    installed = set()
+    package = architecture = status = None
+    with open(_DPKG_STATUS) as f:
+        for line in itertools.chain(f, ['\n']):
+            if line.startswith('Package: '):
+                package = line[9:].strip()
+            elif line.startswith('Architecture: '):
+                architecture = line[14:].strip()
+            elif line.startswith('Status: '):
+                status = line[8:].split()
+            elif line == '\n':
+                if package and status and status[-1] == 'installed':
+                    installed.add('{}:{}'.format(package, architecture))
+                    if architecture in (native_arch, 'all'):
+                        installed.add(package)
+                package = architecture = status = None
+
+    return installed
+
+
 class PackageNotFoundError(Exception):
 
     @property
@@ -117,9 +171,209 @@ class UnpackError(Exception):
         return 'Error while provisioning "{}"'.format(self.package_name)
 
     def __init__(self, package_name):
+        # Passed on so that it can be pickled back from worker processes.
+        super().__init__(package_name)
         self.package_name = package_name
 
 
+_shared_sessions = None
+
+
+@contextmanager
+def shared_sessions():
+    """Share the apt sessions of the Ubuntu repos used within this context.
+
+    The package lists of a sources list are then only updated once, and the
+    apt cache only opened once, however many repos use them.
+    """
+    global _shared_sessions
+    if _shared_sessions is not None:
+        yield
+        return
+
+    with ExitStack() as stack:
+        _shared_sessions = ({}, stack)
+        try:
+            yield
+        finally:
+            _shared_sessions = None
+
+
+def _get_apt_cache_ttl():
+    ttl = os.environ.get(_APT_CACHE_TTL_ENV)
+    if not ttl:
+        return _DEFAULT_APT_CACHE_TTL
+
+    try:
+        return int(ttl)
+    except ValueError:
+        raise EnvironmentError(
+            '{} must be a number of seconds, not {!r}'.format(
+                _APT_CACHE_TTL_ENV, ttl))
+
+
+def _is_fresh(stamp, ttl):
+    try:
+        return time.time() - os.stat(stamp).st_mtime < ttl
+    except FileNotFoundError:
+        return False
+
+
+class _AptSession:
+    """An open apt cache, downloading into the package cache."""
+
+    def __init__(self, apt_cache, package_cache_dir, progress):
+        self.apt_cache = apt_cache
+        self.package_cache_dir = package_cache_dir
+        self.progress = progress
+
+    def fetch(self):
+        """Download the packages marked for install.
+
+        Packages already in the package cache are not downloaded again.
+
+        :returns: the paths to the downloaded packages.
+        """
+        downloads = [_Download.from_version(self.package_cache_dir,
+                                            package.candidate)
+                     for package in self.apt_cache.get_changes()
+                     if not package.marked_delete]
+        # Only apt knows about its other methods, proxies and credentials.
+        if (not all(d.uri.startswith(('http://', 'https://'))
+                    for d in downloads) or _has_apt_network_settings()):
+            return self._fetch_with_apt()
+
+        missing = [d for d in downloads if not d.is_cached()]
+        if missing:
+            _download_packages(missing)
+
+        return [d.destination for d in downloads]
+
+    def _fetch_with_apt(self):
+        # Several sessions may be open, so this can't be set only once.
+        apt.apt_pkg.config.set('Dir::Cache::Archives', self.package_cache_dir)
+        fetcher = apt.apt_pkg.Acquire(self.progress)
+        self.apt_cache.fetch_archives(fetcher=fetcher)
+
+        return [item.destfile for item in fetcher.items]
+
+
+def _has_apt_network_settings():
+    config = apt.apt_pkg.config
+    for scheme in ('http', 'https'):
+        for option in ('Proxy', 'Proxy-Auto-Detect', 'ProxyAutoDetect'):
+            if config.exists('Acquire::{}::{}'.format(scheme, option)):
+                return True
+
+    if os.path.isfile(config.find_file('Dir::Etc::netrc')):
+        return True
+    netrc_parts = config.find_file('Dir::Etc::netrcparts')
+    return os.path.isdir(netrc_parts) and bool(os.listdir(netrc_parts))
+
+
+class _Download:
+    """A package to download into the package cache."""
+
+    def __init__(self, uri, size, checksum, destination):
+        self.uri = uri
+        self.size = size
+        self.checksum = checksum
+        self.destination = destination
+
+    @classmethod
+    def from_version(cls, package_cache_dir, version):
+        # Named the way apt names the packages it downloads, so that the
+        # packages it downloaded before are found in the cache.
+        name = '{}_{}_{}.deb'.format(
+            version.package.name, _quote_version(version.version),
+            version.architecture)
+        for algorithm in ('sha256', 'sha1', 'md5'):
+            checksum = getattr(version, algorithm)
+            if checksum:
+                checksum = (algorithm, checksum)
+                break
+        else:
+            checksum = None
+
+        return cls(version.uri or '', version.size, checksum,
+                   os.path.join(package_cache_dir, name))
+
+    def is_cached(self):
+        # Packages are checked before being moved into the cache.
+        try:
+            return os.path.getsize(self.destination) == self.size
+        except FileNotFoundError:
+            return False
+
+    def download(self, session, progress):
+        partial = os.path.join(os.path.dirname(self.destination), 'partial',
+                               os.path.basename(self.destination))
+        if self.checksum:
+            algorithm, expected = self.checksum
+            checksum = hashlib.new(algorithm)
+
+        response = session.get(self.uri, stream=True,
+                               timeout=_DOWNLOAD_TIMEOUT)
+        try:
+            response.raise_for_status()
+            with open(partial, 'wb') as f:
+                for chunk in response.iter_content(_DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    if self.checksum:
+                        checksum.update(chunk)
+                    progress(len(chunk))
+        finally:
+            response.close()
+
+        if self.checksum and checksum.hexdigest() != expected:
+            os.remove(partial)
+            raise EnvironmentError(
+                'The {} checksum of {!r} does not match the package '
+                'index'.format(algorithm, self.uri))
+
+        os.replace(partial, self.destination)
+
+
+def _quote_version(version):
+    return ''.join('%{:02x}'.format(ord(c)) if c in '_:%' else c
+                   for c in version)
+
+
+def _download_packages(downloads):
+    os.makedirs(os.path.join(
+        os.path.dirname(downloads[0].destination), 'partial'), exist_ok=True)
+
+    workers = min(_MAX_DOWNLOAD_WORKERS, len(downloads))
+    # A single pool of connections per host, shared by all the workers.
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=workers, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    progress_bar = ProgressBar(
+        widgets=['Downloading stage packages ',
+                 Bar(marker='=', left='[', right=']'), ' ', Percentage()],
+        maxval=sum(d.size for d in downloads) or 1)
+    lock = threading.Lock()
+    downloaded = 0
+
+    def progress(size):
+        nonlocal downloaded
+        with lock:
+            downloaded += size
+            progress_bar.update(min(downloaded, progress_bar.maxval))
+
+    progress_bar.start()
+    with session, concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers) as executor:
+        futures = [executor.submit(d.download, session, progress)
+                   for d in downloads]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+    progress_bar.finish()
+
+
 class _AptCache:
 
     def __init__(self, cache_dir, deb_arch, *,
@@ -142,6 +396,9 @@ class _AptCache:
         # apt.Cache(rootdir).
         for key in 'Dir::Etc::Trusted', 'Dir::Etc::TrustedParts':
             apt.apt_pkg.config.set(key, apt.apt_pkg.config.find_file(key))
+        # And the system credentials for the archives.
+        for key in 'Dir::Etc::netrc', 'Dir::Etc::netrcparts':
+            apt.apt_pkg.config.set(key, apt.apt_pkg.config.find_file(key))
 
         # Clear up apt's Post-Invoke-Success as we are not running
         # on the system.
@@ -153,21 +410,20 @@ class _AptCache:
             self.progress.pulse = lambda owner: True
             self.progress._width = 0
 
-    def _setup_apt_cache(self, rootdir):
+    def _get_sources_list(self):
         if self._use_geoip or self._sources_list:
             release = platform.linux_distribution()[2]
-            sources_list = _format_sources_list(
+            return _format_sources_list(
                 self._sources_list, deb_arch=self._deb_arch,
                 use_geoip=self._use_geoip, release=release)
         else:
-            sources_list = _get_local_sources_list()
-
-        sources_list_digest = hashlib.sha384(
-            sources_list.encode(sys.getfilesystemencoding())).hexdigest()
+            return _get_local_sources_list()
 
-        cache_dir = os.path.join(self._cache_dir, sources_list_digest)
+    def _setup_apt_cache(self, rootdir, cache_dir, sources_list):
         apt_cache_dir = os.path.join(cache_dir, 'apt')
-        package_cache_dir = os.path.join(cache_dir, 'packages')
+        # The package lists are kept from one update to the next, so that
+        # apt only downloads the ones modified since (If-Modified-Since).
+        update_stamp = os.path.join(cache_dir, 'updated')
 
         sources_list_file = os.path.join(
             apt_cache_dir, 'etc', 'apt', 'sources.list')
@@ -176,46 +432,55 @@ class _AptCache:
         with open(sources_list_file, 'w') as f:
             f.write(sources_list)
 
-        apt_cache = apt.Cache(rootdir=apt_cache_dir, memonly=True)
-        apt_cache.update(fetch_progress=self.progress,
-                         sources_list=sources_list_file)
+        ttl = _get_apt_cache_ttl()
+        if _is_fresh(update_stamp, ttl):
+            logger.debug('Package lists updated less than {} seconds ago, '
+                         'not updating them'.format(ttl))
+        else:
+            apt_cache = apt.Cache(rootdir=apt_cache_dir, memonly=True)
+            apt_cache.update(fetch_progress=self.progress,
+                             sources_list=sources_list_file)
+            with open(update_stamp, 'w'):
+                pass
 
         copy_tree(apt_cache_dir, rootdir, update=True)
 
-        return package_cache_dir
-
-    def _restore_cached_packages(self, apt_changes,
-                                 package_cache_dir, download_dir):
-        for pkg in apt_changes:
-            src = os.path.join(package_cache_dir, pkg.name)
-            dst = os.path.join(download_dir, pkg.name)
-            if os.path.exists(src):
-                common.link_or_copy(src, dst)
+    @contextmanager
+    def archive(self, rootdir):
+        """Yield an _AptSession for the sources list.
+
+        Within shared_sessions(), the session is kept open and handed to
+        every repo using the same sources list, with its marks cleared.
+        """
+        if _shared_sessions is None:
+            with self._open_session(rootdir) as session:
+                yield session
+            return
+
+        sessions, stack = _shared_sessions
+        key = (self._cache_dir, self._deb_arch, self._sources_list,
+               self._use_geoip)
+        if key not in sessions:
+            sessions[key] = stack.enter_context(self._open_session(rootdir))
+        else:
+            sessions[key].apt_cache.clear()
 
-    def _store_cached_packages(self, package_cache_dir, download_dir):
-        os.makedirs(package_cache_dir, exist_ok=True)
-        for pkg in os.listdir(download_dir):
-            if not pkg.endswith('.deb'):
-                continue
-            src = os.path.join(download_dir, pkg)
-            dst = os.path.join(package_cache_dir, pkg)
-            # The dst may be an incomplete or broken so let's update
-            # just in case.
-            if os.path.exists(dst):
-                os.unlink(dst)
-            common.link_or_copy(src, dst)
+        yield sessions[key]
 
     @contextmanager
-    def archive(self, rootdir, download_dir):
+    def _open_session(self, rootdir):
         try:
-            self._setup_apt(download_dir)
-            package_cache_dir = self._setup_apt_cache(rootdir)
+            sources_list = self._get_sources_list()
+            sources_list_digest = hashlib.sha384(
+                sources_list.encode(sys.getfilesystemencoding())).hexdigest()
+            cache_dir = os.path.join(self._cache_dir, sources_list_digest)
+            package_cache_dir = os.path.join(cache_dir, 'packages')
+
+            self._setup_apt(package_cache_dir)
+            self._setup_apt_cache(rootdir, cache_dir, sources_list)
             apt_cache = apt.Cache(rootdir=rootdir, memonly=True)
             apt_cache.open()
-            self._restore_cached_packages(apt_cache.get_changes(),
-                                          package_cache_dir, download_dir)
-            yield apt_cache
-            self._store_cached_packages(package_cache_dir, download_dir)
+            yield _AptSession(apt_cache, package_cache_dir, self.progress)
         except Exception as e:
             logger.debug('Exception occured: {!r}'.format(e))
             raise e
@@ -230,6 +495,7 @@ class Ubuntu:
         self.recommends = recommends
         cache_dir = os.path.join(
             BaseDirectory.xdg_cache_home, 'snapcraft')
+        self._extracted_debs_dir = os.path.join(cache_dir, 'extracted-debs')
 
         if not project_options:
             project_options = snapcraft.ProjectOptions()
@@ -239,11 +505,26 @@ class Ubuntu:
                              use_geoip=project_options.use_geoip)
 
     def get(self, package_names):
-        with self.apt.archive(self.rootdir, self.downloaddir) as apt_cache:
-            self._get(apt_cache, package_names)
+        """Download package_names and their dependencies.
+
+        Packages are downloaded into a cache shared by every repo using the
+        same sources list, and hard-linked into this repo's download
+        directory.
+        """
+        with self.apt.archive(self.rootdir) as session:
+            self._get(session.apt_cache, package_names)
+            debs = session.fetch()
+
+        os.makedirs(self.downloaddir, exist_ok=True)
+        for deb in debs:
+            destination = os.path.join(self.downloaddir,
+                                       os.path.basename(deb))
+            with suppress(FileNotFoundError):
+                os.remove(destination)
+            common.link_or_copy(deb, destination)
 
     def _get(self, apt_cache, package_names):
-        manifest_dep_names = self._manifest_dep_names(apt_cache)
+        manifest_dep_names = _get_manifest_dep_names()
 
         for name in package_names:
             try:
@@ -260,7 +541,9 @@ class Ubuntu:
         # (apt_cache.broken_count will be > 0)
         # but that is ok as it was consistent before we excluded
         # these base package
-        for pkg in apt_cache:
+        # Only the packages marked for install need to be looked at, keeping
+        # any other is a no-op.
+        for pkg in apt_cache.get_changes():
             # those should be already on each system, it also prevents
             # diving into downloading libc6
             if (pkg.candidate.priority in 'essential' and
@@ -281,32 +564,68 @@ class Ubuntu:
             logger.debug('Skipping blacklisted from manifest packages: '
                          '{!r}'.format(skipped_blacklisted))
 
-        apt_cache.fetch_archives(progress=self.apt.progress)
-
     def unpack(self, rootdir):
-        pkgs_abs_path = glob.glob(os.path.join(self.downloaddir, '*.deb'))
-        for pkg in pkgs_abs_path:
-            # TODO needs elegance and error control
-            try:
-                subprocess.check_call(['dpkg-deb', '--extract', pkg, rootdir])
-            except subprocess.CalledProcessError:
-                raise UnpackError(pkg)
+        """Extract the downloaded packages into rootdir.
+
+        Packages are extracted once into a cache, in parallel, with their
+        suid/sgid bits dropped and python shebangs changed to use env. Their
+        files are then copied into rootdir, as cheaply as the filesystems
+        allow, with the prefix of pkg-config files, xml2-config and
+        xslt-config in rootdir. Absolute symlinks are made relative once all
+        the packages are in rootdir.
+        """
+        debs = sorted(glob.glob(os.path.join(self.downloaddir, '*.deb')))
+        entries = collections.OrderedDict(
+            (deb, os.path.join(self._extracted_debs_dir, '{}.{}'.format(
+                os.path.basename(deb)[:-len('.deb')], _EXTRACTED_DEB_VERSION)))
+            for deb in debs)
+        manifests = {deb: _load_manifest(entry)
+                     for deb, entry in entries.items()}
+        missing = [deb for deb in debs if manifests[deb] is None]
+
+        if missing:
+            os.makedirs(self._extracted_debs_dir, exist_ok=True)
+        if len(missing) == 1:
+            manifests[missing[0]] = _cache_deb(missing[0], entries[missing[0]])
+        elif missing:
+            workers = min(len(missing), os.cpu_count() or 1)
+            # Steps run with --jobs are in the daemonic workers of a pool,
+            # which can't have children of their own.
+            if multiprocessing.current_process().daemon:
+                executor_class = concurrent.futures.ThreadPoolExecutor
+            else:
+                executor_class = concurrent.futures.ProcessPoolExecutor
+            with executor_class(max_workers=workers) as executor:
+                futures = {executor.submit(_cache_deb, deb, entries[deb]): deb
+                           for deb in missing}
+                for future in concurrent.futures.as_completed(futures):
+                    manifests[futures[future]] = future.result()
+
+        absolute_links = []
+        for deb, entry in entries.items():
+            absolute_links.extend(_link_deb(entry, manifests[deb], rootdir))
 
-        _fix_artifacts(rootdir)
-        _fix_xml_tools(rootdir)
-        _fix_shebangs(rootdir)
+        for path, target in absolute_links:
+            _fix_symlink(path, target, rootdir)
 
-    def _manifest_dep_names(self, apt_cache):
-        manifest_dep_names = set()
+        if entries:
+            cache.evict_extracted_debs(self._extracted_debs_dir,
+                                       entries.values())
 
+
+_manifest_dep_names = None
+
+
+def _get_manifest_dep_names():
+    """Return the packages of the base system, from manifest.txt."""
+    global _manifest_dep_names
+    if _manifest_dep_names is None:
         with open(os.path.abspath(os.path.join(__file__, '..',
                                                'manifest.txt'))) as f:
-            for line in f:
-                pkg = line.strip()
-                if pkg in apt_cache:
-                    manifest_dep_names.add(pkg)
+            _manifest_dep_names = frozenset(
+                line.strip() for line in f if line.strip())
 
-        return manifest_dep_names
+    return _manifest_dep_names
 
 
 def _get_local_sources_list():
@@ -382,68 +701,315 @@ def fix_pkg_config(root, pkg_config_file, prefix_trim=None):
                 print(line, end='')
 
 
-def _fix_artifacts(debdir):
-    '''
-    Sometimes debs will contain absolute symlinks (e.g. if the relative
-    path would go all the way to root, they just do absolute).  We can't
-    have that, so instead clean those absolute symlinks.
-
-    Some unpacked items will also contain suid binaries which we do not want in
-    the resulting snap.
-    '''
-    for root, dirs, files in os.walk(debdir):
-        # Symlinks to directories will be in dirs, while symlinks to
-        # non-directories will be in files.
-        for entry in itertools.chain(files, dirs):
-            path = os.path.join(root, entry)
-            if os.path.islink(path) and os.path.isabs(os.readlink(path)):
-                _fix_symlink(path, debdir, root)
-            elif os.path.exists(path):
-                _fix_filemode(path)
-
-            if path.endswith('.pc') and not os.path.islink(path):
-                fix_pkg_config(debdir, path)
-
-
-def _fix_xml_tools(root):
-    xml2_config_path = os.path.join(root, 'usr', 'bin', 'xml2-config')
-    if os.path.isfile(xml2_config_path):
-        common.run(
-            ['sed', '-i', '-e', 's|prefix=/usr|prefix={}/usr|'.
-                format(root), xml2_config_path])
-
-    xslt_config_path = os.path.join(root, 'usr', 'bin', 'xslt-config')
-    if os.path.isfile(xslt_config_path):
-        common.run(
-            ['sed', '-i', '-e', 's|prefix=/usr|prefix={}/usr|'.
-                format(root), xslt_config_path])
-
-
-def _fix_symlink(path, debdir, root):
-    target = os.path.join(debdir, os.readlink(path)[1:])
-    if _skip_link(os.readlink(path)):
+class _ArMemberReader:
+    """Read a single member of an ar archive."""
+
+    def __init__(self, f, size):
+        self._f = f
+        self._left = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self._left:
+            size = self._left
+        data = self._f.read(size)
+        self._left -= len(data)
+        return data
+
+
+# The compressions of data.tar that tarfile can read.
+_TARFILE_DATA_MEMBERS = (b'data.tar', b'data.tar.gz', b'data.tar.bz2',
+                         b'data.tar.xz')
+
+# Bump when the way packages are extracted into the cache changes.
+_EXTRACTED_DEB_VERSION = 2
+
+
+def _cache_deb(deb, entry):
+    """Extract deb into the cache entry and return its manifest.
+
+    The manifest lists the members of deb in order, as ('d', name, mode),
+    ('f', name, size, mtime_ns), ('h', name, target) for hard links or
+    ('l', name, target) for symlinks.
+    """
+    with suppress(FileNotFoundError):
+        # A stale entry.
+        shutil.rmtree(entry)
+
+    tmpdir = tempfile.mkdtemp(prefix='.tmp-', dir=os.path.dirname(entry))
+    try:
+        manifest = _extract_deb(deb, os.path.join(tmpdir, 'tree'))
+        with open(os.path.join(tmpdir, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+        with open(os.path.join(tmpdir, 'size'), 'w') as f:
+            f.write(str(sum(member[2] for member in manifest
+                            if member[0] == 'f')))
+        # Renaming is atomic, so concurrent pulls never see a partial
+        # entry. If another one got there first, keep theirs.
+        with suppress(OSError):
+            os.rename(tmpdir, entry)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return manifest
+
+
+def _load_manifest(entry):
+    """Return the manifest of the cache entry, or None if it is unusable.
+
+    The entry is unusable if any of its files was modified since it was
+    extracted.
+    """
+    try:
+        with open(os.path.join(entry, 'manifest.json')) as f:
+            manifest = json.load(f)
+        for kind, name, *details in manifest:
+            if kind == 'f':
+                st = os.lstat(os.path.join(entry, 'tree', name))
+                if [st.st_size, st.st_mtime_ns] != details:
+                    logger.debug('{} changed in the cache'.format(name))
+                    return None
+        # Mark the entry as recently used.
+        os.utime(entry)
+    except (OSError, ValueError):
+        return None
+
+    return manifest
+
+
+def _extract_deb(deb, tree):
+    try:
+        with open(deb, 'rb') as f:
+            if f.read(8) != b'!<arch>\n':
+                raise ValueError('not a Debian package')
+            while True:
+                header = f.read(60)
+                if len(header) < 60:
+                    raise ValueError('no data member')
+                name = header[:16].rstrip(b' /')
+                size = int(header[48:58])
+                if name.startswith(b'data.tar'):
+                    break
+                f.seek(size + size % 2, os.SEEK_CUR)
+
+            if name in _TARFILE_DATA_MEMBERS:
+                with tarfile.open(fileobj=_ArMemberReader(f, size),
+                                  mode='r|*') as tar:
+                    return _extract_tar(tar, tree)
+
+        # Other compressions are left for dpkg-deb to deal with.
+        with subprocess.Popen(['dpkg-deb', '--fsys-tarfile', deb],
+                              stdout=subprocess.PIPE) as process:
+            with tarfile.open(fileobj=process.stdout, mode='r|') as tar:
+                manifest = _extract_tar(tar, tree)
+        if process.returncode:
+            raise UnpackError(deb)
+        return manifest
+    except (OSError, ValueError, EOFError, tarfile.TarError) as e:
+        logger.warning('Unable to extract {!r}: {}'.format(deb, e))
+        raise UnpackError(deb) from e
+
+
+def _extract_tar(tar, tree):
+    manifest = []
+    directories = []
+    absolute_links = []
+    os.makedirs(tree, exist_ok=True)
+    for member in tar:
+        name = _member_name(member.name)
+        if name == '.':
+            continue
+        path = os.path.join(tree, name)
+
+        if member.isdir():
+            if _make_directory(path):
+                directories.append((path, member.mode))
+            manifest.append(('d', name, stat.S_IMODE(member.mode) & 0o1777))
+        elif _make_room(path, name):
+            entry = _extract_member(tar, member, name, tree, absolute_links)
+            if entry:
+                manifest.append(entry)
+
+    # Set last, in case a directory is not writable.
+    for path, mode in reversed(directories):
+        _fix_filemode(path, mode)
+
+    return manifest
+
+
+def _member_name(name):
+    """Return the normalized name of a member, unless it is outside."""
+    normalized = os.path.normpath(name)
+    if os.path.isabs(normalized) or normalized.split(os.sep)[0] == '..':
+        raise ValueError('{!r} is outside of the package'.format(name))
+    return normalized
+
+
+def _extract_member(tar, member, name, tree, absolute_links):
+    """Extract a member other than a directory.
+
+    :returns: the manifest entry of the member, or None if it was skipped.
+    """
+    path = os.path.join(tree, name)
+    if member.issym():
+        _make_symlink(path, member.linkname, tree, absolute_links)
+        return ('l', name, member.linkname)
+    elif member.islnk():
+        target = _member_name(member.linkname)
+        os.link(os.path.join(tree, target), path)
+        return ('h', name, target)
+    elif member.isreg():
+        with tar.extractfile(member) as source, \
+                open(path, 'wb') as destination:
+            if any(name.startswith(p + os.sep) for p in _BIN_PATHS):
+                destination.write(_fix_shebang_content(source.read()))
+            else:
+                shutil.copyfileobj(source, destination)
+        _fix_filemode(path, member.mode)
+        os.utime(path, (member.mtime, member.mtime))
+    else:
+        logger.debug('Skipping special file {}'.format(member.name))
+        return None
+
+    st = os.lstat(path)
+    return ('f', name, st.st_size, st.st_mtime_ns)
+
+
+def _link_deb(entry, manifest, rootdir):
+    """Link the cached tree of a package into rootdir.
+
+    :returns: the (path, target) of the absolute symlinks, which are made
+              relative to rootdir for the time being.
+    """
+    tree = os.path.join(entry, 'tree')
+    directories = []
+    absolute_links = []
+    for kind, name, *details in manifest:
+        path = os.path.join(rootdir, name)
+        if kind == 'd':
+            if _make_directory(path):
+                directories.append((path, details[0]))
+            continue
+        if not _make_room(path, name):
+            continue
+
+        if kind == 'l':
+            _make_symlink(path, details[0], rootdir, absolute_links)
+            continue
+        if kind == 'h':
+            common.link_or_copy(os.path.join(rootdir, details[0]), path)
+            continue
+
+        source = os.path.join(tree, name)
+        fixup = _relocation_fixup(name, rootdir)
+        if fixup:
+            with open(source, 'rb') as f:
+                content = fixup(f.read())
+            with open(path, 'wb') as f:
+                f.write(content)
+            shutil.copystat(source, path)
+        else:
+            # Copied rather than linked, as the files of parts may be
+            # modified in place.
+            common.copy(source, path)
+
+    for path, mode in reversed(directories):
+        _fix_filemode(path, mode)
+
+    return absolute_links
+
+
+def _make_directory(path):
+    """Create the directory path, returning whether it is a real one."""
+    # Packages unpacked in parallel create the same directories.
+    os.makedirs(path, exist_ok=True)
+    return not os.path.islink(path)
+
+
+def _make_room(path, name):
+    """Make room for the file or link path, unless it is a directory."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.isdir(path) and not os.path.islink(path):
+        logger.warning('Not replacing directory {} with {}'.format(
+            path, name))
+        return False
+    with suppress(FileNotFoundError):
+        os.remove(path)
+    return True
+
+
+def _make_symlink(path, target, rootdir, absolute_links):
+    # Absolute symlinks point inside rootdir until they are fixed, so that
+    # nothing is ever written through them to the system.
+    if os.path.isabs(target):
+        absolute_links.append((path, target))
+        os.symlink(_relative_link(path, target, rootdir), path)
+    else:
+        os.symlink(target, path)
+
+
+def _relocation_fixup(name, rootdir):
+    if name.endswith('.pc'):
+        return lambda content: _fix_pkg_config_content(content, rootdir)
+    if name in ('usr/bin/xml2-config', 'usr/bin/xslt-config'):
+        return lambda content: _fix_xml_tool_content(content, rootdir)
+    return None
+
+
+def _fix_pkg_config_content(content, root):
+    """Prefix the prefix of pkg-config content with root."""
+    content = content.decode(errors='surrogateescape')
+    content = re.sub(r'^prefix=', lambda m: 'prefix=' + root, content,
+                     flags=re.MULTILINE)
+    return content.encode(errors='surrogateescape')
+
+
+def _fix_xml_tool_content(content, root):
+    content = content.decode(errors='surrogateescape')
+    content = re.sub(r'^(.*?)prefix=/usr',
+                     lambda m: '{}prefix={}/usr'.format(m.group(1), root),
+                     content, flags=re.MULTILINE)
+    return content.encode(errors='surrogateescape')
+
+
+def _fix_shebang_content(content):
+    """Change hard coded python shebangs to use env."""
+    try:
+        text = content.decode()
+    except UnicodeDecodeError:
+        # This was probably a binary file. Skip it.
+        return content
+    return re.sub(r'#!.*python\n', '#!/usr/bin/env python\n',
+                  text).encode()
+
+
+def _relative_link(path, target, rootdir):
+    return os.path.relpath(os.path.join(rootdir, target[1:]),
+                           os.path.dirname(path))
+
+
+def _fix_symlink(path, target, rootdir):
+    """Settle an absolute symlink, made relative to rootdir on extraction.
+
+    Debs sometimes contain absolute symlinks (e.g. if the relative path
+    would go all the way to root), which can't be kept as they are unless
+    their target is provided by the system the snap runs on.
+    """
+    if _skip_link(target):
         logger.debug('Skipping {}'.format(target))
+    elif (os.path.exists(os.path.join(rootdir, target[1:])) or
+          _try_copy_local(path, target, rootdir)):
         return
-    if not os.path.exists(target) and not _try_copy_local(path, target):
-        return
+
     os.remove(path)
-    os.symlink(os.path.relpath(target, root), path)
+    os.symlink(target, path)
 
 
-def _fix_filemode(path):
-    mode = stat.S_IMODE(os.stat(path, follow_symlinks=False).st_mode)
+def _fix_filemode(path, mode):
+    mode = stat.S_IMODE(mode)
     if mode & 0o4000 or mode & 0o2000:
         logger.warning('Removing suid/guid from {}'.format(path))
-        os.chmod(path, mode & 0o1777)
-
-
-def _fix_shebangs(path):
-    """Changes hard coded shebangs for files in _BIN_PATHS to use env."""
-    paths = [p for p in _BIN_PATHS if os.path.exists(os.path.join(path, p))]
-    for p in [os.path.join(path, p) for p in paths]:
-        common.replace_in_file(p, re.compile(r''),
-                               re.compile(r'#!.*python\n'),
-                               r'#!/usr/bin/env python\n')
+        mode &= 0o1777
+    os.chmod(path, mode)
 
 
 _skip_list = None
@@ -458,13 +1024,14 @@ def _skip_link(target):
     return target in _skip_list
 
 
-def _try_copy_local(path, target):
-    real_path = os.path.realpath(path)
+def _try_copy_local(path, target, rootdir):
+    real_path = os.path.realpath(target)
     if os.path.exists(real_path):
         logger.warning(
             'Copying needed target link from the system {}'.format(real_path))
-        os.makedirs(os.path.dirname(target), exist_ok=True)
-        shutil.copyfile(os.readlink(path), target)
+        local_target = os.path.join(rootdir, target[1:])
+        os.makedirs(os.path.dirname(local_target), exist_ok=True)
+        shutil.copyfile(real_path, local_target)
         return True
     else:
         logger.warning(
@@ -43,6 +43,17 @@ code for that part, and how to unpack it if necessary.
     Snapcraft will checkout the specific tag from the source tree revision
     control system.
 
+  - source-commit: <commit>
+
+    Snapcraft will checkout this exact commit (its full 40 character sha)
+    from a git repository, fetching nothing else. Pulling a commit that is
+    already checked out does not go to the network at all.
+
+  - source-checksum: <algorithm>/<digest>
+
+    Snapcraft will check that the tarball, zip or script referred to by the
+    'source' keyword has this checksum, e.g. sha256/6d4b4f...
+
   - source-subdir: path
 
     Snapcraft will checkout the repository or unpack the archive referred to
@@ -72,12 +83,22 @@ import tempfile
 import zipfile
 import glob
 
-from snapcraft.internal import common
-from snapcraft.internal.indicators import download_requests_stream
+from snapcraft.internal import cache, common, fingerprint
+from snapcraft.internal.indicators import (
+    download_requests_stream,
+    read_requests_stream,
+)
 
 
 logging.getLogger('urllib3').setLevel(logging.CRITICAL)
 
+# Submodules are fetched in parallel, which is bound by the network rather
+# than by the number of CPUs. This is set through the configuration rather
+# than with --jobs, which older versions of git don't know and fail on, while
+# they ignore settings they don't know.
+_GIT_SUBMODULE_JOBS = 8
+_GIT = ['git', '-c', 'submodule.fetchJobs={}'.format(_GIT_SUBMODULE_JOBS)]
+
 
 class IncompatibleOptionsError(Exception):
 
@@ -88,11 +109,22 @@ class IncompatibleOptionsError(Exception):
 class Base:
 
     def __init__(self, source, source_dir, source_tag=None,
-                 source_branch=None):
+                 source_branch=None, source_checksum=None):
         self.source = source
         self.source_dir = source_dir
         self.source_tag = source_tag
         self.source_branch = source_branch
+        self.source_checksum = source_checksum
+
+    def fingerprint(self, digests=None):
+        """Return a fingerprint of the source or None if it is unknown.
+
+        Sources that need to be fetched cannot tell if they changed without
+        fetching them again, so by default there is no fingerprint.
+
+        :param digests: The fingerprint.DigestCache to use, if any.
+        """
+        return None
 
 
 class FileBase(Base):
@@ -101,24 +133,37 @@ class FileBase(Base):
         if common.isurl(self.source):
             self.download()
         else:
+            if self.source_checksum:
+                cache.verify_checksum(self.source, self.source_checksum)
             shutil.copy2(self.source, self.source_dir)
 
         self.provision(self.source_dir)
 
     def download(self):
-        request = requests.get(self.source, stream=True, allow_redirects=True)
-        request.raise_for_status()
-
+        """Download the source into source_dir, through the download cache.
+        """
         self.file = os.path.join(
             self.source_dir, os.path.basename(self.source))
+
+        download_cache = cache.get_download_cache()
+        if download_cache:
+            download_cache.fetch(self.source, self.file,
+                                 checksum=self.source_checksum)
+            return
+
+        request = requests.get(self.source, stream=True, allow_redirects=True)
+        request.raise_for_status()
         download_requests_stream(request, self.file)
+        if self.source_checksum:
+            cache.verify_checksum(self.file, self.source_checksum)
 
 
 class Script(FileBase):
 
     def __init__(self, source, source_dir, source_tag=None,
-                 source_branch=None):
-        super().__init__(source, source_dir, source_tag, source_branch)
+                 source_branch=None, source_checksum=None):
+        super().__init__(source, source_dir, source_tag, source_branch,
+                         source_checksum)
 
     def download(self):
         super().download()
@@ -153,37 +198,109 @@ class Bazaar(Base):
 class Git(Base):
 
     def __init__(self, source, source_dir, source_tag=None,
-                 source_branch=None):
+                 source_branch=None, source_commit=None):
         super().__init__(source, source_dir, source_tag, source_branch)
+        self.source_commit = source_commit
         if source_tag and source_branch:
             raise IncompatibleOptionsError(
                 'can\'t specify both source-tag and source-branch for '
                 'a git source')
+        if source_commit and (source_tag or source_branch):
+            raise IncompatibleOptionsError(
+                'can\'t specify both source-commit and source-{} for '
+                'a git source'.format('tag' if source_tag else 'branch'))
 
     def pull(self):
-        if os.path.exists(os.path.join(self.source_dir, '.git')):
-            refspec = 'HEAD'
-            if self.source_branch:
-                refspec = 'refs/heads/' + self.source_branch
+        if self.source_commit and self._is_checked_out(self.source_commit):
+            return
+
+        git_cache = None
+        if not os.path.isdir(self.source):
+            # Local repositories are cloned with hard links already.
+            git_cache = cache.get_git_cache()
+        if git_cache:
+            ref = None
+            if self.source_commit:
+                ref = self.source_commit
             elif self.source_tag:
-                refspec = 'refs/tags/' + self.source_tag
-
+                ref = 'refs/tags/' + self.source_tag
+            mirror = git_cache.mirror(self.source, ref=ref)
+            if self.source_commit:
+                self._pull_commit(mirror)
+            else:
+                self._pull_from_mirror(mirror)
+        elif self.source_commit:
+            self._pull_commit(self.source)
+        elif os.path.exists(os.path.join(self.source_dir, '.git')):
             # Pull changes to this repository and any submodules.
             subprocess.check_call(['git', '-C', self.source_dir, 'pull',
                                    '--recurse-submodules=yes', self.source,
-                                   refspec])
+                                   self._refspec()])
 
             # Merge any updates for the submodules (if any).
-            subprocess.check_call(['git', '-C', self.source_dir, 'submodule',
-                                   'update'])
+            subprocess.check_call(_GIT + ['-C', self.source_dir, 'submodule',
+                                          'update'])
+        else:
+            branch_opts = []
+            if self.source_tag or self.source_branch:
+                branch_opts = ['--branch',
+                               self.source_tag or self.source_branch]
+            subprocess.check_call(
+                _GIT + ['clone', '--depth', '1', '--recursive'] +
+                branch_opts + [self.source, self.source_dir])
+
+    def _pull_from_mirror(self, mirror):
+        # Only the mirror talks to the remote, everything else is fetched
+        # locally from it.
+        if os.path.exists(os.path.join(self.source_dir, '.git')):
+            subprocess.check_call(['git', '-C', self.source_dir, 'pull',
+                                   mirror, self._refspec()])
         else:
             branch_opts = []
             if self.source_tag or self.source_branch:
                 branch_opts = ['--branch',
                                self.source_tag or self.source_branch]
-            subprocess.check_call(['git', 'clone', '--depth', '1',
-                                  '--recursive'] + branch_opts +
-                                  [self.source, self.source_dir])
+            subprocess.check_call(['git', 'clone'] + branch_opts +
+                                  [mirror, self.source_dir])
+            # Relative submodule URLs are resolved against origin.
+            subprocess.check_call(['git', '-C', self.source_dir, 'remote',
+                                   'set-url', 'origin', self.source])
+
+        subprocess.check_call(_GIT + ['-C', self.source_dir, 'submodule',
+                                      'update', '--init', '--recursive'])
+
+    def _pull_commit(self, url):
+        # Only the commit itself is fetched, into a new or an existing
+        # checkout.
+        if not os.path.exists(os.path.join(self.source_dir, '.git')):
+            subprocess.check_call(['git', 'init', '--quiet',
+                                   self.source_dir])
+            subprocess.check_call(['git', '-C', self.source_dir, 'remote',
+                                   'add', 'origin', self.source])
+        subprocess.check_call(['git', '-C', self.source_dir, 'fetch',
+                               '--depth', '1', url, self.source_commit])
+        subprocess.check_call(['git', '-C', self.source_dir, 'checkout',
+                               '--quiet', 'FETCH_HEAD'])
+        subprocess.check_call(_GIT + ['-C', self.source_dir, 'submodule',
+                                      'update', '--init', '--recursive'])
+
+    def _is_checked_out(self, commit):
+        if not os.path.exists(os.path.join(self.source_dir, '.git')):
+            return False
+        try:
+            head = subprocess.check_output(
+                ['git', '-C', self.source_dir, 'rev-parse', 'HEAD'],
+                stderr=subprocess.DEVNULL)
+        except subprocess.CalledProcessError:
+            return False
+        return head.decode().strip() == commit.lower()
+
+    def _refspec(self):
+        if self.source_branch:
+            return 'refs/heads/' + self.source_branch
+        elif self.source_tag:
+            return 'refs/tags/' + self.source_tag
+        return 'HEAD'
 
 
 class Mercurial(Base):
@@ -248,8 +365,9 @@ class Subversion(Base):
 class Tar(FileBase):
 
     def __init__(self, source, source_dir, source_tag=None,
-                 source_branch=None):
-        super().__init__(source, source_dir, source_tag, source_branch)
+                 source_branch=None, source_checksum=None):
+        super().__init__(source, source_dir, source_tag, source_branch,
+                         source_checksum)
         if source_tag:
             raise IncompatibleOptionsError(
                 'can\'t specify a source-tag for a tar source')
@@ -257,70 +375,167 @@ class Tar(FileBase):
             raise IncompatibleOptionsError(
                 'can\'t specify a source-branch for a tar source')
 
+    def pull(self):
+        """Extract the tarball into source_dir as it is read.
+
+        Remote tarballs are extracted while they are downloaded, and local
+        ones without being copied first.
+        """
+        if not common.isurl(self.source):
+            if self.source_checksum:
+                cache.verify_checksum(self.source, self.source_checksum)
+            with open(self.source, 'rb') as tarball:
+                self._extract(tarball, self.source_dir)
+            return
+
+        message = 'Downloading {!r}'.format(os.path.basename(self.source))
+        download_cache = cache.get_download_cache()
+        if download_cache:
+            # The tarball is checked against source_checksum once it is
+            # read, before the source directory is touched.
+            with download_cache.open(self.source, self.source_checksum,
+                                     message) as tarball:
+                self._extract(tarball, self.source_dir)
+            return
+        elif self.source_checksum:
+            # Which can only be done once the tarball is downloaded.
+            super().pull()
+            return
+
+        request = requests.get(self.source, stream=True, allow_redirects=True)
+        try:
+            request.raise_for_status()
+            with read_requests_stream(request, message) as tarball:
+                self._extract(tarball, self.source_dir)
+        finally:
+            request.close()
+
     def provision(self, dst, clean_target=True, keep_tarball=False):
-        # TODO add unit tests.
         tarball = os.path.join(self.source_dir, os.path.basename(self.source))
 
-        if clean_target:
-            tmp_tarball = tempfile.NamedTemporaryFile().name
-            shutil.move(tarball, tmp_tarball)
-            shutil.rmtree(dst)
-            os.makedirs(dst)
-            shutil.move(tmp_tarball, tarball)
-
-        self._extract(tarball, dst)
+        with open(tarball, 'rb') as f:
+            self._extract(f, dst, clean_target=clean_target, keep=tarball)
 
         if not keep_tarball:
             os.remove(tarball)
 
-    def _extract(self, tarball, dst):
-        with tarfile.open(tarball) as tar:
-            def filter_members(tar):
-                """Filters members and member names:
-                    - strips common prefix
-                    - bans dangerous names"""
-                members = tar.getmembers()
-                common = os.path.commonprefix([m.name for m in members])
+    def _extract(self, tarball, dst, clean_target=True, keep=None):
+        """Extract the tarball file object into dst.
+
+        The directory common to all members is stripped. As it is only
+        known once all of them are read, the members are extracted as they
+        are into a directory next to dst, from which the common directory
+        is moved into dst.
+        """
+        dst = os.path.abspath(dst)
+        tmpdir = tempfile.mkdtemp(prefix='.tar-', dir=os.path.dirname(dst))
+        try:
+            common_dir = self._extract_members(tarball, tmpdir)
+            # Read what follows the end of the archive, so that downloads
+            # are complete.
+            while tarball.read(64 * 1024):
+                pass
+            if clean_target and os.path.isdir(dst):
+                _clean_dir(dst, keep)
+            _merge_dir(os.path.join(tmpdir, common_dir), dst)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def _extract_members(self, tarball, path):
+        """Extract the tarball file object into path, as it is read.
+
+        :returns: the directory common to all members, relative to path.
+        """
+        common = None
+        is_common_dir = True
+        directories = []
+        with tarfile.open(fileobj=tarball, mode='r|*') as tar:
+            for member in tar:
+                # Stream mode remembers every member, only keep what is
+                # needed.
+                tar.members = []
 
                 # commonprefix() works a character at a time and will
                 # consider "d/ab" and "d/abc" to have common prefix "d/ab";
-                # check all members either start with common dir
-                for m in members:
-                    if not (m.name.startswith(common + '/') or
-                            m.isdir() and m.name == common):
-                        # commonprefix() didn't return a dir name; go up one
-                        # level
-                        common = os.path.dirname(common)
-                        break
-
-                for m in members:
-                    if m.name == common:
-                        continue
-                    self._strip_prefix(common, m)
-                    # We mask all files to be writable to be able to easily
-                    # extract on top.
-                    m.mode = m.mode | 0o200
-                    yield m
-
-            tar.extractall(members=filter_members(tar), path=dst)
-
-    def _strip_prefix(self, common, member):
-        if member.name.startswith(common + '/'):
-            member.name = member.name[len(common + '/'):]
+                # keep track of whether all members either are or start
+                # with the common dir.
+                if common is None:
+                    common = member.name
+                    is_common_dir = member.isdir()
+                else:
+                    prefix = os.path.commonprefix([common, member.name])
+                    if len(prefix) < len(common):
+                        is_common_dir = common[len(prefix)] == '/'
+                        common = prefix
+                    is_common_dir = is_common_dir and (
+                        member.name.startswith(common + '/') or
+                        member.isdir() and member.name == common)
+
+                self._strip_leading_dirs(member)
+                # We mask all files to be writable to be able to easily
+                # extract on top.
+                member.mode = member.mode | 0o200
+                if member.isdir():
+                    directories.append(member)
+                tar.extract(member, path, set_attrs=not member.isdir())
+
+            # Like extractall(), set the attributes of directories last.
+            for member in reversed(directories):
+                dirpath = os.path.join(path, member.name)
+                tar.chmod(member, dirpath)
+                tar.utime(member, dirpath)
+
+        if common is None:
+            return ''
+        if not is_common_dir:
+            # commonprefix() didn't return a dir name; go up one level
+            common = os.path.dirname(common)
+        common = re.sub(r'^(\.{0,2}/)*', r'', common)
+        if common in ('.', '..') or common.startswith('../'):
+            return ''
+        return common
+
+    def _strip_leading_dirs(self, member):
         # strip leading '/', './' or '../' as many times as needed
         member.name = re.sub(r'^(\.{0,2}/)*', r'', member.name)
         # do the same for linkname if this is a hardlink
         if member.islnk() and not member.issym():
-            if member.linkname.startswith(common + '/'):
-                member.linkname = member.linkname[len(common + '/'):]
             member.linkname = re.sub(r'^(\.{0,2}/)*', r'', member.linkname)
 
 
+def _clean_dir(path, keep=None):
+    """Remove everything in path but keep."""
+    if keep:
+        keep = os.path.abspath(keep)
+    for entry in os.scandir(os.path.abspath(path)):
+        if entry.path == keep:
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path)
+        else:
+            os.remove(entry.path)
+
+
+def _merge_dir(source, destination):
+    """Move the contents of source into destination, replacing files."""
+    os.makedirs(destination, exist_ok=True)
+    for entry in os.scandir(source):
+        target = os.path.join(destination, entry.name)
+        if (entry.is_dir(follow_symlinks=False) and os.path.isdir(target) and
+                not os.path.islink(target)):
+            _merge_dir(entry.path, target)
+            continue
+        if os.path.isdir(target) and not os.path.islink(target):
+            shutil.rmtree(target)
+        os.replace(entry.path, target)
+
+
 class Zip(FileBase):
 
     def __init__(self, source, source_dir, source_tag=None,
-                 source_branch=None):
-        super().__init__(source, source_dir, source_tag, source_branch)
+                 source_branch=None, source_checksum=None):
+        super().__init__(source, source_dir, source_tag, source_branch,
+                         source_checksum)
         if source_tag:
             raise IncompatibleOptionsError(
                 'can\'t specify a source-tag for a zip source')
@@ -332,11 +547,7 @@ class Zip(FileBase):
         zip = os.path.join(self.source_dir, os.path.basename(self.source))
 
         if clean_target:
-            tmp_zip = tempfile.NamedTemporaryFile().name
-            shutil.move(zip, tmp_zip)
-            shutil.rmtree(dst)
-            os.makedirs(dst)
-            shutil.move(tmp_zip, zip)
+            _clean_dir(dst, keep=zip)
 
         zipfile.ZipFile(zip).extractall(path=dst)
 
@@ -347,26 +558,31 @@ class Zip(FileBase):
 class Local(Base):
 
     def pull(self):
-        if os.path.islink(self.source_dir) or os.path.isfile(self.source_dir):
-            os.remove(self.source_dir)
-        elif os.path.isdir(self.source_dir):
-            shutil.rmtree(self.source_dir)
-
         source_abspath = os.path.abspath(self.source)
+        common.sync_tree(source_abspath, self.source_dir,
+                         copy_function=common.link_or_copy,
+                         ignore=_snapcraft_files_ignore(source_abspath))
 
-        def ignore(directory, files):
-            if directory is source_abspath:
-                snaps = glob.glob(os.path.join(directory, '*.snap'))
-                if snaps:
-                    snaps = [os.path.basename(s) for s in snaps]
-                    return common.SNAPCRAFT_FILES + snaps
-                else:
-                    return common.SNAPCRAFT_FILES
+    def fingerprint(self, digests=None):
+        source_abspath = os.path.abspath(self.source)
+        return fingerprint.hash_tree(
+            source_abspath, ignore=_snapcraft_files_ignore(source_abspath),
+            digests=digests)
+
+
+def _snapcraft_files_ignore(source_abspath):
+    def ignore(directory, files):
+        if directory is source_abspath:
+            snaps = glob.glob(os.path.join(directory, '*.snap'))
+            if snaps:
+                snaps = [os.path.basename(s) for s in snaps]
+                return common.SNAPCRAFT_FILES + snaps
             else:
-                return []
+                return common.SNAPCRAFT_FILES
+        else:
+            return []
 
-        shutil.copytree(source_abspath, self.source_dir,
-                        copy_function=common.link_or_copy, ignore=ignore)
+    return ignore
 
 
 def get(sourcedir, builddir, options):
@@ -376,14 +592,48 @@ def get(sourcedir, builddir, options):
     :param str builddir: The build directory to use.
     :param options: source options.
     """
+    _get_handler(sourcedir, options).pull()
+
+
+def get_fingerprint(sourcedir, options, digests=None):
+    """Return a fingerprint of the source defined in options.
+
+    :param str sourcedir: The source directory the source is pulled into.
+    :param options: source options.
+    :param digests: The fingerprint.DigestCache to use, if any.
+    :returns: A hex digest or None if the source has no fingerprint.
+    """
+    if not getattr(options, 'source', None):
+        return None
+
+    return _get_handler(sourcedir, options).fingerprint(digests)
+
+
+def _get_handler(sourcedir, options):
     source_type = getattr(options, 'source_type', None)
     source_tag = getattr(options, 'source_tag', None)
     source_branch = getattr(options, 'source_branch', None)
+    source_checksum = getattr(options, 'source_checksum', None)
+    source_commit = getattr(options, 'source_commit', None)
 
     handler_class = _get_source_handler(source_type, options.source)
-    handler = handler_class(options.source, sourcedir, source_tag,
-                            source_branch)
-    handler.pull()
+    handler_name = source_type or handler_class.__name__.lower()
+    kwargs = {}
+    if source_checksum:
+        if not issubclass(handler_class, FileBase):
+            raise IncompatibleOptionsError(
+                'can\'t specify a source-checksum for a {} source'.format(
+                    handler_name))
+        kwargs['source_checksum'] = source_checksum
+    if source_commit:
+        if not issubclass(handler_class, Git):
+            raise IncompatibleOptionsError(
+                'can\'t specify a source-commit for a {} source'.format(
+                    handler_name))
+        kwargs['source_commit'] = source_commit
+
+    return handler_class(options.source, sourcedir, source_tag,
+                         source_branch, **kwargs)
 
 
 def get_required_packages(options):
@@ -29,12 +29,15 @@ yaml.add_constructor(u'!PullState', _pull_state_constructor)
 class PullState(State):
     yaml_tag = u'!PullState'
 
-    def __init__(self, schema_properties, options=None, project=None):
+    def __init__(self, schema_properties, options=None, project=None,
+                 fingerprint=None):
         # Save this off before calling super() since we'll need it
         self.schema_properties = schema_properties
 
         super().__init__(options, project)
 
+        self.fingerprint = fingerprint
+
     def properties_of_interest(self, options):
         """Extract the properties concerning this step from the options.
 
@@ -15,6 +15,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import codecs
+import heapq
 import logging
 import os
 import os.path
@@ -116,6 +117,8 @@ class Config:
         self.build_tools = []
         self.all_parts = []
         self._part_names = []
+        self._parts_by_name = {}
+        self._dependents = {}
         self._project_options = project_options
         self.after_requests = {}
 
@@ -181,16 +184,13 @@ class Config:
     def _compute_part_dependencies(self):
         '''Gather the lists of dependencies and adds to all_parts.'''
 
+        # Remote parts loaded here are appended to all_parts, so their own
+        # dependencies are gathered as well.
         for part in self.all_parts:
             dep_names = self.after_requests.get(part.name, [])
             for dep in dep_names:
-                found = False
-                for i in range(len(self.all_parts)):
-                    if dep == self.all_parts[i].name:
-                        part.deps.append(self.all_parts[i])
-                        found = True
-                        break
-                if not found:
+                dep_part = self._parts_by_name.get(dep)
+                if not dep_part:
                     try:
                         remote_part = self._remote_parts.get_part(dep)
                     except KeyError as e:
@@ -200,53 +200,73 @@ class Config:
                             'to refresh the remote parts '
                             'cache'.format(dep)) from e
                     plugin_name = remote_part.pop('plugin')
-                    part.deps.append(self.load_plugin(
-                        dep, plugin_name, remote_part))
+                    dep_part = self.load_plugin(dep, plugin_name, remote_part)
                     self._part_names.append(dep)
+                part.deps.append(dep_part)
+                self._dependents.setdefault(dep, set()).add(part.name)
 
     def _sort_parts(self):
-        '''Performs an inneficient but easy to follow sorting of parts.'''
+        '''Sort the parts so that each comes after its dependencies.
+
+        Among the parts that can go next, the order in which they were
+        defined is kept.
+        '''
+        index = {part.name: i for i, part in enumerate(self.all_parts)}
+        pending_dependents = {
+            part.name: len(self._dependents.get(part.name, ()))
+            for part in self.all_parts}
+
+        # Parts are taken from the end: the ones nothing else depends upon
+        # come first, and their dependencies become available once all of
+        # their dependents were taken.
+        available = [i for i, part in enumerate(self.all_parts)
+                     if not pending_dependents[part.name]]
+        heapq.heapify(available)
         sorted_parts = []
-
-        while self.all_parts:
-            top_part = None
-            for part in self.all_parts:
-                mentioned = False
-                for other in self.all_parts:
-                    if part in other.deps:
-                        mentioned = True
-                        break
-                if not mentioned:
-                    top_part = part
-                    break
-            if not top_part:
-                raise SnapcraftLogicError(
-                    'circular dependency chain found in parts definition')
-            sorted_parts = [top_part] + sorted_parts
-            self.all_parts.remove(top_part)
-
+        while available:
+            part = self.all_parts[heapq.heappop(available)]
+            sorted_parts.append(part)
+            for dep in {d.name for d in part.deps}:
+                pending_dependents[dep] -= 1
+                if not pending_dependents[dep]:
+                    heapq.heappush(available, index[dep])
+
+        if len(sorted_parts) != len(self.all_parts):
+            raise SnapcraftLogicError(
+                'circular dependency chain found in parts definition: '
+                '{}'.format(' -> '.join(self._find_cycle(pending_dependents))))
+
+        sorted_parts.reverse()
         return sorted_parts
 
+    def _find_cycle(self, pending_dependents):
+        # Every part left out of the sort still has dependents that were left
+        # out as well, so following them must eventually loop.
+        index = {part.name: i for i, part in enumerate(self.all_parts)}
+        name = next(part.name for part in self.all_parts
+                    if pending_dependents[part.name])
+        path = []
+        while name not in path:
+            path.append(name)
+            name = min((d for d in self._dependents[name]
+                        if pending_dependents[d]), key=index.get)
+
+        # Report the chain the way it is written: each part is after the
+        # next one.
+        chain = path[path.index(name):] + [name]
+        chain.reverse()
+        return chain
+
     def part_prereqs(self, part_name):
         """Returns a set with all of part_names' prerequisites."""
         return set(self.after_requests.get(part_name, []))
 
     def part_dependents(self, part_name):
         """Returns a set of all the parts that depend upon part_name."""
-
-        dependents = set()
-        for part, prerequisites in self.after_requests.items():
-            if part_name in prerequisites:
-                dependents.add(part)
-
-        return dependents
+        return set(self._dependents.get(part_name, ()))
 
     def get_part(self, part_name):
-        for part in self.all_parts:
-            if part.name == part_name:
-                return part
-
-        return None
+        return self._parts_by_name.get(part_name)
 
     def get_project_state(self, step):
         """Returns a dict of states for the given step of each part."""
@@ -272,6 +292,7 @@ class Config:
         self.build_tools += part.code.build_packages
         self.build_tools += sources.get_required_packages(part.code.options)
         self.all_parts.append(part)
+        self._parts_by_name[part_name] = part
         return part
 
     def build_env_for_part(self, part, root_part=True):
@@ -279,26 +300,31 @@ class Config:
 
         env = []
         stagedir = self._project_options.stage_dir
+        arch_triplet = self._project_options.arch_triplet
 
         if root_part:
             # this has to come before any {}/usr/bin
             env += part.env(part.installdir)
-            env += _runtime_env(part.installdir,
-                                self._project_options.arch_triplet)
-            env += _runtime_env(stagedir,
-                                self._project_options.arch_triplet)
-            env += _build_env(part.installdir,
-                              self._project_options.arch_triplet)
-            env += _build_env_for_stage(stagedir,
-                                        self._project_options.arch_triplet)
+            env += _runtime_env(part.installdir, arch_triplet)
+            env += _stage_env(_runtime_env, stagedir, arch_triplet)
+            env += _build_env(part.installdir, arch_triplet)
+            env += _stage_env(_build_env_for_stage, stagedir, arch_triplet)
         else:
             env += part.env(stagedir)
-            env += _runtime_env(stagedir,
-                                self._project_options.arch_triplet)
-
-        for dep_part in part.deps:
+            env += _stage_env(_runtime_env, stagedir, arch_triplet)
+
+        # Walk the dependencies depth first, visiting each of them once even
+        # if several parts depend upon it.
+        visited = {part.name}
+        unvisited = list(reversed(part.deps))
+        while unvisited:
+            dep_part = unvisited.pop()
+            if dep_part.name in visited:
+                continue
+            visited.add(dep_part.name)
             env += dep_part.env(stagedir)
-            env += self.build_env_for_part(dep_part, root_part=False)
+            env += _stage_env(_runtime_env, stagedir, arch_triplet)
+            unvisited.extend(reversed(dep_part.deps))
 
         return env
 
@@ -337,6 +363,31 @@ class Config:
         return env
 
 
+_stage_env_cache = {}
+
+
+def _stage_env(env_func, stagedir, arch_triplet):
+    """Return env_func(stagedir, arch_triplet), computed once per stage.
+
+    Staging a part touches the stage directory, so its mtime tells whether
+    the cached environment is still valid. This also holds for processes
+    forked before the part was staged.
+    """
+    try:
+        stat = os.stat(stagedir)
+        signature = (stat.st_ino, stat.st_mtime_ns)
+    except FileNotFoundError:
+        signature = None
+
+    key = (env_func.__name__, stagedir, arch_triplet)
+    cached = _stage_env_cache.get(key)
+    if not cached or cached[0] != signature or not signature:
+        cached = (signature, env_func(stagedir, arch_triplet))
+        _stage_env_cache[key] = cached
+
+    return list(cached[1])
+
+
 def _runtime_env(root, arch_triplet):
     """Set the environment variables required for running binaries."""
     env = []
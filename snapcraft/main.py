@@ -52,6 +52,10 @@ Options:
   --target-arch ARCH                    EXPERIMENTAL: sets the target
                                         architecture. Very few plugins support
                                         this.
+  -j <jobs>, --jobs <jobs>              EXPERIMENTAL: number of parts to pull
+                                        and build concurrently. Parts are still
+                                        staged and primed one at a time
+                                        [default: 1].
 
 Options specific to pulling:
   --enable-geoip         enables geoip for the pull step if stage-packages
@@ -188,6 +192,12 @@ def _get_project_options(args):
     options['use_geoip'] = args['--enable-geoip']
     options['parallel_builds'] = not args['--no-parallel-build']
     options['target_deb_arch'] = args['--target-arch']
+    try:
+        options['jobs'] = int(args['--jobs'])
+    except ValueError:
+        raise EnvironmentError(
+            'The number of jobs must be an integer, not {!r}'.format(
+                args['--jobs']))
 
     return snapcraft.ProjectOptions(**options)
 
@@ -201,12 +211,12 @@ def main(argv=None):
         log_level = logging.DEBUG
 
     log.configure(log_level=log_level)
-    project_options = _get_project_options(args)
 
     if args['strip']:
         logger.warning("DEPRECATED: use 'prime' instead of 'strip'")
         args['prime'] = True
     try:
+        project_options = _get_project_options(args)
         return run(args, project_options)
     except Exception as e:
         if args['--debug']:
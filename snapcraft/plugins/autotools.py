@@ -85,13 +85,29 @@ class AutotoolsPlugin(snapcraft.BasePlugin):
             self.install_via_destdir = True
         elif options.install_via == 'prefix':
             self.install_via_destdir = False
+            self.embeds_installdir = True
         else:
             raise RuntimeError('Unsupported installation method: "{}"'.format(
                 options.install_via))
 
+    @property
+    def out_of_tree_build(self):
+        # Generating configure writes into the source tree, which for local
+        # sources is hard-linked to the project itself.
+        return os.path.exists(os.path.join(self._get_sourcedir(), 'configure'))
+
+    def _get_sourcedir(self):
+        source_subdir = getattr(self.options, 'source_subdir', None)
+        if source_subdir:
+            return os.path.join(self.sourcedir, source_subdir)
+        return self.sourcedir
+
     def build(self):
         super().build()
-        if not os.path.exists(os.path.join(self.builddir, "configure")):
+        configure = './configure'
+        if self.out_of_tree_build:
+            configure = os.path.join(self._get_sourcedir(), 'configure')
+        elif not os.path.exists(os.path.join(self.builddir, "configure")):
             generated = False
             scripts = ["autogen.sh", "bootstrap"]
             for script in scripts:
@@ -110,7 +126,7 @@ class AutotoolsPlugin(snapcraft.BasePlugin):
             if not generated:
                 self.run(['autoreconf', '-i'])
 
-        configure_command = ['./configure']
+        configure_command = [configure]
         make_install_command = ['make', 'install']
 
         if self.install_via_destdir:
@@ -51,6 +51,8 @@ logger = logging.getLogger(__name__)
 
 class CatkinPlugin(snapcraft.BasePlugin):
 
+    embeds_installdir = True
+
     _PLUGIN_STAGE_SOURCES = '''
 deb http://packages.ros.org/ros/ubuntu/ trusty main
 deb http://${prefix}.ubuntu.com/${suffix}/ trusty main universe
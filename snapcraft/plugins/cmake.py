@@ -31,13 +31,14 @@ Additionally, this plugin uses the following plugin-specific keywords:
 """
 
 import os
-import shutil
 
 import snapcraft.plugins.make
 
 
 class CMakePlugin(snapcraft.plugins.make.MakePlugin):
 
+    out_of_tree_build = True
+
     @classmethod
     def schema(cls):
         schema = super().schema()
@@ -62,9 +63,9 @@ class CMakePlugin(snapcraft.plugins.make.MakePlugin):
         self.build_packages.append('cmake')
 
     def build(self):
-        if os.path.exists(self.builddir):
-            shutil.rmtree(self.builddir)
-        os.mkdir(self.builddir)
+        # The build directory of a previous build is reused, for make to only
+        # rebuild what changed.
+        os.makedirs(self.builddir, exist_ok=True)
 
         source_subdir = getattr(self.options, 'source_subdir', None)
         if source_subdir:
@@ -53,6 +53,8 @@ logger = logging.getLogger(__name__)
 
 class Python2Plugin(snapcraft.BasePlugin):
 
+    embeds_installdir = True
+
     @classmethod
     def schema(cls):
         schema = super().schema()
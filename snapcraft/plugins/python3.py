@@ -46,6 +46,8 @@ from snapcraft import common
 
 class Python3Plugin(snapcraft.BasePlugin):
 
+    embeds_installdir = True
+
     @classmethod
     def schema(cls):
         schema = super().schema()
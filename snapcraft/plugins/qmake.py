@@ -43,6 +43,8 @@ from snapcraft import common
 
 class QmakePlugin(snapcraft.BasePlugin):
 
+    out_of_tree_build = True
+
     @classmethod
     def schema(cls):
         schema = super().schema()
@@ -95,12 +97,13 @@ class QmakePlugin(snapcraft.BasePlugin):
 
         env = self._build_environment()
 
-        sources = []
+        sourcedir = self.sourcedir
+        source_subdir = getattr(self.options, 'source_subdir', None)
+        if source_subdir:
+            sourcedir = os.path.join(sourcedir, source_subdir)
+        # qmake finds the project file in the source directory otherwise.
+        sources = [sourcedir]
         if self.options.project_files:
-            sourcedir = self.sourcedir
-            source_subdir = getattr(self.options, 'source_subdir', None)
-            if source_subdir:
-                sourcedir = os.path.join(sourcedir, source_subdir)
             sources = [os.path.join(sourcedir, project_file)
                        for project_file in self.options.project_files]
 
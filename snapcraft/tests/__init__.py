@@ -16,6 +16,7 @@
 
 import logging
 import os
+import struct
 from unittest import mock
 
 import fixtures
@@ -29,11 +30,14 @@ from snapcraft.tests import fixture_setup
 class MockOptions:
 
     def __init__(self, source=None, source_type=None, source_branch=None,
-                 source_tag=None, source_subdir=None, disable_parallel=False):
+                 source_tag=None, source_subdir=None, disable_parallel=False,
+                 source_checksum=None, source_commit=None):
         self.source = source
         self.source_type = source_type
         self.source_branch = source_branch
         self.source_tag = source_tag
+        self.source_checksum = source_checksum
+        self.source_commit = source_commit
         self.source_subdir = source_subdir
         self.disable_parallel = disable_parallel
 
@@ -79,6 +83,52 @@ class TestCase(testscenarios.WithScenarios, fixtures.TestWithFixtures):
         with open('snapcraft.yaml', 'w', encoding=encoding) as fp:
             fp.write(content)
 
+    def make_elf(self, path, needed=(), rpath=None, runpath=None,
+                 machine=62, dynamic=True):
+        """Write a minimal 64 bit little endian ELF file to path.
+
+        The file only has the program headers and dynamic section needed to
+        find its library dependencies. The default machine is x86-64.
+        """
+        strings = b'\0'
+        dynamic_entries = []
+
+        def add_entry(tag, string):
+            nonlocal strings
+            dynamic_entries.append((tag, len(strings)))
+            strings += string.encode() + b'\0'
+
+        for name in needed:
+            add_entry(1, name)
+        if rpath:
+            add_entry(15, rpath)
+        if runpath:
+            add_entry(29, runpath)
+
+        phnum = 2 if dynamic else 1
+        strtab_offset = 64 + 56 * phnum
+        dynamic_entries += [(5, strtab_offset), (10, len(strings)), (0, 0)]
+        dynamic_data = b''.join(
+            struct.pack('<qQ', *e) for e in dynamic_entries)
+        dynamic_offset = strtab_offset + len(strings)
+        size = dynamic_offset + len(dynamic_data)
+
+        data = b'\x7fELF' + bytes([2, 1, 1]) + bytes(9)
+        data += struct.pack('<HHIQQQIHHHHHH', 3, machine, 1, 0, 64, 0, 0, 64,
+                            56, phnum, 64, 0, 0)
+        data += struct.pack('<IIQQQQQQ', 1, 5, 0, 0, 0, size, size, 0x1000)
+        if dynamic:
+            data += struct.pack('<IIQQQQQQ', 2, 6, dynamic_offset,
+                                dynamic_offset, dynamic_offset,
+                                len(dynamic_data), len(dynamic_data), 8)
+        data += strings
+        if dynamic:
+            data += dynamic_data
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
     def verify_state(self, part_name, state_dir, expected_step):
         self.assertTrue(os.path.isdir(state_dir),
                         'Expected state directory for {}'.format(part_name))
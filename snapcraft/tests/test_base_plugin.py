@@ -99,6 +99,18 @@ class TestBasePlugin(tests.TestCase):
         self.assertTrue(
             os.path.exists(os.path.join(plugin.build_basedir, 'file')))
 
+    def test_out_of_tree_build_does_not_copy_sourcedir(self):
+        plugin = snapcraft.BasePlugin('test-part', options=None)
+        plugin.out_of_tree_build = True
+        os.makedirs(plugin.sourcedir)
+        open(os.path.join(plugin.sourcedir, 'file'), 'w').close()
+        os.makedirs(plugin.builddir)
+        open(os.path.join(plugin.builddir, 'built'), 'w').close()
+
+        plugin.build()
+
+        self.assertEqual(['built'], os.listdir(plugin.builddir))
+
     def test_part_name_with_forward_slash_is_one_directory(self):
         plugin = snapcraft.BasePlugin('test/part', options=None)
 
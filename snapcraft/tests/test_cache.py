@@ -0,0 +1,316 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright (C) 2016 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import fcntl
+import hashlib
+import http.server
+import os
+import subprocess
+import threading
+from unittest import mock
+
+import fixtures
+
+from snapcraft.internal import cache
+from snapcraft import tests
+
+
+class GetBuildCacheTestCase(tests.TestCase):
+
+    def test_disabled_by_default(self):
+        self.useFixture(fixtures.EnvironmentVariable(
+            'SNAPCRAFT_BUILD_CACHE_SIZE', None))
+
+        self.assertIsNone(cache.get_build_cache())
+
+    def test_size_is_in_megabytes(self):
+        self.useFixture(fixtures.EnvironmentVariable(
+            'SNAPCRAFT_BUILD_CACHE_SIZE', '2'))
+
+        self.assertEqual(2 * 1024 * 1024, cache.get_build_cache().max_size)
+
+    def test_invalid_size_raises(self):
+        self.useFixture(fixtures.EnvironmentVariable(
+            'SNAPCRAFT_BUILD_CACHE_SIZE', 'lots'))
+
+        with self.assertRaises(EnvironmentError) as raised:
+            cache.get_build_cache()
+
+        self.assertEqual(
+            "SNAPCRAFT_BUILD_CACHE_SIZE must be a size in megabytes, "
+            "not 'lots'", str(raised.exception))
+
+
+class BuildCacheTestCase(tests.TestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        self.cache = cache.BuildCache(1024 * 1024, cache_dir='cache')
+        os.makedirs(os.path.join('install', 'bin'))
+        with open(os.path.join('install', 'bin', 'file'), 'w') as f:
+            f.write('content')
+        os.symlink('file', os.path.join('install', 'bin', 'link'))
+
+    def test_restore_miss(self):
+        self.assertFalse(self.cache.restore('key', 'restored'))
+        self.assertFalse(os.path.exists('restored'))
+
+    def test_store_and_restore(self):
+        self.cache.store('key', 'install')
+
+        os.makedirs(os.path.join('restored', 'stale'))
+        self.assertTrue(self.cache.restore('key', 'restored'))
+
+        self.assertFalse(os.path.exists(os.path.join('restored', 'stale')))
+        with open(os.path.join('restored', 'bin', 'file')) as f:
+            self.assertEqual('content', f.read())
+        self.assertEqual(
+            'file', os.readlink(os.path.join('restored', 'bin', 'link')))
+
+    def test_store_copies_files(self):
+        self.cache.store('key', 'install')
+
+        with open(os.path.join('install', 'bin', 'file'), 'w') as f:
+            f.write('modified')
+        self.cache.restore('key', 'restored')
+
+        with open(os.path.join('restored', 'bin', 'file')) as f:
+            self.assertEqual('content', f.read())
+
+    def test_least_recently_used_entries_are_evicted(self):
+        self.cache.store('old', 'install')
+        with open(os.path.join('cache', 'old', 'size')) as f:
+            self.cache.max_size = 2 * int(f.read())
+        self.cache.store('used', 'install')
+        os.utime(os.path.join('cache', 'old'), (0, 0))
+        os.utime(os.path.join('cache', 'used'), (1, 1))
+
+        self.cache.restore('used', 'restored')
+        self.cache.store('new', 'install')
+
+        self.assertEqual(['new', 'used'], sorted(os.listdir('cache')))
+
+
+class EvictExtractedDebsTestCase(tests.TestCase):
+
+    def make_entry(self, name, size, mtime):
+        entry = os.path.join('cache', name)
+        os.makedirs(entry)
+        with open(os.path.join(entry, 'size'), 'w') as f:
+            f.write(str(size))
+        os.utime(entry, (mtime, mtime))
+        return entry
+
+    def test_least_recently_used_entries_are_evicted(self):
+        self.useFixture(fixtures.EnvironmentVariable(
+            'SNAPCRAFT_EXTRACTED_DEBS_CACHE_SIZE', '2'))
+        self.make_entry('old', 1024 * 1024, 0)
+        self.make_entry('used', 1024 * 1024, 1)
+        in_use = self.make_entry('in-use', 1024 * 1024, 0)
+
+        cache.evict_extracted_debs('cache', [in_use])
+
+        self.assertEqual(['in-use', 'used'], sorted(os.listdir('cache')))
+
+    def test_entries_in_use_are_kept(self):
+        self.useFixture(fixtures.EnvironmentVariable(
+            'SNAPCRAFT_EXTRACTED_DEBS_CACHE_SIZE', '0'))
+        in_use = self.make_entry('in-use', 1024 * 1024, 0)
+        self.make_entry('unused', 1, 1)
+
+        cache.evict_extracted_debs('cache', [in_use])
+
+        self.assertEqual(['in-use'], os.listdir('cache'))
+
+
+class GetDownloadCacheTestCase(tests.TestCase):
+
+    def test_enabled_by_default(self):
+        self.useFixture(fixtures.EnvironmentVariable(
+            'SNAPCRAFT_DOWNLOAD_CACHE_SIZE', None))
+
+        self.assertEqual(
+            2048 * 1024 * 1024, cache.get_download_cache().max_size)
+
+    def test_size_zero_disables_the_cache(self):
+        self.useFixture(fixtures.EnvironmentVariable(
+            'SNAPCRAFT_DOWNLOAD_CACHE_SIZE', '0'))
+
+        self.assertIsNone(cache.get_download_cache())
+
+
+class _ETagHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    content = b'content'
+    statuses = []
+
+    def do_GET(self):
+        etag = '"{}"'.format(hashlib.md5(self.content).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.statuses.append(304)
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.statuses.append(200)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.content)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(self.content)
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadCacheTestCase(tests.TestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        self.useFixture(fixtures.EnvironmentVariable(
+            'no_proxy', 'localhost,127.0.0.1'))
+        self.handler = type('Handler', (_ETagHTTPRequestHandler,), {
+            'statuses': []})
+        server = http.server.HTTPServer(('127.0.0.1', 0), self.handler)
+        server_thread = threading.Thread(target=server.serve_forever)
+        self.addCleanup(server_thread.join)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        server_thread.start()
+        self.url = 'http://{}:{}/file'.format(*server.server_address)
+
+        self.cache = cache.DownloadCache(1024 * 1024, cache_dir='cache')
+        self.sha256 = hashlib.sha256(b'content').hexdigest()
+
+    def test_fetch_links_the_cached_file(self):
+        self.cache.fetch(self.url, 'file')
+
+        with open('file', 'rb') as f:
+            self.assertEqual(b'content', f.read())
+        self.assertTrue(os.path.samefile(
+            'file', os.path.join('cache', 'files', self.sha256)))
+
+    def test_unmodified_file_is_revalidated(self):
+        self.cache.fetch(self.url, 'file')
+        os.remove('file')
+
+        self.cache.fetch(self.url, 'file')
+
+        self.assertEqual([200, 304], self.handler.statuses)
+        with open('file', 'rb') as f:
+            self.assertEqual(b'content', f.read())
+
+    def test_modified_file_is_downloaded_again(self):
+        self.cache.fetch(self.url, 'file')
+        self.handler.content = b'modified'
+
+        self.cache.fetch(self.url, 'file')
+
+        self.assertEqual([200, 200], self.handler.statuses)
+        with open('file', 'rb') as f:
+            self.assertEqual(b'modified', f.read())
+
+    def test_sha256_checksum_hits_without_downloading(self):
+        self.cache.fetch(self.url, 'file')
+
+        self.cache.fetch('http://localhost:1/unreachable', 'other',
+                         checksum='sha256/' + self.sha256)
+
+        self.assertEqual([200], self.handler.statuses)
+        with open('other', 'rb') as f:
+            self.assertEqual(b'content', f.read())
+
+    def test_checksum_mismatch_raises_and_is_not_cached(self):
+        with self.assertRaises(EnvironmentError) as raised:
+            self.cache.fetch(self.url, 'file', checksum='md5/1234')
+
+        self.assertIn('md5 checksum of the download does not match 1234',
+                      str(raised.exception))
+        self.assertFalse(os.path.exists('file'))
+        self.assertEqual([], os.listdir(os.path.join('cache', 'files')))
+
+    def test_invalid_checksum_raises(self):
+        with self.assertRaises(EnvironmentError) as raised:
+            self.cache.fetch(self.url, 'file', checksum='1234')
+
+        self.assertIn("Invalid checksum '1234'", str(raised.exception))
+
+    def test_least_recently_used_files_are_evicted(self):
+        self.cache.max_size = len(b'content')
+        self.cache.fetch(self.url, 'file')
+        os.utime(os.path.join('cache', 'files', self.sha256), (0, 0))
+        self.handler.content = b'new'
+
+        self.cache.fetch(self.url + '?new', 'new')
+
+        self.assertEqual([hashlib.sha256(b'new').hexdigest()],
+                         os.listdir(os.path.join('cache', 'files')))
+
+
+class GetGitCacheTestCase(tests.TestCase):
+
+    def test_disabled_by_default(self):
+        self.useFixture(fixtures.EnvironmentVariable(
+            'SNAPCRAFT_GIT_CACHE_SIZE', None))
+
+        self.assertIsNone(cache.get_git_cache())
+
+    def test_size_is_in_megabytes(self):
+        self.useFixture(fixtures.EnvironmentVariable(
+            'SNAPCRAFT_GIT_CACHE_SIZE', '2'))
+
+        self.assertEqual(2 * 1024 * 1024, cache.get_git_cache().max_size)
+
+
+class GitCacheTestCase(tests.TestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        self.cache = cache.GitCache(1024 * 1024, cache_dir='cache')
+        subprocess.check_call(['git', 'init', '--quiet', 'remote'])
+        self.url = 'file://' + os.path.abspath('remote')
+        self.lock_file = os.path.join('cache', '.{}.lock'.format(
+            hashlib.sha256(self.url.encode()).hexdigest()))
+
+    def assert_locked(self, *args, **kwargs):
+        with open(self.lock_file) as f:
+            with self.assertRaises(BlockingIOError):
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def test_mirror_is_locked_while_cloned(self):
+        with mock.patch('subprocess.check_call',
+                        side_effect=self.assert_locked) as mock_check_call:
+            self.cache.mirror(self.url)
+
+        self.assertEqual(2, mock_check_call.call_count)
+
+    def test_mirror_serves_any_commit(self):
+        mirror = self.cache.mirror(self.url)
+
+        self.assertEqual(b'true\n', subprocess.check_output(
+            ['git', '-C', mirror, 'config', 'uploadpack.allowAnySHA1InWant']))
+
+    def test_mirror_is_locked_while_fetched(self):
+        mirror = self.cache.mirror(self.url)
+
+        with mock.patch('subprocess.check_call',
+                        side_effect=self.assert_locked) as mock_check_call:
+            self.assertEqual(mirror, self.cache.mirror(self.url))
+
+        mock_check_call.assert_called_once_with(
+            ['git', '-C', mirror, 'fetch', '--prune', 'origin'])
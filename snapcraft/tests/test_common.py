@@ -14,12 +14,20 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import errno
 import os
 import re
+import shutil
+import stat
+import subprocess
+from unittest import mock
 
 from snapcraft.internal import common
 from snapcraft import tests
 
+# The FICLONE ioctl on Linux, which fcntl only defines from Python 3.12.
+_FICLONE = 0x40049409
+
 
 class CommonTestCase(tests.TestCase):
 
@@ -84,6 +92,75 @@ class CommonTestCase(tests.TestCase):
                     self.assertEqual(f.read(), file_info['expected'])
 
 
+class RunTestCase(tests.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(setattr, common, 'env', common.env)
+        common.env = ['FOO="foo $HOME"']
+        os.mkdir('dir')
+
+    def test_run(self):
+        common.run(['/bin/sh', '-c', 'echo "$FOO" > output'], cwd='dir')
+
+        with open(os.path.join('dir', 'output')) as f:
+            self.assertEqual('foo {}\n'.format(os.environ['HOME']), f.read())
+
+    def test_env_script_is_written_once(self):
+        common.run(['true'])
+        scripts = os.listdir(
+            os.path.join(self.path, '.cache', 'snapcraft', 'env'))
+
+        with mock.patch('tempfile.NamedTemporaryFile') as mock_tmp:
+            common.run(['true'])
+        common.env = ['FOO=bar']
+        common.run(['true'])
+
+        self.assertFalse(mock_tmp.called)
+        self.assertEqual(1, len(scripts))
+        self.assertEqual(2, len(os.listdir(
+            os.path.join(self.path, '.cache', 'snapcraft', 'env'))))
+
+    def test_least_recently_used_env_scripts_are_evicted(self):
+        patcher = mock.patch.object(common, '_MAX_ENV_SCRIPTS', 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        env_dir = os.path.join(self.path, '.cache', 'snapcraft', 'env')
+        for value in ('first', 'second'):
+            common.env = ['FOO={}'.format(value)]
+            common.run(['true'])
+        for script in os.listdir(env_dir):
+            os.utime(os.path.join(env_dir, script), (0, 0))
+
+        common.env = ['FOO=first']
+        common.run(['true'])
+        common.env = ['FOO=third']
+        common.run(['true'])
+
+        self.assertEqual(2, len(os.listdir(env_dir)))
+        common.env = ['FOO=first']
+        with mock.patch('tempfile.NamedTemporaryFile') as mock_tmp:
+            common.run(['true'])
+        self.assertFalse(mock_tmp.called)
+
+    def test_run_output(self):
+        output = common.run_output(['/bin/sh', '-c', 'echo "$FOO $PWD"'],
+                                   cwd='dir')
+
+        self.assertEqual('foo {} {}'.format(
+            os.environ['HOME'], os.path.abspath('dir')), output)
+
+    def test_run_output_computes_the_environment_once(self):
+        common.run_output(['true'])
+
+        with mock.patch('subprocess.check_output',
+                        wraps=subprocess.check_output) as mock_check_output:
+            output = common.run_output(['/bin/sh', '-c', 'echo "$FOO"'])
+
+        self.assertEqual('foo {}'.format(os.environ['HOME']), output)
+        self.assertEqual(1, mock_check_output.call_count)
+
+
 class CommonMigratedTestCase(tests.TestCase):
 
     def test_parallel_build_count_migration_message(self):
@@ -154,3 +231,169 @@ class FormatInColumnsTestCase(tests.TestCase):
                           common.format_output_in_columns(self.elements_list,
                                                           max_width=60,
                                                           num_col_spaces=1))
+
+
+class LinkOrCopyTestCase(tests.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        with open('source', 'w') as f:
+            f.write('content')
+        os.chmod('source', 0o750)
+        common._unsupported_copy_methods.clear()
+        self.addCleanup(common._unsupported_copy_methods.clear)
+
+    def assert_copied(self, destination):
+        self.assertFalse(os.path.samefile('source', destination))
+        with open(destination) as f:
+            self.assertEqual('content', f.read())
+        self.assertEqual(0o750, stat.S_IMODE(os.stat(destination).st_mode))
+
+    def test_link_or_copy_links(self):
+        common.link_or_copy('source', 'destination')
+
+        self.assertTrue(os.path.samefile('source', 'destination'))
+
+    @mock.patch('os.link')
+    def test_link_or_copy_copies_when_link_fails(self, mock_link):
+        mock_link.side_effect = OSError(errno.EXDEV, 'cross-device link')
+
+        common.link_or_copy('source', 'destination')
+
+        self.assert_copied('destination')
+
+    def test_link_or_copy_copies_symlinks(self):
+        os.symlink('source', 'symlink')
+
+        with mock.patch('os.link', side_effect=OSError(errno.EPERM, 'no')):
+            common.link_or_copy('symlink', 'destination')
+
+        self.assertEqual('source', os.readlink('destination'))
+
+    def test_link_or_copy_onto_a_hard_link_raises(self):
+        os.link('source', 'destination')
+
+        with self.assertRaises(shutil.SameFileError):
+            common.link_or_copy('source', 'destination')
+
+        with open('source') as f:
+            self.assertEqual('content', f.read())
+
+    def test_copy_onto_a_symlink_to_source_raises(self):
+        os.symlink('source', 'destination')
+
+        with self.assertRaises(shutil.SameFileError):
+            common.copy('source', 'destination', follow_symlinks=True)
+
+        with open('source') as f:
+            self.assertEqual('content', f.read())
+
+    def test_copy_without_ficlone_skips_reflinks(self):
+        mock_fcntl = mock.Mock(spec=['ioctl'])
+        with mock.patch.object(common, 'fcntl', mock_fcntl):
+            common.copy('source', 'destination')
+
+        mock_fcntl.ioctl.assert_not_called()
+        self.assert_copied('destination')
+
+    @mock.patch('fcntl.FICLONE', _FICLONE, create=True)
+    @mock.patch('fcntl.ioctl')
+    def test_copy_remembers_unsupported_methods(self, mock_ioctl):
+        mock_ioctl.side_effect = OSError(errno.EOPNOTSUPP, 'no reflinks')
+
+        common.copy('source', 'destination1')
+        common.copy('source', 'destination2')
+
+        self.assertEqual(1, mock_ioctl.call_count)
+        self.assert_copied('destination1')
+        self.assert_copied('destination2')
+
+    @mock.patch('os.sendfile')
+    @mock.patch('fcntl.FICLONE', _FICLONE, create=True)
+    @mock.patch('fcntl.ioctl')
+    def test_copy_falls_back_to_a_buffered_copy(self, mock_ioctl,
+                                                mock_sendfile):
+        mock_ioctl.side_effect = OSError(errno.EXDEV, 'cross-device')
+        mock_sendfile.side_effect = OSError(errno.EINVAL, 'invalid')
+
+        with mock.patch('os.copy_file_range', create=True,
+                        side_effect=OSError(errno.ENOSYS, 'no syscall')):
+            common.copy('source', 'destination')
+
+        self.assert_copied('destination')
+
+    @mock.patch('fcntl.FICLONE', _FICLONE, create=True)
+    @mock.patch('fcntl.ioctl')
+    def test_copy_raises_other_errors(self, mock_ioctl):
+        mock_ioctl.side_effect = OSError(errno.ENOSPC, 'no space left')
+
+        with self.assertRaises(OSError) as raised:
+            common.copy('source', 'destination')
+
+        self.assertEqual(errno.ENOSPC, raised.exception.errno)
+
+    def test_copy_into_directory(self):
+        os.mkdir('directory')
+
+        common.copy('source', 'directory')
+
+        self.assert_copied(os.path.join('directory', 'source'))
+
+
+class SyncTreeTestCase(tests.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        os.makedirs(os.path.join('source', 'dir'))
+        for name, content in (('a', 'a'), (os.path.join('dir', 'b'), 'b')):
+            with open(os.path.join('source', name), 'w') as f:
+                f.write(content)
+        os.symlink('a', os.path.join('source', 'link'))
+
+    def test_sync_new_tree(self):
+        common.sync_tree('source', 'destination', symlinks=True)
+
+        with open(os.path.join('destination', 'dir', 'b')) as f:
+            self.assertEqual('b', f.read())
+        self.assertEqual('a', os.readlink(os.path.join('destination',
+                                                       'link')))
+
+    def test_sync_only_copies_changes(self):
+        common.sync_tree('source', 'destination', symlinks=True)
+        with open(os.path.join('source', 'a'), 'w') as f:
+            f.write('changed')
+        os.remove(os.path.join('source', 'dir', 'b'))
+        os.symlink('dir', os.path.join('source', 'dir', 'c'))
+        open(os.path.join('destination', 'stale'), 'w').close()
+
+        copy_function = mock.Mock(wraps=shutil.copy2)
+        common.sync_tree('source', 'destination', symlinks=True,
+                         copy_function=copy_function)
+
+        copy_function.assert_called_once_with(
+            os.path.join('source', 'a'), os.path.join('destination', 'a'))
+        with open(os.path.join('destination', 'a')) as f:
+            self.assertEqual('changed', f.read())
+        self.assertEqual(['c'], os.listdir(os.path.join('destination',
+                                                        'dir')))
+        self.assertCountEqual(['a', 'dir', 'link'],
+                              os.listdir('destination'))
+
+    def test_sync_replaces_entries_of_another_type(self):
+        common.sync_tree('source', 'destination', symlinks=True)
+        os.remove(os.path.join('source', 'link'))
+        os.mkdir(os.path.join('source', 'link'))
+        shutil.rmtree(os.path.join('source', 'dir'))
+        open(os.path.join('source', 'dir'), 'w').close()
+
+        common.sync_tree('source', 'destination', symlinks=True)
+
+        self.assertTrue(os.path.isfile(os.path.join('destination', 'dir')))
+        self.assertFalse(os.path.islink(os.path.join('destination', 'link')))
+        self.assertTrue(os.path.isdir(os.path.join('destination', 'link')))
+
+    def test_sync_ignores(self):
+        common.sync_tree('source', 'destination',
+                         ignore=lambda directory, names: ['dir'])
+
+        self.assertCountEqual(['a', 'link'], os.listdir('destination'))
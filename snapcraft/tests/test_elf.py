@@ -0,0 +1,135 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright (C) 2016 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+from snapcraft.internal import elf
+from snapcraft import tests
+
+
+class ElfFileTestCase(tests.TestCase):
+
+    def test_dynamic_section(self):
+        self.make_elf('binary', needed=['libfoo.so.1', 'libbar.so.2'],
+                      rpath='/rpath:$ORIGIN/lib', runpath='/runpath')
+
+        elf_file = elf.ElfFile('binary')
+
+        self.assertTrue(elf_file.is_dynamic)
+        self.assertEqual(['libfoo.so.1', 'libbar.so.2'], elf_file.needed)
+        self.assertEqual(['/rpath', '$ORIGIN/lib'], elf_file.rpath)
+        self.assertEqual(['/runpath'], elf_file.runpath)
+
+    def test_statically_linked(self):
+        self.make_elf('binary', dynamic=False)
+
+        self.assertFalse(elf.ElfFile('binary').is_dynamic)
+
+    def test_not_an_elf_file(self):
+        with open('file', 'w') as f:
+            f.write('#!/bin/sh\n')
+
+        self.assertFalse(elf.is_elf('file'))
+        self.assertRaises(elf.ElfError, elf.ElfFile, 'file')
+
+    def test_truncated_file(self):
+        self.make_elf('binary', needed=['libfoo.so.1'])
+        with open('binary', 'rb') as f:
+            data = f.read()
+        with open('binary', 'wb') as f:
+            f.write(data[:80])
+
+        self.assertTrue(elf.is_elf('binary'))
+        self.assertRaises(elf.ElfError, elf.ElfFile, 'binary')
+
+    def test_get_elf_file_reads_changed_files_again(self):
+        self.make_elf('binary', needed=['libfoo.so.1'])
+        self.assertEqual(['libfoo.so.1'], elf.get_elf_file('binary').needed)
+
+        os.remove('binary')
+        self.make_elf('binary', needed=['libfoo.so.1', 'libbar.so.1'])
+        self.assertEqual(['libfoo.so.1', 'libbar.so.1'],
+                         elf.get_elf_file('binary').needed)
+
+
+class FindLibrariesTestCase(tests.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.system = os.path.abspath('system')
+        self.stage = os.path.abspath('stage')
+
+    def find_libraries(self, path):
+        return elf.find_libraries(path, [self.stage], [self.system])
+
+    def test_libraries_are_found_recursively(self):
+        self.make_elf('binary', needed=['libfoo.so.1'])
+        self.make_elf(os.path.join(self.stage, 'libfoo.so.1'),
+                      needed=['libbar.so.1', 'libc.so.6',
+                              'ld-linux-x86-64.so.2'])
+        self.make_elf(os.path.join(self.system, 'libbar.so.1'),
+                      needed=['libc.so.6'])
+        self.make_elf(os.path.join(self.system, 'libc.so.6'))
+
+        self.assertEqual(
+            [os.path.join(self.stage, 'libfoo.so.1'),
+             os.path.join(self.system, 'libbar.so.1'),
+             os.path.join(self.system, 'libc.so.6')],
+            self.find_libraries('binary'))
+
+    def test_library_paths_come_before_system_paths(self):
+        self.make_elf('binary', needed=['libfoo.so.1'])
+        self.make_elf(os.path.join(self.stage, 'libfoo.so.1'))
+        self.make_elf(os.path.join(self.system, 'libfoo.so.1'))
+
+        self.assertEqual([os.path.join(self.stage, 'libfoo.so.1')],
+                         self.find_libraries('binary'))
+
+    def test_rpath_comes_first_and_is_inherited(self):
+        self.make_elf(os.path.join('bin', 'binary'),
+                      needed=['libfoo.so.1'], rpath='$ORIGIN/../lib')
+        self.make_elf(os.path.join('lib', 'libfoo.so.1'),
+                      needed=['libbar.so.1'])
+        self.make_elf(os.path.join('lib', 'libbar.so.1'))
+        self.make_elf(os.path.join(self.stage, 'libfoo.so.1'))
+        self.make_elf(os.path.join(self.stage, 'libbar.so.1'))
+
+        self.assertEqual(
+            [os.path.join(os.getcwd(), 'bin', '..', 'lib', 'libfoo.so.1'),
+             os.path.join(os.getcwd(), 'bin', '..', 'lib', 'libbar.so.1')],
+            self.find_libraries(os.path.join('bin', 'binary')))
+
+    def test_runpath_comes_after_library_paths(self):
+        self.make_elf('binary', needed=['libfoo.so.1'],
+                      rpath='/ignored', runpath=os.path.abspath('lib'))
+        self.make_elf(os.path.join('lib', 'libfoo.so.1'))
+        self.make_elf(os.path.join(self.stage, 'libfoo.so.1'))
+
+        self.assertEqual([os.path.join(self.stage, 'libfoo.so.1')],
+                         self.find_libraries('binary'))
+
+    def test_libraries_for_other_machines_are_skipped(self):
+        self.make_elf('binary', needed=['libfoo.so.1'])
+        self.make_elf(os.path.join(self.stage, 'libfoo.so.1'), machine=183)
+        self.make_elf(os.path.join(self.system, 'libfoo.so.1'))
+
+        self.assertEqual([os.path.join(self.system, 'libfoo.so.1')],
+                         self.find_libraries('binary'))
+
+    def test_missing_libraries_are_left_out(self):
+        self.make_elf('binary', needed=['libmissing.so.1'])
+
+        self.assertEqual([], self.find_libraries('binary'))
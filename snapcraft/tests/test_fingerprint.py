@@ -0,0 +1,126 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright (C) 2016 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+from unittest import mock
+
+from snapcraft.internal import fingerprint
+from snapcraft import tests
+
+
+class HashTreeTestCase(tests.TestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        os.makedirs(os.path.join('src', 'dir'))
+        with open(os.path.join('src', 'dir', 'file'), 'w') as f:
+            f.write('content')
+        os.symlink('file', os.path.join('src', 'dir', 'link'))
+        self.digest = fingerprint.hash_tree('src')
+
+    def test_hash_is_stable(self):
+        self.assertEqual(self.digest, fingerprint.hash_tree('src'))
+
+    def test_hash_changes_on_edit(self):
+        with open(os.path.join('src', 'dir', 'file'), 'w') as f:
+            f.write('other content')
+
+        self.assertNotEqual(self.digest, fingerprint.hash_tree('src'))
+
+    def test_hash_changes_on_rename(self):
+        os.rename(os.path.join('src', 'dir', 'file'),
+                  os.path.join('src', 'dir', 'renamed'))
+
+        self.assertNotEqual(self.digest, fingerprint.hash_tree('src'))
+
+    def test_hash_changes_on_mode_change(self):
+        os.chmod(os.path.join('src', 'dir', 'file'), 0o755)
+
+        self.assertNotEqual(self.digest, fingerprint.hash_tree('src'))
+
+    def test_hash_changes_on_link_target_change(self):
+        os.remove(os.path.join('src', 'dir', 'link'))
+        os.symlink('other', os.path.join('src', 'dir', 'link'))
+
+        self.assertNotEqual(self.digest, fingerprint.hash_tree('src'))
+
+    def test_ignored_entries_do_not_change_the_hash(self):
+        open(os.path.join('src', 'ignored'), 'w').close()
+
+        self.assertEqual(self.digest, fingerprint.hash_tree(
+            'src', ignore=lambda d, entries: ['ignored']))
+
+    def test_vcs_metadata_does_not_change_the_hash(self):
+        os.makedirs(os.path.join('src', 'dir', '.git'))
+        with open(os.path.join('src', 'dir', '.git', 'HEAD'), 'w') as f:
+            f.write('ref: refs/heads/master')
+
+        self.assertEqual(self.digest, fingerprint.hash_tree('src'))
+
+
+class DigestCacheTestCase(tests.TestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        os.mkdir('src')
+        with open(os.path.join('src', 'file'), 'w') as f:
+            f.write('content')
+        self.digest = fingerprint.hash_tree('src')
+
+        patcher = mock.patch('snapcraft.internal.fingerprint._hash_file',
+                             wraps=fingerprint._hash_file)
+        self.mock_hash_file = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def hash_tree(self):
+        digests = fingerprint.DigestCache(os.path.abspath('digests.json'))
+        digest = fingerprint.hash_tree('src', digests=digests)
+        digests.save()
+        return digest
+
+    def test_unchanged_files_are_not_read_again(self):
+        self.assertEqual(self.digest, self.hash_tree())
+        self.assertEqual(self.digest, self.hash_tree())
+
+        self.assertEqual(1, self.mock_hash_file.call_count)
+
+    def test_modified_files_are_read_again(self):
+        self.hash_tree()
+        with open(os.path.join('src', 'file'), 'w') as f:
+            f.write('CONTENT')
+        os.utime(os.path.join('src', 'file'), ns=(0, 0))
+
+        self.assertNotEqual(self.digest, self.hash_tree())
+        self.assertEqual(2, self.mock_hash_file.call_count)
+
+
+class HashFilesTestCase(tests.TestCase):
+
+    def test_missing_files_are_hashed(self):
+        missing = fingerprint.hash_files('.', ['file'])
+
+        open('file', 'w').close()
+
+        self.assertNotEqual(missing, fingerprint.hash_files('.', ['file']))
+
+    def test_order_does_not_matter(self):
+        open('a', 'w').close()
+        open('b', 'w').close()
+
+        self.assertEqual(fingerprint.hash_files('.', ['a', 'b']),
+                         fingerprint.hash_files('.', ['b', 'a']))
@@ -99,6 +99,45 @@ class TestGetLibraries(tests.TestCase):
             self.fake_logger.output)
 
 
+class TestGetLibrariesFromElf(tests.TestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        patcher = mock.patch('snapcraft.internal.common.run_output')
+        self.run_output_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch('snapcraft.internal.libraries._get_system_libs')
+        self.get_system_libs_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.get_system_libs_mock.return_value = frozenset(['libc.so.6'])
+
+        self.libdir = os.path.abspath('lib')
+        self.make_elf('binary', needed=['libfoo.so.1', 'libc.so.6'])
+        self.make_elf(os.path.join(self.libdir, 'libfoo.so.1'))
+        self.make_elf(os.path.join(self.libdir, 'libc.so.6'))
+
+    def test_get_libraries_without_ldd(self):
+        libs = libraries.get_dependencies('binary', [self.libdir])
+
+        self.assertEqual([os.path.join(self.libdir, 'libfoo.so.1')], libs)
+        self.assertFalse(self.run_output_mock.called)
+
+    def test_parse_ld_so_conf_with_includes(self):
+        os.makedirs('ld.so.conf.d')
+        with open('ld.so.conf', 'w') as f:
+            f.write('include ld.so.conf.d/*.conf\n/first # comment\n')
+        with open(os.path.join('ld.so.conf.d', 'b.conf'), 'w') as f:
+            f.write('/b\n')
+        with open(os.path.join('ld.so.conf.d', 'a.conf'), 'w') as f:
+            f.write('/a1:/a2\n')
+
+        self.assertEqual(['/a1', '/a2', '/b', '/first'],
+                         libraries._parse_ld_so_conf(
+                             os.path.abspath('ld.so.conf')))
+
+
 class TestSystemLibsOnNewRelease(tests.TestCase):
 
     def setUp(self):
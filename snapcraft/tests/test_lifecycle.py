@@ -15,14 +15,21 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import multiprocessing.pool
+import os
+import shutil
+import threading
+import time
 
 import fixtures
 from unittest import mock
 
 import snapcraft
 from snapcraft.internal import (
+    common,
     pluginhandler,
     lifecycle,
+    repo,
 )
 from snapcraft import tests
 
@@ -534,6 +541,322 @@ confinement: strict
             "The 'pull' step of 'part1' is out of date. Please clean that "
             "part's 'pull' step in order to rebuild", str(raised.exception))
 
+    def test_changed_local_source_is_pulled_and_built_again(self):
+        self.make_snapcraft_yaml("""parts:
+  part1:
+    plugin: dump
+    source: src
+""")
+        os.mkdir('src')
+        with open(os.path.join('src', 'file'), 'w') as f:
+            f.write('content')
+
+        lifecycle.execute('build', self.project_options)
+
+        # Reset logging since we only care about the following
+        self.fake_logger = fixtures.FakeLogger(level=logging.INFO)
+        self.useFixture(self.fake_logger)
+
+        lifecycle.execute('build', self.project_options)
+        self.assertEqual(
+            'Skipping pull part1 (already ran)\n'
+            'Skipping build part1 (already ran)\n',
+            self.fake_logger.output)
+
+        self.fake_logger = fixtures.FakeLogger(level=logging.INFO)
+        self.useFixture(self.fake_logger)
+
+        os.remove(os.path.join('src', 'file'))
+        with open(os.path.join('src', 'file'), 'w') as f:
+            f.write('other content')
+
+        lifecycle.execute('build', self.project_options)
+
+        self.assertEqual(
+            'Skipping cleaning priming area for part1 (inputs changed) '
+            '(already clean)\n'
+            'Skipping cleaning staging area for part1 (inputs changed) '
+            '(already clean)\n'
+            'Cleaning build for part1 (inputs changed)\n'
+            'Cleaning pulled source for part1 (inputs changed)\n'
+            'Preparing to pull part1 \n'
+            'Pulling part1 \n'
+            'Preparing to build part1 \n'
+            'Building part1 \n',
+            self.fake_logger.output)
+        with open(os.path.join(
+                'parts', 'part1', 'install', 'file')) as f:
+            self.assertEqual('other content', f.read())
+
+    def test_changed_local_source_only_copies_what_changed(self):
+        self.make_snapcraft_yaml("""parts:
+  part1:
+    plugin: dump
+    source: src
+""")
+        os.mkdir('src')
+        for name in ('changed', 'unchanged'):
+            with open(os.path.join('src', name), 'w') as f:
+                f.write(name)
+        build_dir = os.path.join('parts', 'part1', 'build')
+
+        lifecycle.execute('build', self.project_options)
+        unchanged_inode = os.stat(
+            os.path.join(build_dir, 'unchanged')).st_ino
+
+        os.remove(os.path.join('src', 'changed'))
+        with open(os.path.join('src', 'changed'), 'w') as f:
+            f.write('other content')
+
+        # Run the steps in threads for the copies to be seen here.
+        fake_context = mock.Mock(Pool=multiprocessing.pool.ThreadPool)
+        with mock.patch('multiprocessing.get_context',
+                        return_value=fake_context):
+            with mock.patch('snapcraft.internal.common.link_or_copy',
+                            wraps=common.link_or_copy) as mock_link_or_copy:
+                lifecycle.execute('build', self.project_options)
+
+        mock_link_or_copy.assert_called_once_with(
+            os.path.abspath(os.path.join('src', 'changed')),
+            os.path.join(self.parts_dir, 'part1', 'src', 'changed'))
+        self.assertEqual(unchanged_inode, os.stat(
+            os.path.join(build_dir, 'unchanged')).st_ino)
+        with open(os.path.join(build_dir, 'changed')) as f:
+            self.assertEqual('other content', f.read())
+        with open(os.path.join(
+                'parts', 'part1', 'install', 'changed')) as f:
+            self.assertEqual('other content', f.read())
+
+    def test_build_is_restored_from_the_build_cache(self):
+        self.useFixture(fixtures.EnvironmentVariable(
+            'SNAPCRAFT_BUILD_CACHE_SIZE', '10'))
+        self.make_snapcraft_yaml("""parts:
+  part1:
+    plugin: dump
+    source: src
+""")
+        os.mkdir('src')
+        with open(os.path.join('src', 'file'), 'w') as f:
+            f.write('content')
+
+        lifecycle.execute('build', self.project_options)
+        shutil.rmtree('parts')
+
+        self.fake_logger = fixtures.FakeLogger(level=logging.INFO)
+        self.useFixture(self.fake_logger)
+
+        with mock.patch('snapcraft.plugins.dump.DumpPlugin.build') as build:
+            lifecycle.execute('build', self.project_options)
+
+        build.assert_not_called()
+        self.assertIn('Restoring cached build for part1',
+                      self.fake_logger.output)
+        with open(os.path.join(
+                'parts', 'part1', 'install', 'file')) as f:
+            self.assertEqual('content', f.read())
+        self.assertEqual('build', pluginhandler.load_plugin(
+            'part1', 'dump', {'source': 'src'}).last_step())
+
+    @mock.patch('snapcraft.internal.repo.Ubuntu.unpack')
+    @mock.patch('snapcraft.internal.repo.Ubuntu.get')
+    def test_stage_packages_are_fetched_in_shared_sessions(
+            self, mock_get, mock_unpack):
+        shared = []
+        mock_get.side_effect = lambda packages: shared.append(
+            (packages, repo._shared_sessions is not None))
+        self.make_snapcraft_yaml("""parts:
+  part1:
+    plugin: nil
+    stage-packages: [foo]
+  part2:
+    plugin: nil
+    stage-packages: [bar]
+""")
+
+        lifecycle.execute('pull', self.project_options)
+
+        self.assertCountEqual([(['foo'], True), (['bar'], True)], shared)
+
+
+class ScheduledExecutionTestCases(tests.TestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        self.project_options = snapcraft.ProjectOptions(jobs=2)
+
+    def make_snapcraft_yaml(self, parts):
+        super().make_snapcraft_yaml("""name: test
+version: 0
+summary: test
+description: test
+confinement: strict
+
+{}
+""".format(parts))
+
+    def assert_last_step(self, part_name, step):
+        state_dir = os.path.join(self.parts_dir, part_name, 'state')
+        self.assertEqual([step], [s for s in os.listdir(state_dir)
+                                  if s == step])
+        next_steps = common.COMMAND_ORDER[
+            common.COMMAND_ORDER.index(step) + 1:]
+        for next_step in next_steps:
+            self.assertFalse(os.path.exists(
+                os.path.join(state_dir, next_step)))
+
+    def test_prerequisites_are_staged(self):
+        self.make_snapcraft_yaml("""parts:
+  part1:
+    plugin: nil
+  part2:
+    plugin: nil
+    after:
+      - part1
+  part3:
+    plugin: nil
+""")
+
+        lifecycle.execute('build', self.project_options)
+
+        self.assert_last_step('part1', 'stage')
+        self.assert_last_step('part2', 'build')
+        self.assert_last_step('part3', 'build')
+
+    def test_prime_runs_for_all_parts(self):
+        self.make_snapcraft_yaml("""parts:
+  part1:
+    plugin: nil
+  part2:
+    plugin: nil
+    after:
+      - part1
+""")
+
+        lifecycle.execute('prime', self.project_options)
+
+        self.assert_last_step('part1', 'prime')
+        self.assert_last_step('part2', 'prime')
+        self.assertTrue(
+            os.path.exists(os.path.join(self.snap_dir, 'meta', 'snap.yaml')))
+
+    def test_exception_when_dependency_is_required(self):
+        self.make_snapcraft_yaml("""parts:
+  part1:
+    plugin: nil
+  part2:
+    plugin: nil
+    after:
+      - part1
+""")
+
+        with self.assertRaises(RuntimeError) as raised:
+            lifecycle.execute('pull', self.project_options,
+                              part_names=['part2'])
+
+        self.assertEqual(
+            "Requested 'pull' of 'part2' but there are unsatisfied "
+            "prerequisites: 'part1'", str(raised.exception))
+
+    def test_steps_do_not_wait_for_other_parts(self):
+        self.make_snapcraft_yaml("""parts:
+  part1:
+    plugin: nil
+  part2:
+    plugin: nil
+    after:
+      - part1
+  part3:
+    plugin: nil
+""")
+
+        # Run the workers as threads so they can synchronize with this test.
+        # part3 is not done pulling until part1 has been built and staged
+        # and part2 has started pulling, which would never happen if every
+        # part had to finish a step before any moved on to the next one.
+        part2_pulling = threading.Event()
+        original_pull = pluginhandler.PluginHandler.pull
+
+        def _fake_pull(part, force=False):
+            if part.name == 'part2':
+                part2_pulling.set()
+            elif part.name == 'part3':
+                self.assertTrue(part2_pulling.wait(timeout=10))
+            original_pull(part, force)
+
+        fake_context = mock.Mock(Pool=multiprocessing.pool.ThreadPool)
+        with mock.patch('multiprocessing.get_context',
+                        return_value=fake_context):
+            with mock.patch.object(pluginhandler.PluginHandler, 'pull',
+                                   _fake_pull):
+                lifecycle.execute('build', self.project_options)
+
+        self.assert_last_step('part1', 'stage')
+        self.assert_last_step('part2', 'build')
+        self.assert_last_step('part3', 'build')
+
+    def test_failure_in_worker_is_raised(self):
+        self.make_snapcraft_yaml("""parts:
+  part1:
+    plugin: nil
+  part2:
+    plugin: nil
+""")
+
+        with mock.patch.object(snapcraft.BasePlugin, 'build',
+                               side_effect=RuntimeError('build failed')):
+            with self.assertRaises(RuntimeError) as raised:
+                lifecycle.execute('build', self.project_options)
+
+        self.assertEqual('build failed', str(raised.exception))
+
+    def test_failure_in_this_process_waits_for_workers(self):
+        self.make_snapcraft_yaml("""parts:
+  part1:
+    plugin: nil
+  part2:
+    plugin: nil
+""")
+
+        # part1 fails to stage, in this process, while part2 is building in
+        # a worker. part2 must be done building by the time the pool is
+        # torn down.
+        part2_building = threading.Event()
+        part2_built = threading.Event()
+        built_when_terminated = []
+        original_build = pluginhandler.PluginHandler.build
+
+        def _fake_build(part, force=False):
+            if part.name == 'part2':
+                part2_building.set()
+                time.sleep(0.5)
+            original_build(part, force)
+            if part.name == 'part2':
+                part2_built.set()
+
+        def _fake_stage(part, force=False):
+            self.assertTrue(part2_building.wait(timeout=10))
+            raise RuntimeError('stage failed')
+
+        class _Pool(multiprocessing.pool.ThreadPool):
+            def terminate(self):
+                built_when_terminated.append(part2_built.is_set())
+                super().terminate()
+
+        fake_context = mock.Mock(Pool=_Pool)
+        with mock.patch('multiprocessing.get_context',
+                        return_value=fake_context):
+            with mock.patch.object(pluginhandler.PluginHandler, 'build',
+                                   _fake_build):
+                with mock.patch.object(pluginhandler.PluginHandler, 'stage',
+                                       _fake_stage):
+                    with self.assertRaises(RuntimeError) as raised:
+                        lifecycle.execute('stage', self.project_options)
+
+        self.assertEqual('stage failed', str(raised.exception))
+        self.assertEqual([True], built_when_terminated)
+        self.assert_last_step('part2', 'build')
+
 
 class HumanizeListTestCases(tests.TestCase):
 
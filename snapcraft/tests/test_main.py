@@ -34,6 +34,7 @@ class TestMain(TestCase):
         with mock.patch('snapcraft.ProjectOptions') as mock_project_options:
             snapcraft.main.main([])
             mock_project_options.assert_called_once_with(
+                jobs=1,
                 parallel_builds=True, target_deb_arch=None, use_geoip=False)
             self.assertTrue(mock_cmd.called, mock_cmd.called)
 
@@ -43,6 +44,7 @@ class TestMain(TestCase):
             snapcraft.main.main(['--enable-geoip'])
             self.assertTrue(mock_cmd.called, mock_cmd.called)
             mock_project_options.assert_called_once_with(
+                jobs=1,
                 parallel_builds=True, target_deb_arch=None, use_geoip=True)
 
     def test_command_error(self):
@@ -77,6 +79,7 @@ class TestMain(TestCase):
         with mock.patch('snapcraft.ProjectOptions') as mock_project_options:
             snapcraft.main.main([])
             mock_project_options.assert_called_once_with(
+                jobs=1,
                 parallel_builds=True, target_deb_arch=None, use_geoip=False)
 
     @mock.patch('snapcraft.internal.lifecycle.snap')
@@ -84,6 +87,7 @@ class TestMain(TestCase):
         with mock.patch('snapcraft.ProjectOptions') as mock_project_options:
             snapcraft.main.main(['--no-parallel-build'])
             mock_project_options.assert_called_once_with(
+                jobs=1,
                 parallel_builds=False, target_deb_arch=None, use_geoip=False)
 
     @mock.patch('snapcraft.internal.lifecycle.snap')
@@ -91,8 +95,28 @@ class TestMain(TestCase):
         with mock.patch('snapcraft.ProjectOptions') as mock_project_options:
             snapcraft.main.main(['--target-arch', 'arm64'])
             mock_project_options.assert_called_once_with(
+                jobs=1,
                 parallel_builds=True, target_deb_arch='arm64', use_geoip=False)
 
+    @mock.patch('snapcraft.internal.lifecycle.snap')
+    def test_command_with_jobs(self, mock_cmd):
+        with mock.patch('snapcraft.ProjectOptions') as mock_project_options:
+            snapcraft.main.main(['--jobs', '4'])
+            mock_project_options.assert_called_once_with(
+                jobs=4,
+                parallel_builds=True, target_deb_arch=None, use_geoip=False)
+
+    def test_command_with_invalid_jobs(self):
+        fake_logger = fixtures.FakeLogger(level=logging.ERROR)
+        self.useFixture(fake_logger)
+
+        with self.assertRaises(SystemExit):
+            snapcraft.main.main(['--jobs', 'many'])
+
+        self.assertEqual(
+            "The number of jobs must be an integer, not 'many'\n",
+            fake_logger.output)
+
     @mock.patch('pkg_resources.require')
     @mock.patch('sys.stdout', new_callable=io.StringIO)
     def test_devel_version(self, mock_stdout, mock_resources):
@@ -62,3 +62,13 @@ class OptionsTestCase(tests.TestCase):
             snapcraft.ProjectOptions()
         except KeyError:
             self.fail('Expected s390x to be supported')
+
+    def test_jobs_default_to_one(self):
+        self.assertEqual(1, snapcraft.ProjectOptions().jobs)
+
+    def test_jobs_must_be_positive(self):
+        with self.assertRaises(EnvironmentError) as raised:
+            snapcraft.ProjectOptions(jobs=0)
+
+        self.assertEqual('The number of jobs must be at least 1, not 0',
+                         str(raised.exception))
@@ -120,6 +120,16 @@ class AutotoolsPluginTestCase(tests.TestCase):
         self.assertEqual(str(raised.exception),
                          'Unsupported installation method: "invalid"')
 
+    def test_only_prefix_installs_embed_the_installdir(self):
+        plugin = autotools.AutotoolsPlugin('test-part', self.options,
+                                           self.project_options)
+        self.assertFalse(plugin.embeds_installdir)
+
+        self.options.install_via = 'prefix'
+        plugin = autotools.AutotoolsPlugin('test-part', self.options,
+                                           self.project_options)
+        self.assertTrue(plugin.embeds_installdir)
+
     def build_with_configure(self):
         plugin = autotools.AutotoolsPlugin('test-part', self.options,
                                            self.project_options)
@@ -140,7 +150,8 @@ class AutotoolsPluginTestCase(tests.TestCase):
 
         self.assertEqual(3, run_mock.call_count)
         run_mock.assert_has_calls([
-            mock.call(['./configure', '--prefix=']),
+            mock.call([os.path.join(plugin.sourcedir, 'configure'),
+                       '--prefix=']),
             mock.call(['make', '-j2']),
             mock.call(['make', 'install',
                        'DESTDIR={}'.format(plugin.installdir)])
@@ -153,12 +164,19 @@ class AutotoolsPluginTestCase(tests.TestCase):
 
         self.assertEqual(3, run_mock.call_count)
         run_mock.assert_has_calls([
-            mock.call(['./configure', '--prefix={}'.format(
-                plugin.installdir)]),
+            mock.call([os.path.join(plugin.sourcedir, 'configure'),
+                       '--prefix={}'.format(plugin.installdir)]),
             mock.call(['make', '-j2']),
             mock.call(['make', 'install'])
         ])
 
+    @mock.patch.object(autotools.AutotoolsPlugin, 'run')
+    def test_build_configure_out_of_tree(self, run_mock):
+        plugin = self.build_with_configure()
+
+        self.assertTrue(plugin.out_of_tree_build)
+        self.assertEqual([], os.listdir(plugin.builddir))
+
     def build_with_autogen(self, files=None):
         plugin = autotools.AutotoolsPlugin('test-part', self.options,
                                            self.project_options)
@@ -32,6 +32,8 @@ class TestCopyPlugin(TestCase):
         self.mock_options = Mock()
         self.mock_options.source = '.'
         self.mock_options.source_subdir = None
+        self.mock_options.source_checksum = None
+        self.mock_options.source_commit = None
         self.mock_options.files = {}
         # setup the expected target dir in our tempdir
         self.dst_prefix = 'parts/copy/install/'
@@ -125,12 +125,18 @@ class GulpPluginTestCase(tests.TestCase):
                 'node-engine': {'default': '4.4.4', 'type': 'string'},
                 'source': {'type': 'string'},
                 'source-branch': {'default': '', 'type': 'string'},
+                'source-commit': {'default': '',
+                                  'pattern': '^[0-9a-fA-F]{40}$',
+                                  'type': 'string'},
+                'source-checksum': {'default': '', 'type': 'string'},
                 'source-subdir': {'default': None, 'type': 'string'},
                 'source-tag': {'default': '', 'type:': 'string'},
                 'source-type': {'default': '', 'type': 'string'},
                 'disable-parallel': {'default': False, 'type': 'boolean'}},
             'pull-properties': ['source', 'source-type', 'source-branch',
-                                'source-tag', 'source-subdir', 'node-engine'],
+                                'source-tag', 'source-commit',
+                                'source-checksum', 'source-subdir',
+                                'node-engine'],
             'build-properties': ['disable-parallel', 'gulp-tasks'],
             'required': ['source', 'gulp-tasks'],
             'type': 'object'}
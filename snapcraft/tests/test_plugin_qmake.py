@@ -166,7 +166,7 @@ class QMakeTestCase(tests.TestCase):
         plugin.build()
 
         self.run_mock.assert_has_calls([
-            mock.call(['qmake'], cwd=plugin.builddir,
+            mock.call(['qmake', plugin.sourcedir], cwd=plugin.builddir,
                       env=mock.ANY),
             mock.call(['make', '-j2'], cwd=plugin.builddir, env=mock.ANY),
             mock.call(['make', 'install',
@@ -182,7 +182,8 @@ class QMakeTestCase(tests.TestCase):
         plugin.build()
 
         self.run_mock.assert_has_calls([
-            mock.call(['qmake'], cwd=plugin.builddir, env=mock.ANY),
+            mock.call(['qmake', os.path.join(plugin.sourcedir, 'subdir')],
+                      cwd=plugin.builddir, env=mock.ANY),
             mock.call(['make', '-j2'], cwd=plugin.builddir, env=mock.ANY),
             mock.call(['make', 'install',
                        'INSTALL_ROOT={}'.format(plugin.installdir)],
@@ -234,8 +235,8 @@ class QMakeTestCase(tests.TestCase):
         plugin.build()
 
         self.run_mock.assert_has_calls([
-            mock.call(['qmake', '-foo'], cwd=plugin.builddir,
-                      env=mock.ANY),
+            mock.call(['qmake', '-foo', plugin.sourcedir],
+                      cwd=plugin.builddir, env=mock.ANY),
             mock.call(['make', '-j2'], cwd=plugin.builddir, env=mock.ANY),
             mock.call(['make', 'install',
                        'INSTALL_ROOT={}'.format(plugin.installdir)],
@@ -251,7 +252,8 @@ class QMakeTestCase(tests.TestCase):
 
         self.run_mock.assert_has_calls([
             mock.call(['qmake', 'LIBS+="-L{}/lib"'.format(plugin.installdir),
-                       'INCLUDEPATH+="{}/include"'.format(plugin.installdir)],
+                       'INCLUDEPATH+="{}/include"'.format(plugin.installdir),
+                       plugin.sourcedir],
                       cwd=plugin.builddir, env=mock.ANY),
             mock.call(['make', '-j2'], cwd=plugin.builddir, env=mock.ANY),
             mock.call(['make', 'install',
@@ -269,7 +271,8 @@ class QMakeTestCase(tests.TestCase):
         self.run_mock.assert_has_calls([
             mock.call(
                 ['qmake', 'LIBS+="-L{}/lib"'.format(plugin.project.stage_dir),
-                 'INCLUDEPATH+="{}/include"'.format(plugin.project.stage_dir)],
+                 'INCLUDEPATH+="{}/include"'.format(plugin.project.stage_dir),
+                 plugin.sourcedir],
                 cwd=plugin.builddir, env=mock.ANY),
             mock.call(['make', '-j2'], cwd=plugin.builddir, env=mock.ANY),
             mock.call(['make', 'install',
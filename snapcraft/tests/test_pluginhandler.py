@@ -16,6 +16,7 @@
 
 from collections import OrderedDict
 import copy
+import inspect
 import logging
 import os
 import shutil
@@ -33,13 +34,17 @@ import fixtures
 import snapcraft
 from snapcraft.internal import (
     common,
+    libraries,
     lifecycle,
     pluginhandler,
     repo,
     states,
 )
 from snapcraft import tests
-from snapcraft.plugins import nil
+from snapcraft.plugins import (
+    make,
+    nil,
+)
 
 
 class PluginTestCase(tests.TestCase):
@@ -54,6 +59,15 @@ class PluginTestCase(tests.TestCase):
         self.assertEqual(raised.exception.__str__(),
                          'unknown plugin: test_unexisting')
 
+    def test_abbreviated_source_commit_raises(self):
+        with self.assertRaises(pluginhandler.PluginError) as raised:
+            pluginhandler.load_plugin(
+                'test-part', 'make', {'source': '.',
+                                      'source-commit': '2514f9533ec9b45'})
+
+        self.assertIn("'2514f9533ec9b45' does not match",
+                      str(raised.exception))
+
     def test_fileset_include_excludes(self):
         stage_set = [
             '-etc',
@@ -382,6 +396,57 @@ class PluginTestCase(tests.TestCase):
         self.assertEqual(stat.S_IMODE(
             os.stat(os.path.join('stage', 'foo', 'bar')).st_mode), new_mode)
 
+    def test_migrate_files_links_files(self):
+        os.makedirs('install/foo')
+        os.makedirs('stage/foo')
+        for name in ('1', 'foo/2', 'foo/3'):
+            open(os.path.join('install', name), 'w').close()
+        open(os.path.join('stage', 'foo', '2'), 'w').close()
+
+        files, dirs = pluginhandler._migratable_filesets(['*'], 'install')
+        linked, copied = pluginhandler._migrate_files(
+            files, dirs, 'install', 'stage')
+
+        self.assertEqual((3, 0), (linked, copied))
+        for name in ('1', 'foo/2', 'foo/3'):
+            self.assertTrue(os.path.samefile(
+                os.path.join('install', name), os.path.join('stage', name)))
+
+    @patch('os.link')
+    def test_migrate_files_copies_files_that_cannot_be_linked(
+            self, mock_link):
+        mock_link.side_effect = OSError('Invalid cross-device link')
+        os.makedirs('install/foo')
+        os.makedirs('stage')
+        for name in ('1', 'foo/2', 'foo/3'):
+            with open(os.path.join('install', name), 'w') as f:
+                f.write(name)
+
+        files, dirs = pluginhandler._migratable_filesets(['*'], 'install')
+        linked, copied = pluginhandler._migrate_files(
+            files, dirs, 'install', 'stage')
+
+        self.assertEqual((0, 3), (linked, copied))
+        for name in ('1', 'foo/2', 'foo/3'):
+            with open(os.path.join('stage', name)) as f:
+                self.assertEqual(name, f.read())
+
+    @patch('snapcraft.internal.common.copy')
+    @patch('os.link')
+    def test_migrate_files_raises_copy_errors(self, mock_link, mock_copy):
+        mock_link.side_effect = OSError('Invalid cross-device link')
+        mock_copy.side_effect = OSError('No space left on device')
+        os.makedirs('install')
+        os.makedirs('stage')
+        open(os.path.join('install', '1'), 'w').close()
+        open(os.path.join('install', '2'), 'w').close()
+
+        files, dirs = pluginhandler._migratable_filesets(['*'], 'install')
+        with self.assertRaises(OSError) as raised:
+            pluginhandler._migrate_files(files, dirs, 'install', 'stage')
+
+        self.assertEqual('No space left on device', str(raised.exception))
+
     @patch('importlib.import_module')
     @patch('snapcraft.internal.pluginhandler._load_local')
     @patch('snapcraft.internal.pluginhandler._get_plugin')
@@ -629,6 +694,49 @@ class MigratableFilesetsTestCase(tests.TestCase):
         self.assertEqual({'foo/bar/baz/3'}, files)
         self.assertEqual({'foo', 'foo/bar', 'foo/bar/baz'}, dirs)
 
+    def test_migratable_filesets_wildcards_skip_hidden_files(self):
+        open('install/.hidden', 'w').close()
+        open('install/foo/.hidden', 'w').close()
+
+        files, dirs = pluginhandler._migratable_filesets(['*'], 'install')
+        self.assertNotIn('.hidden', files)
+        self.assertIn('foo/.hidden', files)
+
+    def test_migratable_filesets_exclude_directories_everywhere(self):
+        os.makedirs('install/foo/__pycache__')
+        os.makedirs('install/foo/bar/__pycache__')
+        open('install/foo/__pycache__/2.pyc', 'w').close()
+        open('install/foo/bar/__pycache__/3.pyc', 'w').close()
+
+        files, dirs = pluginhandler._migratable_filesets(
+            ['*', '-*/__pycache__', '-*/*/__pycache__'], 'install')
+        self.assertEqual({'1', 'foo/2', 'foo/bar/3', 'foo/bar/baz/4'}, files)
+        self.assertEqual({'foo', 'foo/bar', 'foo/bar/baz'}, dirs)
+
+    def test_migratable_filesets_exclude_file_in_included_directory(self):
+        files, dirs = pluginhandler._migratable_filesets(
+            ['foo', '-foo/bar/*'], 'install')
+        self.assertEqual({'foo/2'}, files)
+        self.assertEqual({'foo', 'foo/bar'}, dirs)
+
+    def test_migratable_filesets_missing_file_is_kept(self):
+        files, dirs = pluginhandler._migratable_filesets(
+            ['foo/missing'], 'install')
+        self.assertEqual({'foo/missing'}, files)
+        self.assertEqual({'foo'}, dirs)
+
+    def test_migratable_filesets_nested_symlinked_directory(self):
+        os.symlink('bar', 'install/foo/link')
+
+        files, dirs = pluginhandler._migratable_filesets(['*'], 'install')
+        self.assertIn('foo/link', files)
+        self.assertNotIn('foo/link/3', files)
+
+        files, dirs = pluginhandler._migratable_filesets(
+            ['foo/link'], 'install')
+        self.assertEqual({'foo/link', 'foo/link/3', 'foo/link/baz/4'}, files)
+        self.assertEqual({'foo', 'foo/link', 'foo/link/baz'}, dirs)
+
 
 class RealStageTestCase(tests.TestCase):
 
@@ -940,6 +1048,18 @@ class StateTestCase(tests.TestCase):
         self.assertTrue(type(state.project_options) is OrderedDict)
         self.assertEqual(0, len(state.project_options))
 
+    def test_stage_touches_stage_dir(self):
+        libdir = os.path.join(self.handler.code.installdir, 'usr', 'lib')
+        os.makedirs(libdir)
+        open(os.path.join(libdir, 'lib'), 'w').close()
+        os.makedirs(os.path.join(self.stage_dir, 'usr'))
+        os.utime(self.stage_dir, (0, 0))
+
+        self.handler.mark_done('build')
+        self.handler.stage()
+
+        self.assertNotEqual(0, os.stat(self.stage_dir).st_mtime)
+
     def test_stage_state_with_stage_keyword(self):
         self.handler.code.options.stage = ['bin/1']
 
@@ -1060,7 +1180,10 @@ class StateTestCase(tests.TestCase):
         self.handler.prime()
 
         self.assertEqual('prime', self.handler.last_step())
-        mock_find_dependencies.assert_called_once_with(self.handler.snapdir)
+        mock_find_dependencies.assert_called_once_with(
+            self.handler.snapdir, {'bin/1', 'bin/2'},
+            self.handler._library_paths(),
+            self.handler._dependency_cache_file)
         self.assertFalse(mock_copy.called)
 
         state = self.handler.get_state('prime')
@@ -1103,7 +1226,10 @@ class StateTestCase(tests.TestCase):
         self.handler.prime()
 
         self.assertEqual('prime', self.handler.last_step())
-        mock_find_dependencies.assert_called_once_with(self.handler.snapdir)
+        mock_find_dependencies.assert_called_once_with(
+            self.handler.snapdir, {'bin/1', 'bin/2'},
+            self.handler._library_paths(),
+            self.handler._dependency_cache_file)
         mock_migrate_files.assert_has_calls([
             call({'bin/1', 'bin/2'}, {'bin'}, self.handler.stagedir,
                  self.handler.snapdir),
@@ -1151,7 +1277,9 @@ class StateTestCase(tests.TestCase):
         self.handler.prime()
 
         self.assertEqual('prime', self.handler.last_step())
-        mock_find_dependencies.assert_called_once_with(self.handler.snapdir)
+        mock_find_dependencies.assert_called_once_with(
+            self.handler.snapdir, {'bin/1'}, self.handler._library_paths(),
+            self.handler._dependency_cache_file)
         self.assertFalse(mock_copy.called)
 
         state = self.handler.get_state('prime')
@@ -1809,6 +1937,43 @@ class CleanTestCase(tests.TestCase):
         self.assertTrue(os.path.isfile(staged_file))
 
 
+class KeepDirsCleanTestCase(tests.TestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        patcher = patch.object(pluginhandler.PluginHandler, 'is_clean')
+        patcher.start().return_value = False
+        self.addCleanup(patcher.stop)
+
+        self.handler = pluginhandler.load_plugin('test_part', 'nil')
+        os.makedirs(self.handler.code.sourcedir)
+        os.makedirs(self.handler.code.build_basedir)
+        os.makedirs(self.handler.code.installdir)
+
+    def test_clean_build_keeps_build_dir(self):
+        self.handler.clean_build(keep_dirs=True)
+
+        self.assertTrue(os.path.exists(self.handler.code.build_basedir))
+        self.assertFalse(os.path.exists(self.handler.code.installdir))
+
+    def test_clean_build_removes_build_dir_by_default(self):
+        self.handler.clean_build()
+
+        self.assertFalse(os.path.exists(self.handler.code.build_basedir))
+        self.assertFalse(os.path.exists(self.handler.code.installdir))
+
+    def test_clean_pull_keeps_source_dir(self):
+        self.handler.clean_pull(keep_dirs=True)
+
+        self.assertTrue(os.path.exists(self.handler.code.sourcedir))
+
+    def test_clean_pull_removes_source_dir_by_default(self):
+        self.handler.clean_pull()
+
+        self.assertFalse(os.path.exists(self.handler.code.sourcedir))
+
+
 class PerStepCleanTestCase(tests.TestCase):
 
     def setUp(self):
@@ -1841,8 +2006,8 @@ class PerStepCleanTestCase(tests.TestCase):
         self.manager_mock.assert_has_calls([
             call.clean_prime({}, 'foo'),
             call.clean_stage({}, 'foo'),
-            call.clean_build('foo'),
-            call.clean_pull('foo'),
+            call.clean_build('foo', False),
+            call.clean_pull('foo', False),
         ])
 
     def test_clean_pull_order(self):
@@ -1854,8 +2019,8 @@ class PerStepCleanTestCase(tests.TestCase):
         self.manager_mock.assert_has_calls([
             call.clean_prime({}, ''),
             call.clean_stage({}, ''),
-            call.clean_build(''),
-            call.clean_pull(''),
+            call.clean_build('', False),
+            call.clean_pull('', False),
         ])
 
     def test_clean_build_order(self):
@@ -1867,7 +2032,7 @@ class PerStepCleanTestCase(tests.TestCase):
         self.manager_mock.assert_has_calls([
             call.clean_prime({}, ''),
             call.clean_stage({}, ''),
-            call.clean_build(''),
+            call.clean_build('', False),
         ])
 
     def test_clean_stage_order(self):
@@ -1892,6 +2057,61 @@ class PerStepCleanTestCase(tests.TestCase):
         ])
 
 
+class StepFingerprintTestCase(tests.TestCase):
+
+    def test_unchanged_sources_are_not_read_again(self):
+        handler = pluginhandler.load_plugin('part', 'nil')
+        os.makedirs(handler.code.sourcedir)
+        with open(os.path.join(handler.code.sourcedir, 'file'), 'w') as f:
+            f.write('content')
+        digest = handler._step_fingerprint('build')
+
+        with patch('snapcraft.internal.fingerprint._hash_file') as mock_hash:
+            self.assertEqual(digest, handler._step_fingerprint('build'))
+
+        mock_hash.assert_not_called()
+
+
+class BuildCacheKeyTestCase(tests.TestCase):
+
+    def _key_in(self, directory, embeds_installdir):
+        os.makedirs(directory)
+        os.chdir(directory)
+        handler = pluginhandler.load_plugin('part', 'nil')
+        handler.code.embeds_installdir = embeds_installdir
+        return handler._build_cache_key()
+
+    def test_key_does_not_depend_on_the_install_directory(self):
+        self.assertEqual(self._key_in('one', False),
+                         self._key_in('../two', False))
+
+    def test_key_depends_on_an_embedded_install_directory(self):
+        self.assertNotEqual(self._key_in('one', True),
+                            self._key_in('../two', True))
+
+    def test_key_depends_on_the_plugin_sources(self):
+        handler = pluginhandler.load_plugin('part', 'nil')
+        key = handler._build_cache_key()
+
+        with patch('snapcraft.internal.pluginhandler._get_source_files',
+                   return_value=[os.path.abspath('plugin.py')]):
+            with open('plugin.py', 'w') as f:
+                f.write('first')
+            first_key = handler._build_cache_key()
+            with open('plugin.py', 'w') as f:
+                f.write('second')
+            second_key = handler._build_cache_key()
+
+        self.assertNotEqual(key, first_key)
+        self.assertNotEqual(first_key, second_key)
+
+    def test_source_files_include_the_base_classes(self):
+        self.assertEqual(
+            [inspect.getsourcefile(make.MakePlugin),
+             inspect.getsourcefile(snapcraft.BasePlugin)],
+            pluginhandler._get_source_files(make.MakePlugin))
+
+
 class CollisionTestCase(tests.TestCase):
 
     def setUp(self):
@@ -2189,76 +2409,55 @@ class StagePackagesTestCase(tests.TestCase):
 
 class FindDependenciesTestCase(tests.TestCase):
 
-    @patch('magic.open')
-    @patch('snapcraft.internal.libraries.get_dependencies')
-    def test_find_dependencies(self, mock_dependencies, mock_magic):
-        workdir = os.path.join(os.getcwd(), 'workdir')
-        os.makedirs(workdir)
-
-        linked_elf_path = os.path.join(workdir, 'linked')
-        open(linked_elf_path, 'w').close()
+    def setUp(self):
+        super().setUp()
+        self.workdir = os.path.join(os.getcwd(), 'workdir')
+        os.makedirs(self.workdir)
 
-        mock_ms = Mock()
-        mock_magic.return_value = mock_ms
-        mock_ms.load.return_value = 0
-        mock_ms.file.return_value = (
-            'ELF 64-bit LSB executable, x86-64, version 1 (SYSV), '
-            'dynamically linked interpreter /lib64/ld-linux-x86-64.so.2, '
-            'for GNU/Linux 2.6.32, BuildID[sha1]=XYZ, stripped')
+    @patch('snapcraft.internal.libraries.get_dependencies')
+    def test_find_dependencies(self, mock_dependencies):
+        linked_elf_path = os.path.join(self.workdir, 'linked')
+        self.make_elf(linked_elf_path, needed=['libDepends.so'])
 
         mock_dependencies.return_value = ['/usr/lib/libDepends.so']
 
-        dependencies = pluginhandler._find_dependencies(workdir)
+        dependencies = pluginhandler._find_dependencies(
+            self.workdir, ['linked'], ['/lib'])
 
-        mock_ms.file.assert_called_once_with(bytes(linked_elf_path, 'utf-8'))
+        mock_dependencies.assert_called_once_with(linked_elf_path, ['/lib'])
         self.assertEqual(dependencies, {'/usr/lib/libDepends.so'})
 
-    @patch('magic.open')
     @patch('snapcraft.internal.libraries.get_dependencies')
-    def test_find_dependencies_skip_object_files(self, mock_dependencies,
-                                                 mock_magic):
-        workdir = os.path.join(os.getcwd(), 'workdir')
-        os.makedirs(workdir)
-        open(os.path.join(workdir, 'object_file.o'), 'w').close()
-
-        mock_ms = Mock()
-        mock_magic.return_value = mock_ms
-        mock_ms.load.return_value = 0
-        mock_ms.file.return_value = (
-            'ELF 64-bit LSB executable, x86-64, version 1 (SYSV), '
-            'dynamically linked interpreter /lib64/ld-linux-x86-64.so.2, '
-            'for GNU/Linux 2.6.32, BuildID[sha1]=XYZ, stripped')
+    def test_find_dependencies_only_of_given_files(self, mock_dependencies):
+        self.make_elf(os.path.join(self.workdir, 'mine'))
+        self.make_elf(os.path.join(self.workdir, 'other-part'))
+
+        pluginhandler._find_dependencies(self.workdir, ['mine'])
+
+        mock_dependencies.assert_called_once_with(
+            os.path.join(self.workdir, 'mine'), None)
+
+    @patch('snapcraft.internal.libraries.get_dependencies')
+    def test_find_dependencies_skip_object_files(self, mock_dependencies):
+        self.make_elf(os.path.join(self.workdir, 'object_file.o'))
 
         mock_dependencies.return_value = ['/usr/lib/libDepends.so']
 
-        dependencies = pluginhandler._find_dependencies(workdir)
+        dependencies = pluginhandler._find_dependencies(
+            self.workdir, ['object_file.o'])
 
-        self.assertFalse(mock_ms.file.called,
+        self.assertFalse(mock_dependencies.called,
                          'Expected object file to be skipped')
         self.assertEqual(dependencies, set())
 
-    @patch('magic.open')
     @patch('snapcraft.internal.libraries.get_dependencies')
     def test_no_find_dependencies_of_non_dynamically_linked(
-            self, mock_dependencies, mock_magic):
-        workdir = os.path.join(os.getcwd(), 'workdir')
-        os.makedirs(workdir)
-
-        statically_linked_elf_path = os.path.join(workdir, 'statically-linked')
-        open(statically_linked_elf_path, 'w').close()
+            self, mock_dependencies):
+        self.make_elf(os.path.join(self.workdir, 'statically-linked'),
+                      dynamic=False)
 
-        mock_ms = Mock()
-        mock_magic.return_value = mock_ms
-        mock_ms.load.return_value = 0
-        mock_ms.file.return_value = (
-            'ELF 64-bit LSB executable, x86-64, version 1 (SYSV), '
-            'statically linked, for GNU/Linux 2.6.32, '
-            'BuildID[sha1]=XYZ, stripped')
-
-        dependencies = pluginhandler._find_dependencies(workdir)
-
-        mock_ms.file.assert_called_once_with(
-            bytes(statically_linked_elf_path, 'utf-8'))
+        dependencies = pluginhandler._find_dependencies(
+            self.workdir, ['statically-linked'])
 
         self.assertFalse(
             mock_dependencies.called,
@@ -2266,24 +2465,14 @@ class FindDependenciesTestCase(tests.TestCase):
 
         self.assertFalse(dependencies)
 
-    @patch('magic.open')
     @patch('snapcraft.internal.libraries.get_dependencies')
-    def test_no_find_dependencies_of_non_elf_files(
-            self, mock_dependencies, mock_magic):
-        workdir = os.path.join(os.getcwd(), 'workdir')
-        os.makedirs(workdir)
-
-        non_elf_path = os.path.join(workdir, 'non-elf')
-        open(non_elf_path, 'w').close()
-
-        mock_ms = Mock()
-        mock_magic.return_value = mock_ms
-        mock_ms.load.return_value = 0
-        mock_ms.file.return_value = 'JPEG image data, Exif standard: ...'
+    def test_no_find_dependencies_of_non_elf_files(self, mock_dependencies):
+        non_elf_path = os.path.join(self.workdir, 'non-elf')
+        with open(non_elf_path, 'wb') as f:
+            f.write(b'\xff\xd8\xff\xe0JFIF')
 
-        dependencies = pluginhandler._find_dependencies(workdir)
-
-        mock_ms.file.assert_called_once_with(bytes(non_elf_path, 'utf-8'))
+        dependencies = pluginhandler._find_dependencies(
+            self.workdir, ['non-elf'])
 
         self.assertFalse(
             mock_dependencies.called,
@@ -2293,39 +2482,156 @@ class FindDependenciesTestCase(tests.TestCase):
             dependencies,
             'non elf files should not have library dependencies')
 
-    @patch('magic.open')
     @patch('snapcraft.internal.libraries.get_dependencies')
-    def test_no_find_dependencies_of_symlinks(
-            self, mock_dependencies, mock_magic):
-        workdir = os.path.join(os.getcwd(), 'workdir')
-        os.makedirs(workdir)
+    def test_no_find_dependencies_of_symlinks(self, mock_dependencies):
+        self.make_elf(os.path.join(self.workdir, 'linked'),
+                      needed=['libc.so.6'])
+        os.symlink('linked', os.path.join(self.workdir, 'symlinked'))
 
-        symlinked_path = os.path.join(workdir, 'symlinked')
-        os.symlink('/bin/dash', symlinked_path)
+        pluginhandler._find_dependencies(
+            self.workdir, ['linked', 'symlinked'])
 
-        mock_ms = Mock()
-        mock_magic.return_value = mock_ms
-        mock_ms.load.return_value = 0
+        mock_dependencies.assert_called_once_with(
+            os.path.join(self.workdir, 'linked'), None)
 
-        dependencies = pluginhandler._find_dependencies(workdir)
+    @patch('snapcraft.internal.libraries.get_dependencies')
+    def test_unreadable_elf_files_are_left_to_ldd(self, mock_dependencies):
+        truncated_path = os.path.join(self.workdir, 'truncated')
+        self.make_elf(truncated_path, needed=['libc.so.6'])
+        with open(truncated_path, 'r+b') as f:
+            f.truncate(80)
 
-        self.assertFalse(
-            mock_ms.file.called, 'magic is not needed for symlinks')
+        pluginhandler._find_dependencies(self.workdir, ['truncated'])
 
-        self.assertFalse(
-            mock_dependencies.called,
-            'statically linked files should not have library dependencies')
+        mock_dependencies.assert_called_once_with(truncated_path, None)
 
-        self.assertFalse(
-            dependencies,
-            'statically linked files should not have library dependencies')
+    @patch('snapcraft.internal.libraries.get_dependencies')
+    def test_unchanged_files_are_not_read_again(self, mock_dependencies):
+        cache_file = os.path.join(os.getcwd(), 'cache.json')
+        library_path = os.path.join(os.getcwd(), 'lib', 'libfoo.so')
+        self.make_elf(library_path)
+        self.make_elf(os.path.join(self.workdir, 'linked'))
+        mock_dependencies.return_value = [library_path]
 
-    @patch('magic.open')
-    def test_fail_to_load_magic_raises_exception(self, mock_magic):
-        mock_magic.return_value.load.return_value = 1
+        pluginhandler._find_dependencies(
+            self.workdir, ['linked'], cache_file=cache_file)
+        dependencies = pluginhandler._find_dependencies(
+            self.workdir, ['linked'], cache_file=cache_file)
 
-        with self.assertRaises(RuntimeError) as raised:
-            pluginhandler._find_dependencies('.')
+        self.assertEqual(1, mock_dependencies.call_count)
+        self.assertEqual(dependencies, {library_path})
+
+    @patch('snapcraft.internal.libraries.get_dependencies')
+    def test_missing_libraries_are_looked_up_again(self, mock_dependencies):
+        cache_file = os.path.join(os.getcwd(), 'cache.json')
+        library_path = os.path.join(os.getcwd(), 'lib', 'libfoo.so')
+        self.make_elf(library_path)
+        self.make_elf(os.path.join(self.workdir, 'linked'))
+        mock_dependencies.return_value = [library_path]
+
+        pluginhandler._find_dependencies(
+            self.workdir, ['linked'], cache_file=cache_file)
+        os.remove(library_path)
+        pluginhandler._find_dependencies(
+            self.workdir, ['linked'], cache_file=cache_file)
+
+        self.assertEqual(2, mock_dependencies.call_count)
+
+    @patch('snapcraft.internal.libraries.get_dependencies')
+    def test_changed_files_are_read_again(self, mock_dependencies):
+        cache_file = os.path.join(os.getcwd(), 'cache.json')
+        linked_elf_path = os.path.join(self.workdir, 'linked')
+        self.make_elf(linked_elf_path)
+        mock_dependencies.return_value = []
+
+        pluginhandler._find_dependencies(
+            self.workdir, ['linked'], cache_file=cache_file)
+        self.make_elf(linked_elf_path, needed=['libfoo.so'])
+        pluginhandler._find_dependencies(
+            self.workdir, ['linked'], cache_file=cache_file)
 
+        self.assertEqual(2, mock_dependencies.call_count)
+
+    @patch('snapcraft.internal.libraries.get_dependencies')
+    def test_shadowed_libraries_are_looked_up_again(self, mock_dependencies):
+        cache_file = os.path.join(os.getcwd(), 'cache.json')
+        libdir = os.path.join(os.getcwd(), 'lib')
+        otherdir = os.path.join(os.getcwd(), 'other')
+        os.makedirs(libdir)
+        self.make_elf(os.path.join(otherdir, 'libfoo.so'))
+        self.make_elf(os.path.join(self.workdir, 'linked'))
+        mock_dependencies.return_value = [
+            os.path.join(otherdir, 'libfoo.so')]
+
+        pluginhandler._find_dependencies(
+            self.workdir, ['linked'], [libdir, otherdir], cache_file)
+        self.make_elf(os.path.join(libdir, 'libfoo.so'))
+        pluginhandler._find_dependencies(
+            self.workdir, ['linked'], [libdir, otherdir], cache_file)
+
+        self.assertEqual(2, mock_dependencies.call_count)
+
+    @patch('snapcraft.internal.libraries.get_dependencies')
+    def test_unresolved_libraries_are_looked_up_again(
+            self, mock_dependencies):
+        cache_file = os.path.join(os.getcwd(), 'cache.json')
+        libdir = os.path.join(os.getcwd(), 'lib')
+        os.makedirs(libdir)
+        self.make_elf(os.path.join(self.workdir, 'linked'),
+                      needed=['libfoo.so'])
+        mock_dependencies.return_value = []
+
+        pluginhandler._find_dependencies(
+            self.workdir, ['linked'], [libdir], cache_file)
+        pluginhandler._find_dependencies(
+            self.workdir, ['linked'], [libdir], cache_file)
+        self.assertEqual(1, mock_dependencies.call_count)
+
+        self.make_elf(os.path.join(libdir, 'libfoo.so'))
+        pluginhandler._find_dependencies(
+            self.workdir, ['linked'], [libdir], cache_file)
+        self.assertEqual(2, mock_dependencies.call_count)
+
+    @patch('snapcraft.internal.libraries.get_dependencies')
+    def test_libraries_copied_into_workdir_do_not_invalidate_the_cache(
+            self, mock_dependencies):
+        cache_file = os.path.join(os.getcwd(), 'cache.json')
+        primed_libdir = os.path.join(self.workdir, 'lib')
+        system_libdir = os.path.join(os.getcwd(), 'system')
+        self.make_elf(os.path.join(system_libdir, 'libfoo.so'))
+        self.make_elf(os.path.join(self.workdir, 'linked'))
+        mock_dependencies.return_value = [
+            os.path.join(system_libdir, 'libfoo.so')]
+        library_paths = [primed_libdir, system_libdir]
+
+        pluginhandler._find_dependencies(
+            self.workdir, ['linked'], library_paths, cache_file)
+        self.make_elf(os.path.join(primed_libdir, 'libfoo.so'))
+        dependencies = pluginhandler._find_dependencies(
+            self.workdir, ['linked'], library_paths, cache_file)
+
+        self.assertEqual(1, mock_dependencies.call_count)
         self.assertEqual(
-            raised.exception.__str__(), 'Cannot load magic header detection')
+            dependencies, {os.path.join(system_libdir, 'libfoo.so')})
+
+    def test_second_prime_reuses_cached_dependencies(self):
+        handler = pluginhandler.load_plugin('test-part', 'nil')
+        handler.makedirs()
+        self.make_elf(os.path.join(handler.installdir, 'bin', 'app'),
+                      needed=['libfoo.so'])
+        self.make_elf(os.path.join(handler.installdir, 'lib', 'libfoo.so'))
+        handler.mark_done('build')
+        handler.stage()
+        patcher = patch('snapcraft.internal.libraries._get_system_libs')
+        patcher.start().return_value = frozenset()
+        self.addCleanup(patcher.stop)
+
+        with patch('snapcraft.internal.libraries.get_dependencies',
+                   wraps=libraries.get_dependencies) as mock_dependencies:
+            handler.prime()
+            call_count = mock_dependencies.call_count
+            handler.prime()
+
+        self.assertEqual(2, call_count)
+        self.assertEqual(call_count, mock_dependencies.call_count)
+        self.assertEqual({'lib'}, handler.get_state('prime').dependency_paths)
@@ -15,11 +15,16 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import fixtures
+import glob
+import hashlib
+import io
 import logging
+import multiprocessing
 import os
 import stat
+import tarfile
 import tempfile
-from unittest.mock import ANY, call, patch
+from unittest.mock import ANY, call, MagicMock, Mock, patch
 
 import snapcraft
 from snapcraft import repo
@@ -44,13 +49,16 @@ class UbuntuTestCase(tests.TestCase):
         ubuntu.get(['fake-package'])
 
         mock_apt.assert_has_calls([
-            call.apt_pkg.config.set('Dir::Cache::Archives',
-                                    os.path.join(self.tempdir, 'download')),
+            call.apt_pkg.config.set('Dir::Cache::Archives', ANY),
             call.apt_pkg.config.set('Apt::Install-Recommends', 'False'),
             call.apt_pkg.config.find_file('Dir::Etc::Trusted'),
             call.apt_pkg.config.set('Dir::Etc::Trusted', ANY),
             call.apt_pkg.config.find_file('Dir::Etc::TrustedParts'),
             call.apt_pkg.config.set('Dir::Etc::TrustedParts', ANY),
+            call.apt_pkg.config.find_file('Dir::Etc::netrc'),
+            call.apt_pkg.config.set('Dir::Etc::netrc', ANY),
+            call.apt_pkg.config.find_file('Dir::Etc::netrcparts'),
+            call.apt_pkg.config.set('Dir::Etc::netrcparts', ANY),
             call.apt_pkg.config.clear('APT::Update::Post-Invoke-Success'),
             call.progress.text.AcquireProgress(),
             call.Cache(memonly=True, rootdir=ANY),
@@ -58,14 +66,228 @@ class UbuntuTestCase(tests.TestCase):
             call.Cache(memonly=True, rootdir=self.tempdir),
             call.Cache().open(),
         ])
-        mock_apt.assert_has_calls([
-            call.Cache().fetch_archives(progress=ANY),
-        ])
 
         # __getitem__ is tricky
         self.assertIn(
             call('fake-package'), mock_apt.Cache().__getitem__.call_args_list)
 
+    def _mark_fake_package(self, mock_apt, uri, content=b'deb'):
+        version = Mock(uri=uri, size=len(content), version='1:1.0',
+                       architecture='amd64',
+                       sha256=hashlib.sha256(content).hexdigest())
+        version.package.name = 'fake-package'
+        version.priority = 'optional'
+        package = Mock(marked_delete=False, candidate=version)
+        package.name = 'fake-package'
+        mock_apt.Cache.return_value.get_changes.return_value = [package]
+        # apt is not set up with proxies or credentials.
+        mock_apt.apt_pkg.config.exists.return_value = False
+        mock_apt.apt_pkg.config.find_file.return_value = ''
+
+    @patch('snapcraft.repo.requests')
+    @patch('snapcraft.repo._get_local_sources_list')
+    @patch('snapcraft.repo.apt')
+    def test_get_downloads_packages_into_download_dir(
+            self, mock_apt, mock_sources_list, mock_requests):
+        mock_sources_list.return_value = 'deb http://archive xenial main'
+        self._mark_fake_package(mock_apt, 'http://archive/fake-package.deb')
+        mock_get = mock_requests.Session.return_value.get
+        mock_get.return_value.iter_content.return_value = [b'd', b'eb']
+
+        ubuntu = repo.Ubuntu(os.path.join(self.tempdir, 'ubuntu'))
+        ubuntu.get(['fake-package'])
+
+        mock_get.assert_called_once_with(
+            'http://archive/fake-package.deb', stream=True, timeout=ANY)
+        mock_apt.Cache().fetch_archives.assert_not_called()
+        with open(os.path.join(ubuntu.downloaddir,
+                               'fake-package_1%3a1.0_amd64.deb'), 'rb') as f:
+            self.assertEqual(b'deb', f.read())
+
+    @patch('snapcraft.repo.requests')
+    @patch('snapcraft.repo._get_local_sources_list')
+    @patch('snapcraft.repo.apt')
+    def test_cached_packages_are_not_downloaded_again(
+            self, mock_apt, mock_sources_list, mock_requests):
+        mock_sources_list.return_value = 'deb http://archive xenial main'
+        self._mark_fake_package(mock_apt, 'http://archive/fake-package.deb')
+        mock_get = mock_requests.Session.return_value.get
+        mock_get.return_value.iter_content.return_value = [b'deb']
+
+        for part in ('part1', 'part2'):
+            ubuntu = repo.Ubuntu(os.path.join(self.tempdir, part))
+            ubuntu.get(['fake-package'])
+            self.assertTrue(os.path.exists(os.path.join(
+                ubuntu.downloaddir, 'fake-package_1%3a1.0_amd64.deb')))
+
+        self.assertEqual(1, mock_get.call_count)
+
+    @patch('snapcraft.repo.requests')
+    @patch('snapcraft.repo._get_local_sources_list')
+    @patch('snapcraft.repo.apt')
+    def test_checksum_mismatch_raises(self, mock_apt, mock_sources_list,
+                                      mock_requests):
+        mock_sources_list.return_value = 'deb http://archive xenial main'
+        self._mark_fake_package(mock_apt, 'http://archive/fake-package.deb')
+        mock_get = mock_requests.Session.return_value.get
+        mock_get.return_value.iter_content.return_value = [b'bad']
+
+        ubuntu = repo.Ubuntu(os.path.join(self.tempdir, 'ubuntu'))
+        with self.assertRaises(EnvironmentError) as raised:
+            ubuntu.get(['fake-package'])
+
+        self.assertEqual(
+            "The sha256 checksum of 'http://archive/fake-package.deb' does "
+            "not match the package index", str(raised.exception))
+        self.assertFalse(os.path.exists(ubuntu.downloaddir))
+
+    @patch('snapcraft.repo._get_local_sources_list')
+    @patch('snapcraft.repo.apt')
+    def test_get_uses_apt_for_other_uris(self, mock_apt, mock_sources_list):
+        mock_sources_list.return_value = 'deb file:/archive xenial main'
+        self._mark_fake_package(mock_apt, 'file:/archive/fake-package.deb')
+        package_path = os.path.join(self.tempdir, 'fake-package.deb')
+        open(package_path, 'w').close()
+        fetched_item = Mock(destfile=package_path)
+        mock_apt.apt_pkg.Acquire.return_value.items = [fetched_item]
+
+        ubuntu = repo.Ubuntu(os.path.join(self.tempdir, 'ubuntu'))
+        ubuntu.get(['fake-package'])
+
+        mock_apt.Cache().fetch_archives.assert_called_once_with(
+            fetcher=mock_apt.apt_pkg.Acquire())
+        self.assertTrue(os.path.samefile(
+            package_path, os.path.join(ubuntu.downloaddir,
+                                       'fake-package.deb')))
+
+    @patch('snapcraft.repo._get_local_sources_list')
+    @patch('snapcraft.repo.apt')
+    def test_get_uses_apt_with_a_proxy(self, mock_apt, mock_sources_list):
+        mock_sources_list.return_value = 'deb http://archive xenial main'
+        self._mark_fake_package(mock_apt, 'http://archive/fake-package.deb')
+        mock_apt.apt_pkg.config.exists.side_effect = (
+            lambda key: key == 'Acquire::http::Proxy')
+        package_path = os.path.join(self.tempdir, 'fake-package.deb')
+        open(package_path, 'w').close()
+        fetched_item = Mock(destfile=package_path)
+        mock_apt.apt_pkg.Acquire.return_value.items = [fetched_item]
+
+        ubuntu = repo.Ubuntu(os.path.join(self.tempdir, 'ubuntu'))
+        ubuntu.get(['fake-package'])
+
+        mock_apt.Cache().fetch_archives.assert_called_once_with(
+            fetcher=mock_apt.apt_pkg.Acquire())
+
+    @patch('snapcraft.repo._get_local_sources_list')
+    @patch('snapcraft.repo.apt')
+    def test_get_uses_apt_with_credentials(self, mock_apt, mock_sources_list):
+        mock_sources_list.return_value = 'deb http://archive xenial main'
+        self._mark_fake_package(mock_apt, 'http://archive/fake-package.deb')
+        auth_conf = os.path.join(self.tempdir, 'auth.conf')
+        open(auth_conf, 'w').close()
+        mock_apt.apt_pkg.config.find_file.side_effect = (
+            lambda key: auth_conf if key == 'Dir::Etc::netrc' else '')
+        package_path = os.path.join(self.tempdir, 'fake-package.deb')
+        open(package_path, 'w').close()
+        fetched_item = Mock(destfile=package_path)
+        mock_apt.apt_pkg.Acquire.return_value.items = [fetched_item]
+
+        ubuntu = repo.Ubuntu(os.path.join(self.tempdir, 'ubuntu'))
+        ubuntu.get(['fake-package'])
+
+        mock_apt.Cache().fetch_archives.assert_called_once_with(
+            fetcher=mock_apt.apt_pkg.Acquire())
+
+    @patch('snapcraft.repo._get_local_sources_list')
+    @patch('snapcraft.repo.apt')
+    def test_shared_sessions_update_once(self, mock_apt, mock_sources_list):
+        mock_sources_list.return_value = 'deb http://archive xenial main'
+
+        with repo.shared_sessions():
+            for part in ('part1', 'part2'):
+                repo.Ubuntu(os.path.join(self.tempdir, part)).get(
+                    ['fake-package'])
+
+        self.assertEqual(1, mock_apt.Cache().update.call_count)
+        self.assertEqual(1, mock_apt.Cache().open.call_count)
+        # The marks of the first part are cleared for the second one.
+        self.assertEqual(1, mock_apt.Cache().clear.call_count)
+
+    @patch('snapcraft.repo._get_local_sources_list')
+    @patch('snapcraft.repo.apt')
+    def test_sessions_are_not_shared_by_default(self, mock_apt,
+                                                mock_sources_list):
+        mock_sources_list.return_value = 'deb http://archive xenial main'
+
+        for part in ('part1', 'part2'):
+            repo.Ubuntu(os.path.join(self.tempdir, part)).get(
+                ['fake-package'])
+
+        self.assertEqual(2, mock_apt.Cache().open.call_count)
+
+    @patch('snapcraft.repo._get_local_sources_list')
+    @patch('snapcraft.repo.apt')
+    def test_fresh_package_lists_are_not_updated(self, mock_apt,
+                                                 mock_sources_list):
+        mock_sources_list.return_value = 'deb http://archive xenial main'
+
+        for part in ('part1', 'part2'):
+            repo.Ubuntu(os.path.join(self.tempdir, part)).get(
+                ['fake-package'])
+
+        self.assertEqual(1, mock_apt.Cache().update.call_count)
+
+    @patch('snapcraft.repo._get_local_sources_list')
+    @patch('snapcraft.repo.apt')
+    def test_package_lists_are_updated_when_ttl_is_zero(self, mock_apt,
+                                                        mock_sources_list):
+        self.useFixture(fixtures.EnvironmentVariable(
+            'SNAPCRAFT_APT_CACHE_TTL', '0'))
+        mock_sources_list.return_value = 'deb http://archive xenial main'
+
+        for part in ('part1', 'part2'):
+            repo.Ubuntu(os.path.join(self.tempdir, part)).get(
+                ['fake-package'])
+
+        self.assertEqual(2, mock_apt.Cache().update.call_count)
+
+    @patch('snapcraft.repo._get_local_sources_list')
+    @patch('snapcraft.repo.apt')
+    def test_invalid_ttl_raises(self, mock_apt, mock_sources_list):
+        self.useFixture(fixtures.EnvironmentVariable(
+            'SNAPCRAFT_APT_CACHE_TTL', 'soon'))
+        mock_sources_list.return_value = 'deb http://archive xenial main'
+
+        ubuntu = repo.Ubuntu(self.tempdir)
+        with self.assertRaises(EnvironmentError) as raised:
+            ubuntu.get(['fake-package'])
+
+        self.assertEqual(
+            "SNAPCRAFT_APT_CACHE_TTL must be a number of seconds, not 'soon'",
+            str(raised.exception))
+
+    def test_get_only_looks_at_changes(self):
+        packages = {}
+        for name, priority in [('fake-package', 'optional'),
+                               ('fake-dependency', 'optional'),
+                               ('adduser', 'important'),
+                               ('fake-essential', '')]:
+            package = Mock(candidate=Mock(priority=priority))
+            package.name = name
+            packages[name] = package
+        apt_cache = MagicMock()
+        apt_cache.__getitem__.side_effect = packages.__getitem__
+        apt_cache.get_changes.return_value = list(packages.values())
+
+        repo.Ubuntu(self.tempdir)._get(apt_cache, ['fake-package'])
+
+        apt_cache.__iter__.assert_not_called()
+        packages['fake-package'].mark_install.assert_called_once_with()
+        for name in ('fake-package', 'fake-dependency'):
+            packages[name].mark_keep.assert_not_called()
+        for name in ('adduser', 'fake-essential'):
+            packages[name].mark_keep.assert_called_once_with()
+
     @patch('snapcraft.repo._get_geoip_country_code_prefix')
     def test_sources_is_none_uses_default(self, mock_cc):
         mock_cc.return_value = 'ar'
@@ -146,23 +368,248 @@ deb http://ports.ubuntu.com/ubuntu-ports trusty-security multiverse
         self.assertEqual(sources_list, expected_sources_list)
         self.assertFalse(mock_cc.called)
 
+
+def _make_deb(path, entries, compression='xz'):
+    """Write a Debian package with entries as its data.
+
+    :param entries: (name, type, content, mode) tuples, where content is
+                    the target of links and the data of regular files.
+    """
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w:' + compression) as tar:
+        for name, type, content, mode in entries:
+            info = tarfile.TarInfo('./' + name)
+            info.type = type
+            info.mode = mode
+            info.mtime = 1000000000
+            if type in (tarfile.SYMTYPE, tarfile.LNKTYPE):
+                info.linkname = content
+                tar.addfile(info)
+            elif type == tarfile.REGTYPE:
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+            else:
+                tar.addfile(info)
+
+    control = io.BytesIO()
+    with tarfile.open(fileobj=control, mode='w:gz'):
+        pass
+
+    with open(path, 'wb') as f:
+        f.write(b'!<arch>\n')
+        for name, member in [('debian-binary', b'2.0\n'),
+                             ('control.tar.gz', control.getvalue()),
+                             ('data.tar.' + compression, data.getvalue())]:
+            f.write('{:<16}{:<12}{:<6}{:<6}{:<8}{:<10}`\n'.format(
+                name, 0, 0, 0, 100644, len(member)).encode())
+            f.write(member)
+            if len(member) % 2:
+                f.write(b'\n')
+
+
+def _unpack(rootdir, destination):
+    repo.Ubuntu(rootdir).unpack(destination)
+
+
+class UnpackTestCase(tests.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.ubuntu = repo.Ubuntu('ubuntu')
+        os.makedirs(self.ubuntu.downloaddir)
+        self.rootdir = os.path.abspath('root')
+
+    def make_deb(self, name, entries, **kwargs):
+        _make_deb(os.path.join(self.ubuntu.downloaddir, name + '.deb'),
+                  entries, **kwargs)
+
+    def test_unpack_extracts_packages(self):
+        self.make_deb('one', [
+            ('usr', tarfile.DIRTYPE, None, 0o755),
+            ('usr/bin', tarfile.DIRTYPE, None, 0o755),
+            ('usr/bin/one', tarfile.REGTYPE, b'1', 0o755),
+            ('usr/bin/link', tarfile.LNKTYPE, './usr/bin/one', 0o755),
+        ])
+        self.make_deb('two', [
+            ('usr', tarfile.DIRTYPE, None, 0o755),
+            ('usr/share', tarfile.DIRTYPE, None, 0o755),
+            ('usr/share/two', tarfile.REGTYPE, b'2', 0o644),
+        ], compression='gz')
+
+        self.ubuntu.unpack(self.rootdir)
+
+        one = os.path.join(self.rootdir, 'usr', 'bin', 'one')
+        with open(one) as f:
+            self.assertEqual('1', f.read())
+        self.assertEqual(0o755, stat.S_IMODE(os.stat(one).st_mode))
+        self.assertEqual(1000000000, os.stat(one).st_mtime)
+        self.assertTrue(os.path.samefile(
+            one, os.path.join(self.rootdir, 'usr', 'bin', 'link')))
+        with open(os.path.join(self.rootdir, 'usr', 'share', 'two')) as f:
+            self.assertEqual('2', f.read())
+
+    def test_unpack_in_a_pool_worker(self):
+        for name in ('one', 'two'):
+            self.make_deb(name, [
+                (name, tarfile.REGTYPE, name.encode(), 0o644),
+            ])
+
+        # Pool workers are daemonic processes, which can't have children.
+        with multiprocessing.get_context('fork').Pool(1) as pool:
+            pool.apply(_unpack, ('ubuntu', self.rootdir))
+
+        for name in ('one', 'two'):
+            with open(os.path.join(self.rootdir, name)) as f:
+                self.assertEqual(name, f.read())
+
+    def test_unpack_copies_packages_from_cache(self):
+        self.make_deb('one', [
+            ('usr', tarfile.DIRTYPE, None, 0o755),
+            ('usr/lib', tarfile.DIRTYPE, None, 0o755),
+            ('usr/lib/libone.so', tarfile.REGTYPE, b'1', 0o644),
+            ('usr/lib/one.pc', tarfile.REGTYPE, b'prefix=/usr\n', 0o644),
+        ])
+
+        with patch('snapcraft.repo._extract_deb',
+                   wraps=repo._extract_deb) as mock_extract:
+            for rootdir in ('root1', 'root2'):
+                self.ubuntu.unpack(os.path.abspath(rootdir))
+
+        self.assertEqual(1, mock_extract.call_count)
+        self.assertFalse(os.path.samefile(
+            os.path.join('root1', 'usr', 'lib', 'libone.so'),
+            os.path.join('root2', 'usr', 'lib', 'libone.so')))
+        for rootdir in ('root1', 'root2'):
+            with open(os.path.join(rootdir, 'usr', 'lib', 'one.pc')) as f:
+                self.assertEqual(
+                    'prefix={}/usr\n'.format(os.path.abspath(rootdir)),
+                    f.read())
+
+    def test_unpack_modifying_a_part_leaves_the_cache_alone(self):
+        self.make_deb('one', [
+            ('libone.so', tarfile.REGTYPE, b'1', 0o644),
+        ])
+        self.ubuntu.unpack(os.path.abspath('root1'))
+        with open(os.path.join('root1', 'libone.so'), 'w') as f:
+            f.write('modified')
+
+        with patch('snapcraft.repo._extract_deb',
+                   wraps=repo._extract_deb) as mock_extract:
+            self.ubuntu.unpack(os.path.abspath('root2'))
+
+        mock_extract.assert_not_called()
+        with open(os.path.join('root2', 'libone.so')) as f:
+            self.assertEqual('1', f.read())
+
+    def test_unpack_extracts_modified_packages_again(self):
+        self.make_deb('one', [
+            ('libone.so', tarfile.REGTYPE, b'1', 0o644),
+        ])
+        self.ubuntu.unpack(os.path.abspath('root1'))
+        cached, = glob.glob(os.path.join(
+            self.ubuntu._extracted_debs_dir, 'one.*', 'tree', 'libone.so'))
+        with open(cached, 'w') as f:
+            f.write('modified')
+
+        self.ubuntu.unpack(os.path.abspath('root2'))
+
+        with open(os.path.join('root2', 'libone.so')) as f:
+            self.assertEqual('1', f.read())
+
+    def test_unpack_evicts_unused_packages_from_cache(self):
+        self.useFixture(fixtures.EnvironmentVariable(
+            'SNAPCRAFT_EXTRACTED_DEBS_CACHE_SIZE', '0'))
+        self.make_deb('one', [
+            ('one', tarfile.REGTYPE, b'1', 0o644),
+        ])
+        self.ubuntu.unpack(os.path.abspath('root1'))
+        os.remove(os.path.join(self.ubuntu.downloaddir, 'one.deb'))
+        self.make_deb('two', [
+            ('two', tarfile.REGTYPE, b'2', 0o644),
+        ])
+
+        self.ubuntu.unpack(os.path.abspath('root2'))
+
+        self.assertEqual(
+            ['two.{}'.format(repo._EXTRACTED_DEB_VERSION)],
+            os.listdir(self.ubuntu._extracted_debs_dir))
+
+    def test_unpack_uses_dpkg_deb_for_other_compressions(self):
+        self.make_deb('one', [
+            ('one', tarfile.REGTYPE, b'1', 0o644),
+        ])
+
+        with patch('snapcraft.repo._TARFILE_DATA_MEMBERS', ()):
+            self.ubuntu.unpack(self.rootdir)
+
+        with open(os.path.join(self.rootdir, 'one')) as f:
+            self.assertEqual('1', f.read())
+
+    def test_unpack_invalid_package_raises(self):
+        with open(os.path.join(self.ubuntu.downloaddir, 'bad.deb'),
+                  'w') as f:
+            f.write('not a package')
+
+        with self.assertRaises(repo.UnpackError) as raised:
+            self.ubuntu.unpack(self.rootdir)
+
+        self.assertEqual(
+            os.path.join(self.ubuntu.downloaddir, 'bad.deb'),
+            raised.exception.package_name)
+
+    def test_unpack_members_outside_rootdir_raises(self):
+        self.make_deb('bad', [
+            ('../outside', tarfile.REGTYPE, b'', 0o644),
+        ])
+
+        self.assertRaises(repo.UnpackError, self.ubuntu.unpack, self.rootdir)
+        self.assertFalse(os.path.exists('outside'))
+
+    def test_unpack_hard_links_outside_rootdir_raises(self):
+        open('outside', 'w').close()
+        self.make_deb('bad', [
+            ('inside', tarfile.LNKTYPE, '../../../../outside', 0o644),
+        ])
+
+        self.assertRaises(repo.UnpackError, self.ubuntu.unpack, self.rootdir)
+        self.assertEqual(1, os.stat('outside').st_nlink)
+
     def test_fix_symlinks(self):
-        os.makedirs(self.tempdir + '/a')
-        open(self.tempdir + '/1', mode='w').close()
+        self.make_deb('links', [
+            ('a', tarfile.DIRTYPE, None, 0o755),
+            ('1', tarfile.REGTYPE, b'', 0o644),
+            ('rel-to-a', tarfile.SYMTYPE, 'a', 0o777),
+            ('abs-to-a', tarfile.SYMTYPE, '/a', 0o777),
+            ('abs-to-b', tarfile.SYMTYPE, '/b', 0o777),
+            ('rel-to-1', tarfile.SYMTYPE, '1', 0o777),
+            ('abs-to-1', tarfile.SYMTYPE, '/1', 0o777),
+        ])
 
-        os.symlink('a', self.tempdir + '/rel-to-a')
-        os.symlink('/a', self.tempdir + '/abs-to-a')
-        os.symlink('/b', self.tempdir + '/abs-to-b')
-        os.symlink('1', self.tempdir + '/rel-to-1')
-        os.symlink('/1', self.tempdir + '/abs-to-1')
+        self.ubuntu.unpack(self.rootdir)
 
-        repo._fix_artifacts(debdir=self.tempdir)
+        self.assertEqual(os.readlink(self.rootdir + '/rel-to-a'), 'a')
+        self.assertEqual(os.readlink(self.rootdir + '/abs-to-a'), 'a')
+        self.assertEqual(os.readlink(self.rootdir + '/abs-to-b'), '/b')
+        self.assertEqual(os.readlink(self.rootdir + '/rel-to-1'), '1')
+        self.assertEqual(os.readlink(self.rootdir + '/abs-to-1'), '1')
 
-        self.assertEqual(os.readlink(self.tempdir + '/rel-to-a'), 'a')
-        self.assertEqual(os.readlink(self.tempdir + '/abs-to-a'), 'a')
-        self.assertEqual(os.readlink(self.tempdir + '/abs-to-b'), '/b')
-        self.assertEqual(os.readlink(self.tempdir + '/rel-to-1'), '1')
-        self.assertEqual(os.readlink(self.tempdir + '/abs-to-1'), '1')
+    def test_fix_symlinks_to_other_packages(self):
+        self.make_deb('links', [
+            ('lib', tarfile.DIRTYPE, None, 0o755),
+            ('lib/libfoo.so', tarfile.SYMTYPE, '/usr/lib/libfoo.so.1',
+             0o777),
+        ])
+        self.make_deb('libs', [
+            ('usr', tarfile.DIRTYPE, None, 0o755),
+            ('usr/lib', tarfile.DIRTYPE, None, 0o755),
+            ('usr/lib/libfoo.so.1', tarfile.REGTYPE, b'', 0o644),
+        ])
+
+        self.ubuntu.unpack(self.rootdir)
+
+        self.assertEqual(
+            os.readlink(os.path.join(self.rootdir, 'lib', 'libfoo.so')),
+            '../usr/lib/libfoo.so.1')
 
     def test_fix_suid(self):
         files = {
@@ -171,36 +618,35 @@ deb http://ports.ubuntu.com/ubuntu-ports trusty-security multiverse
             'suid_guid_file': (0o6744, 0o0744),
             'suid_guid_sticky_file': (0o7744, 0o1744),
         }
+        self.make_deb('suid', [(key, tarfile.REGTYPE, b'', modes[0])
+                               for key, modes in files.items()])
+
+        self.ubuntu.unpack(self.rootdir)
 
         for key in files:
             with self.subTest(key=key):
-                file = os.path.join(self.tempdir, key)
-                open(file, mode='w').close()
-                os.chmod(file, files[key][0])
-
-                repo._fix_artifacts(debdir=self.tempdir)
+                file = os.path.join(self.rootdir, key)
                 self.assertEqual(
                     stat.S_IMODE(os.stat(file).st_mode), files[key][1])
 
     def test_fix_pkg_config(self):
-        pc_file = os.path.join(self.tempdir, 'granite.pc')
-
-        with open(pc_file, 'w') as f:
-            f.write('prefix=/usr\n')
-            f.write('exec_prefix=${prefix}\n')
-            f.write('libdir=${prefix}/lib\n')
-            f.write('includedir=${prefix}/include\n')
-            f.write('\n')
-            f.write('Name: granite\n')
-            f.write('Description: elementary\'s Application Framework\n')
-            f.write('Version: 0.4\n')
-            f.write('Libs: -L${libdir} -lgranite\n')
-            f.write('Cflags: -I${includedir}/granite\n')
-            f.write('Requires: cairo gee-0.8 glib-2.0 gio-unix-2.0 '
-                    'gobject-2.0\n')
-        repo._fix_artifacts(debdir=self.tempdir)
-
-        with open(pc_file) as f:
+        self.make_deb('granite', [('granite.pc', tarfile.REGTYPE, b"""\
+prefix=/usr
+exec_prefix=${prefix}
+libdir=${prefix}/lib
+includedir=${prefix}/include
+
+Name: granite
+Description: elementary's Application Framework
+Version: 0.4
+Libs: -L${libdir} -lgranite
+Cflags: -I${includedir}/granite
+Requires: cairo gee-0.8 glib-2.0 gio-unix-2.0 gobject-2.0
+""", 0o644)])
+
+        self.ubuntu.unpack(self.rootdir)
+
+        with open(os.path.join(self.rootdir, 'granite.pc')) as f:
             pc_file_content = f.read()
         expected_pc_file_content = """prefix={}/usr
 exec_prefix=${{prefix}}
@@ -213,55 +659,69 @@ Version: 0.4
 Libs: -L${{libdir}} -lgranite
 Cflags: -I${{includedir}}/granite
 Requires: cairo gee-0.8 glib-2.0 gio-unix-2.0 gobject-2.0
-""".format(self.tempdir)
+""".format(self.rootdir)
 
         self.assertEqual(pc_file_content, expected_pc_file_content)
 
-    def test_fix_shebang(self):
-        rootdir = 'root'
+    def test_fix_xml_tools(self):
+        self.make_deb('xml', [
+            ('usr/bin/xml2-config', tarfile.REGTYPE,
+             b'prefix=/usr\nexec_prefix=/usr prefix=/usr\n', 0o755),
+            ('usr/bin/other-config', tarfile.REGTYPE,
+             b'prefix=/usr\n', 0o755),
+        ])
+
+        self.ubuntu.unpack(self.rootdir)
 
+        with open(os.path.join(self.rootdir, 'usr/bin/xml2-config')) as f:
+            self.assertEqual(
+                'prefix={0}/usr\nexec_prefix={0}/usr prefix=/usr\n'.format(
+                    self.rootdir), f.read())
+        with open(os.path.join(self.rootdir, 'usr/bin/other-config')) as f:
+            self.assertEqual('prefix=/usr\n', f.read())
+
+    def test_fix_shebang(self):
         files = [
             {
-                'path': os.path.join(rootdir, 'bin', 'a'),
+                'path': os.path.join('bin', 'a'),
                 'content': '#!/usr/bin/python\nimport this',
                 'expected': '#!/usr/bin/env python\nimport this',
             },
             {
-                'path': os.path.join(rootdir, 'sbin', 'b'),
+                'path': os.path.join('sbin', 'b'),
                 'content': '#!/usr/bin/python\nimport this',
                 'expected': '#!/usr/bin/env python\nimport this',
             },
             {
-                'path': os.path.join(rootdir, 'usr', 'bin', 'c'),
+                'path': os.path.join('usr', 'bin', 'c'),
                 'content': '#!/usr/bin/python\nimport this',
                 'expected': '#!/usr/bin/env python\nimport this',
             },
             {
-                'path': os.path.join(rootdir, 'usr', 'sbin', 'd'),
+                'path': os.path.join('usr', 'sbin', 'd'),
                 'content': '#!/usr/bin/python\nimport this',
                 'expected': '#!/usr/bin/env python\nimport this',
             },
             {
-                'path': os.path.join(rootdir, 'opt', 'bin', 'e'),
+                'path': os.path.join('opt', 'bin', 'e'),
                 'content': '#!/usr/bin/python\nraise Exception()',
                 'expected': '#!/usr/bin/python\nraise Exception()',
             },
             {
-                'path': os.path.join(rootdir, 'bin', 'd'),
+                'path': os.path.join('bin', 'd'),
                 'content': '#!/usr/bin/python3\nraise Exception()',
                 'expected': '#!/usr/bin/python3\nraise Exception()',
             },
         ]
+        self.make_deb('scripts', [
+            (f['path'], tarfile.REGTYPE, f['content'].encode(), 0o755)
+            for f in files])
+
+        self.ubuntu.unpack(self.rootdir)
 
         for f in files:
             with self.subTest(key=f['path']):
-                os.makedirs(os.path.dirname(f['path']), exist_ok=True)
-                with open(f['path'], 'w') as fd:
-                    fd.write(f['content'])
-
-                repo._fix_shebangs(rootdir)
-
-                with open(f['path'], 'r') as fd:
+                with open(os.path.join(self.rootdir, f['path'])) as fd:
                     self.assertEqual(fd.read(), f['expected'])
 
 
@@ -275,3 +735,51 @@ class BuildPackagesTestCase(tests.TestCase):
             "Could not find a required package in 'build-packages': "
             '"The cache has no package named \'package-does-not-exist\'"',
             str(raised.exception))
+
+    def write_dpkg_status(self, stanzas):
+        status_file = os.path.join(self.path, 'status')
+        with open(status_file, 'w') as f:
+            for package, architecture, status in stanzas:
+                f.write('Package: {}\nStatus: {}\nPriority: optional\n'
+                        'Architecture: {}\nVersion: 1.0\n\n'.format(
+                            package, status, architecture))
+        patcher = patch('snapcraft.repo._DPKG_STATUS', status_file)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch('snapcraft.repo.apt')
+    def test_installed_packages_skip_apt(self, mock_apt):
+        mock_apt.apt_pkg.config.find.return_value = 'amd64'
+        self.write_dpkg_status([
+            ('native', 'amd64', 'install ok installed'),
+            ('arch-independent', 'all', 'hold ok installed'),
+            ('foreign', 'i386', 'install ok installed'),
+        ])
+
+        repo.install_build_packages(
+            ['native', 'arch-independent', 'foreign:i386'])
+
+        mock_apt.Cache.assert_not_called()
+
+    @patch('subprocess.check_call')
+    @patch('snapcraft.repo.apt')
+    def test_missing_packages_use_apt(self, mock_apt, mock_check_call):
+        mock_apt.apt_pkg.config.find.return_value = 'amd64'
+        self.write_dpkg_status([
+            ('native', 'amd64', 'install ok installed'),
+            ('foreign', 'i386', 'install ok installed'),
+            ('removed', 'amd64', 'deinstall ok config-files'),
+        ])
+        mock_apt.Cache.return_value.__enter__.return_value.__getitem__\
+            .return_value.installed = None
+
+        repo.install_build_packages(['native', 'foreign', 'removed'])
+
+        mock_apt.Cache.assert_called_once_with()
+        self.assertEqual(
+            ['sudo', 'apt-get', '-o', 'Dpkg::Progress-Fancy=1',
+             '--no-install-recommends', '-y', 'install'],
+            mock_check_call.call_args[0][0][:7])
+        self.assertCountEqual(
+            ['native', 'foreign', 'removed'],
+            mock_check_call.call_args[0][0][7:])
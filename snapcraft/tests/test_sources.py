@@ -14,8 +14,14 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import glob
+import hashlib
+import io
 import os
 import http.server
+import shutil
+import subprocess
+import tarfile
 import threading
 import unittest.mock
 
@@ -40,14 +46,59 @@ class FakeTarballHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
         pass
 
 
+def _make_tarball(entries, compression='gz'):
+    tarball = io.BytesIO()
+    with tarfile.open(fileobj=tarball, mode='w:' + compression) as tar:
+        for name in entries:
+            info = tarfile.TarInfo(name)
+            if name.endswith('/'):
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                tar.addfile(info)
+            else:
+                info.size = len(name)
+                info.mode = 0o444
+                tar.addfile(info, io.BytesIO(name.encode()))
+
+    return tarball.getvalue()
+
+
+class TarballHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    data = _make_tarball(['root/', 'root/a', 'root/dir/', 'root/dir/b'])
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', len(self.data))
+        self.send_header('Content-type', 'application/x-tar')
+        self.end_headers()
+        self.wfile.write(self.data)
+
+    def log_message(self, *args):
+        # Overwritten so the test does not write to stderr.
+        pass
+
+
 class TestTar(tests.TestCase):
 
-    @unittest.mock.patch('snapcraft.sources.Tar.provision')
-    def test_pull_tarball_must_download_to_sourcedir(self, mock_prov):
+    def assert_tree(self, expected, path):
+        found = []
+        for root, directories, files in os.walk(path):
+            for name in directories:
+                found.append(os.path.relpath(os.path.join(root, name),
+                                             path) + '/')
+            for name in files:
+                found.append(os.path.relpath(os.path.join(root, name), path))
+
+        self.assertCountEqual(expected, found)
+
+    def test_pull_tarball_extracts_while_downloading(self):
         self.useFixture(fixtures.EnvironmentVariable(
             'no_proxy', 'localhost,127.0.0.1'))
+        self.useFixture(fixtures.EnvironmentVariable(
+            'SNAPCRAFT_DOWNLOAD_CACHE_SIZE', '0'))
         server = http.server.HTTPServer(
-            ('127.0.0.1', 0), FakeTarballHTTPRequestHandler)
+            ('127.0.0.1', 0), TarballHTTPRequestHandler)
         server_thread = threading.Thread(target=server.serve_forever)
         self.addCleanup(server_thread.join)
         self.addCleanup(server.server_close)
@@ -57,6 +108,7 @@ class TestTar(tests.TestCase):
         plugin_name = 'test_plugin'
         dest_dir = os.path.join('parts', plugin_name, 'src')
         os.makedirs(dest_dir)
+        open(os.path.join(dest_dir, 'stale'), 'w').close()
         tar_file_name = 'test.tar'
         source = 'http://{}:{}/{file_name}'.format(
             *server.server_address, file_name=tar_file_name)
@@ -64,9 +116,110 @@ class TestTar(tests.TestCase):
 
         tar_source.pull()
 
-        mock_prov.assert_called_once_with(dest_dir)
-        with open(os.path.join(dest_dir, tar_file_name), 'r') as tar_file:
-            self.assertEqual('Test fake compressed file', tar_file.read())
+        self.assert_tree(['a', 'dir/', 'dir/b'], dest_dir)
+        with open(os.path.join(dest_dir, 'dir', 'b')) as f:
+            self.assertEqual('root/dir/b', f.read())
+        self.assertEqual(['parts'], os.listdir())
+
+    def test_pull_local_tarball(self):
+        os.makedirs('src')
+        with open('test.tar.gz', 'wb') as f:
+            f.write(_make_tarball(['./root/', './root/a']))
+
+        sources.Tar('test.tar.gz', 'src').pull()
+
+        self.assert_tree(['a'], 'src')
+        self.assertTrue(os.path.exists('test.tar.gz'))
+
+    def test_pull_tarball_with_checksum(self):
+        self.useFixture(fixtures.EnvironmentVariable(
+            'no_proxy', 'localhost,127.0.0.1'))
+        server = http.server.HTTPServer(
+            ('127.0.0.1', 0), TarballHTTPRequestHandler)
+        server_thread = threading.Thread(target=server.serve_forever)
+        self.addCleanup(server_thread.join)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        server_thread.start()
+        source = 'http://{}:{}/test.tar'.format(*server.server_address)
+        checksum = 'sha256/' + hashlib.sha256(
+            TarballHTTPRequestHandler.data).hexdigest()
+        os.makedirs('src')
+
+        sources.Tar(source, 'src', source_checksum=checksum).pull()
+        # The second pull is served from the download cache.
+        server.shutdown()
+        shutil.rmtree('src')
+        os.makedirs('src')
+        sources.Tar(source, 'src', source_checksum=checksum).pull()
+
+        self.assert_tree(['a', 'dir/', 'dir/b'], 'src')
+
+    def test_pull_tarball_with_wrong_checksum_leaves_source_dir(self):
+        os.makedirs('src')
+        open(os.path.join('src', 'existing'), 'w').close()
+        with open('test.tar.gz', 'wb') as f:
+            f.write(_make_tarball(['root/', 'root/a']))
+        tar_source = sources.Tar('test.tar.gz', 'src',
+                                 source_checksum='md5/1234')
+
+        with self.assertRaises(EnvironmentError) as raised:
+            tar_source.pull()
+
+        self.assertIn('The md5 checksum of ', str(raised.exception))
+        self.assert_tree(['existing'], 'src')
+
+    def test_pull_without_common_dir(self):
+        os.makedirs('src')
+        with open('test.tar.gz', 'wb') as f:
+            f.write(_make_tarball(['root/a', 'other/b']))
+
+        sources.Tar('test.tar.gz', 'src').pull()
+
+        self.assert_tree(['root/', 'root/a', 'other/', 'other/b'], 'src')
+
+    def test_pull_strips_common_dir_not_prefix(self):
+        os.makedirs('src')
+        with open('test.tar.gz', 'wb') as f:
+            f.write(_make_tarball(['d/ab', 'd/abc']))
+
+        sources.Tar('test.tar.gz', 'src').pull()
+
+        self.assert_tree(['ab', 'abc'], 'src')
+
+    def test_pull_single_file(self):
+        os.makedirs('src')
+        with open('test.tar.gz', 'wb') as f:
+            f.write(_make_tarball(['a']))
+
+        sources.Tar('test.tar.gz', 'src').pull()
+
+        self.assert_tree(['a'], 'src')
+
+    def test_provision_on_top_and_keep_tarball(self):
+        os.makedirs(os.path.join('src', 'dir'))
+        open(os.path.join('src', 'dir', 'existing'), 'w').close()
+        with open(os.path.join('src', 'test.tar.gz'), 'wb') as f:
+            f.write(_make_tarball(['root/', 'root/dir/', 'root/dir/b']))
+        tar_source = sources.Tar('http://test/test.tar.gz', 'src')
+
+        tar_source.provision('src', clean_target=False, keep_tarball=True)
+
+        self.assert_tree(['test.tar.gz', 'dir/', 'dir/existing', 'dir/b'],
+                         'src')
+        # Files are made writable.
+        self.assertTrue(os.access(os.path.join('src', 'dir', 'b'), os.W_OK))
+
+    def test_provision_cleans_target(self):
+        os.makedirs(os.path.join('src', 'dir'))
+        open(os.path.join('src', 'dir', 'existing'), 'w').close()
+        with open(os.path.join('src', 'test.tar.gz'), 'wb') as f:
+            f.write(_make_tarball(['root/', 'root/dir/', 'root/dir/b']))
+        tar_source = sources.Tar('http://test/test.tar.gz', 'src')
+
+        tar_source.provision('src')
+
+        self.assert_tree(['dir/', 'dir/b'], 'src')
 
 
 class TestZip(tests.TestCase):
@@ -177,14 +330,20 @@ class TestBazaar(SourceTestCase):
 
 class TestGit(SourceTestCase):
 
+    def setUp(self):
+        super().setUp()
+
+        self.useFixture(fixtures.EnvironmentVariable(
+            'SNAPCRAFT_GIT_CACHE_SIZE', '0'))
+
     def test_pull(self):
         git = sources.Git('git://my-source', 'source_dir')
 
         git.pull()
 
         self.mock_run.assert_called_once_with(
-            ['git', 'clone', '--depth', '1', '--recursive', 'git://my-source',
-             'source_dir'])
+            ['git', '-c', 'submodule.fetchJobs=8', 'clone', '--depth', '1',
+             '--recursive', 'git://my-source', 'source_dir'])
 
     def test_pull_branch(self):
         git = sources.Git('git://my-source', 'source_dir',
@@ -192,16 +351,18 @@ class TestGit(SourceTestCase):
         git.pull()
 
         self.mock_run.assert_called_once_with(
-            ['git', 'clone', '--depth', '1', '--recursive', '--branch',
-             'my-branch', 'git://my-source', 'source_dir'])
+            ['git', '-c', 'submodule.fetchJobs=8', 'clone', '--depth', '1',
+             '--recursive', '--branch', 'my-branch', 'git://my-source',
+             'source_dir'])
 
     def test_pull_tag(self):
         git = sources.Git('git://my-source', 'source_dir', source_tag='tag')
         git.pull()
 
         self.mock_run.assert_called_once_with(
-            ['git', 'clone', '--depth', '1', '--recursive', '--branch', 'tag',
-             'git://my-source', 'source_dir'])
+            ['git', '-c', 'submodule.fetchJobs=8', 'clone', '--depth', '1',
+             '--recursive', '--branch', 'tag', 'git://my-source',
+             'source_dir'])
 
     def test_pull_existing(self):
         self.mock_path_exists.return_value = True
@@ -213,8 +374,8 @@ class TestGit(SourceTestCase):
             unittest.mock.call(['git', '-C', 'source_dir', 'pull',
                                 '--recurse-submodules=yes', 'git://my-source',
                                 'HEAD']),
-            unittest.mock.call(['git', '-C', 'source_dir', 'submodule',
-                                'update'])
+            unittest.mock.call(['git', '-c', 'submodule.fetchJobs=8', '-C',
+                                'source_dir', 'submodule', 'update'])
         ])
 
     def test_pull_existing_with_tag(self):
@@ -227,8 +388,8 @@ class TestGit(SourceTestCase):
             unittest.mock.call(['git', '-C', 'source_dir', 'pull',
                                 '--recurse-submodules=yes', 'git://my-source',
                                 'refs/tags/tag']),
-            unittest.mock.call(['git', '-C', 'source_dir', 'submodule',
-                                'update'])
+            unittest.mock.call(['git', '-c', 'submodule.fetchJobs=8', '-C',
+                                'source_dir', 'submodule', 'update'])
         ])
 
     def test_pull_existing_with_branch(self):
@@ -242,8 +403,8 @@ class TestGit(SourceTestCase):
             unittest.mock.call(['git', '-C', 'source_dir', 'pull',
                                 '--recurse-submodules=yes', 'git://my-source',
                                 'refs/heads/my-branch']),
-            unittest.mock.call(['git', '-C', 'source_dir', 'submodule',
-                                'update'])
+            unittest.mock.call(['git', '-c', 'submodule.fetchJobs=8', '-C',
+                                'source_dir', 'submodule', 'update'])
         ])
 
     def test_init_with_source_branch_and_tag_raises_exception(self):
@@ -255,6 +416,124 @@ class TestGit(SourceTestCase):
             'can\'t specify both source-tag and source-branch for a git source'
         self.assertEqual(raised.exception.message, expected_message)
 
+    def test_init_with_source_commit_and_tag_raises_exception(self):
+        with self.assertRaises(sources.IncompatibleOptionsError) as raised:
+            sources.Git('git://mysource', 'source_dir',
+                        source_tag='tag', source_commit='1234')
+
+        self.assertEqual(
+            "can't specify both source-commit and source-tag for a git "
+            "source", raised.exception.message)
+
+
+class TestGitMirror(tests.TestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        for variable in ('GIT_AUTHOR_NAME', 'GIT_COMMITTER_NAME'):
+            self.useFixture(fixtures.EnvironmentVariable(variable, 'test'))
+        for variable in ('GIT_AUTHOR_EMAIL', 'GIT_COMMITTER_EMAIL'):
+            self.useFixture(fixtures.EnvironmentVariable(
+                variable, 'test@example.com'))
+        self.useFixture(fixtures.EnvironmentVariable(
+            'SNAPCRAFT_GIT_CACHE_SIZE', '100'))
+
+        subprocess.check_call(['git', 'init', '--quiet', 'remote'])
+        self.commit('first')
+        self.git('tag', 'first')
+        self.source = 'file://' + os.path.abspath('remote')
+
+    def git(self, *args, repository='remote'):
+        return subprocess.check_output(
+            ['git', '-C', repository] + list(args)).decode().strip()
+
+    def commit(self, content):
+        with open(os.path.join('remote', 'file'), 'w') as f:
+            f.write(content)
+        self.git('add', 'file')
+        self.git('commit', '--quiet', '-m', content)
+
+    def assert_content(self, content, source_dir):
+        with open(os.path.join(source_dir, 'file')) as f:
+            self.assertEqual(content, f.read())
+
+    def test_clone_from_mirror(self):
+        sources.Git(self.source, 'src').pull()
+
+        self.assert_content('first', 'src')
+        self.assertEqual(self.source, self.git(
+            'remote', 'get-url', 'origin', repository='src'))
+        self.assertEqual(1, len(glob.glob(
+            os.path.join(self.path, '.cache', 'snapcraft', 'git', '*'))))
+
+    def test_tag_in_mirror_is_fetched_locally(self):
+        sources.Git(self.source, 'src').pull()
+        os.rename('remote', 'gone')
+
+        sources.Git(self.source, 'other', source_tag='first').pull()
+
+        self.assert_content('first', 'other')
+
+    def test_pull_existing_updates_the_mirror(self):
+        sources.Git(self.source, 'src').pull()
+        self.commit('second')
+
+        sources.Git(self.source, 'src').pull()
+
+        self.assert_content('second', 'src')
+
+    def test_pull_commit(self):
+        commit = self.git('rev-parse', 'HEAD')
+        self.commit('second')
+
+        sources.Git(self.source, 'src', source_commit=commit).pull()
+
+        self.assert_content('first', 'src')
+        self.assertEqual(commit, self.git('rev-parse', 'HEAD',
+                                          repository='src'))
+
+    def test_pull_commit_into_existing_checkout(self):
+        sources.Git(self.source, 'src').pull()
+        self.commit('second')
+        commit = self.git('rev-parse', 'HEAD')
+
+        sources.Git(self.source, 'src', source_commit=commit).pull()
+
+        self.assert_content('second', 'src')
+
+    def test_pull_commit_without_mirror(self):
+        self.useFixture(fixtures.EnvironmentVariable(
+            'SNAPCRAFT_GIT_CACHE_SIZE', None))
+        first = self.git('rev-parse', 'HEAD')
+        self.commit('second')
+        second = self.git('rev-parse', 'HEAD')
+
+        sources.Git(self.source, 'src', source_commit=first).pull()
+        self.assert_content('first', 'src')
+        sources.Git(self.source, 'src', source_commit=second).pull()
+
+        self.assert_content('second', 'src')
+        # Only the commit that was asked for is fetched.
+        self.assertEqual('1', self.git('rev-list', '--count', 'HEAD',
+                                       repository='src'))
+
+    @unittest.mock.patch('subprocess.check_call')
+    def test_pull_checked_out_commit_does_nothing(self, mock_check_call):
+        commit = self.git('rev-parse', 'HEAD')
+        subprocess.call(['git', 'clone', '--quiet', 'remote', 'src'])
+
+        sources.Git(self.source, 'src', source_commit=commit).pull()
+
+        self.assertFalse(mock_check_call.called)
+
+    def test_local_repository_is_not_mirrored(self):
+        sources.Git('remote', 'src').pull()
+
+        self.assert_content('first', 'src')
+        self.assertFalse(os.path.exists(
+            os.path.join(self.path, '.cache', 'snapcraft', 'git')))
+
 
 class TestMercurial(SourceTestCase):
 
@@ -400,6 +679,26 @@ class TestLocal(tests.TestCase):
         self.assertGreater(
             os.stat(os.path.join('destination', 'dir', 'file')).st_nlink, 1)
 
+    def test_pull_again_only_syncs_changes(self):
+        os.makedirs(os.path.join('src', 'dir'))
+        open(os.path.join('src', 'dir', 'file'), 'w').close()
+        open(os.path.join('src', 'removed'), 'w').close()
+        local = sources.Local('src', 'destination')
+        local.pull()
+        os.remove(os.path.join('src', 'removed'))
+        with open(os.path.join('src', 'new'), 'w') as f:
+            f.write('new')
+
+        with unittest.mock.patch('snapcraft.internal.common.link_or_copy',
+                                 wraps=sources.common.link_or_copy) as \
+                mock_link_or_copy:
+            local.pull()
+
+        mock_link_or_copy.assert_called_once_with(
+            os.path.join(os.path.abspath('src'), 'new'),
+            os.path.join('destination', 'new'))
+        self.assertCountEqual(['dir', 'new'], os.listdir('destination'))
+
     def test_pull_with_existing_source_link_creates_symlink(self):
         os.makedirs(os.path.join('src', 'dir'))
         open(os.path.join('src', 'dir', 'file'), 'w').close()
@@ -485,6 +784,62 @@ class TestLocal(tests.TestCase):
         self.assertGreater(
             os.stat(os.path.join('destination', 'dir', 'file')).st_nlink, 1)
 
+    def test_fingerprint_changes_with_content(self):
+        os.mkdir('src')
+        with open(os.path.join('src', 'file'), 'w') as f:
+            f.write('content')
+
+        local = sources.Local('src', 'destination')
+        digest = local.fingerprint()
+
+        with open(os.path.join('src', 'file'), 'w') as f:
+            f.write('other content')
+
+        self.assertNotEqual(digest, local.fingerprint())
+
+    def test_fingerprint_ignores_snapcraft_specific_data(self):
+        os.mkdir('src')
+        open(os.path.join('src', 'file'), 'w').close()
+
+        local = sources.Local('src', 'destination')
+        digest = local.fingerprint()
+
+        os.makedirs(os.path.join('src', 'parts'))
+        open(os.path.join('src', 'snapcraft.yaml'), 'w').close()
+        open(os.path.join('src', 'foo.snap'), 'w').close()
+
+        self.assertEqual(digest, local.fingerprint())
+
+    def test_remote_sources_have_no_fingerprint(self):
+        options = tests.MockOptions(source='lp:snapcraft_test_source')
+
+        self.assertIsNone(sources.get_fingerprint('dummy', options))
+
+
+class TestIncompatibleOptions(tests.TestCase):
+
+    def test_checksum_for_vcs_source_raises(self):
+        options = tests.MockOptions(source='lp:snapcraft_test_source',
+                                    source_checksum='md5/1234')
+
+        with self.assertRaises(sources.IncompatibleOptionsError) as raised:
+            sources.get('src', 'build', options)
+
+        self.assertEqual(
+            "can't specify a source-checksum for a bazaar source",
+            str(raised.exception))
+
+    def test_commit_for_tar_source_raises(self):
+        options = tests.MockOptions(source='https://test/test.tar.gz',
+                                    source_commit='1234')
+
+        with self.assertRaises(sources.IncompatibleOptionsError) as raised:
+            sources.get('src', 'build', options)
+
+        self.assertEqual(
+            "can't specify a source-commit for a tar source",
+            str(raised.exception))
+
 
 class TestUri(tests.TestCase):
 
@@ -40,8 +40,8 @@ class BuildStateTestCase(tests.TestCase):
             self.schema_properties, self.options, self.project)
 
     def test_representation(self):
-        expected = ('BuildState(project_options: {}, properties: {}, '
-                    'schema_properties: {})').format(
+        expected = ('BuildState(fingerprint: None, project_options: {}, '
+                    'properties: {}, schema_properties: {})').format(
             self.project.__dict__, self.options.__dict__,
             self.schema_properties)
         self.assertEqual(expected, repr(self.state))
@@ -59,7 +59,10 @@ class BuildStateTestCase(tests.TestCase):
             snapcraft.internal.states.BuildState(
                 self.schema_properties, None, self.project),
             snapcraft.internal.states.BuildState(
-                self.schema_properties, self.options, None)
+                self.schema_properties, self.options, None),
+            snapcraft.internal.states.BuildState(
+                self.schema_properties, self.options, self.project,
+                fingerprint='0123')
         ]
 
         for index, other in enumerate(others):
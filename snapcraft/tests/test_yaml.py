@@ -345,7 +345,8 @@ parts:
 
         self.assertEqual(
             raised.exception.message,
-            'circular dependency chain found in parts definition')
+            'circular dependency chain found in parts definition: '
+            'p1 -> p2 -> p1')
 
     @unittest.mock.patch('snapcraft.internal.yaml.Config.load_plugin')
     def test_invalid_yaml_missing_name(self, mock_loadPlugin):
@@ -840,6 +841,75 @@ parts:
         self.assertFalse(config.part_dependents('dependent'))
         self.assertEqual({'dependent'}, config.part_dependents('main'))
 
+    def test_parts_are_sorted_after_their_dependencies(self):
+        self.make_snapcraft_yaml("""name: test
+version: "1"
+summary: test
+description: test
+confinement: strict
+
+parts:
+  p1:
+    plugin: nil
+    after: [p4, p3]
+  p2:
+    plugin: nil
+  p3:
+    plugin: nil
+    after: [p2]
+  p4:
+    plugin: nil
+""")
+        config = internal_yaml.Config()
+
+        self.assertEqual(['p4', 'p2', 'p3', 'p1'],
+                         [part.name for part in config.all_parts])
+
+    def test_config_loop_reports_only_the_loop(self):
+        self.make_snapcraft_yaml("""name: test
+version: "1"
+summary: test
+description: test
+confinement: strict
+
+parts:
+  p1:
+    plugin: nil
+    after: [p2]
+  p2:
+    plugin: nil
+    after: [p3]
+  p3:
+    plugin: nil
+    after: [p4]
+  p4:
+    plugin: nil
+    after: [p2]
+""")
+        with self.assertRaises(internal_yaml.SnapcraftLogicError) as raised:
+            internal_yaml.Config()
+
+        self.assertEqual(
+            raised.exception.message,
+            'circular dependency chain found in parts definition: '
+            'p2 -> p3 -> p4 -> p2')
+
+    def test_get_part(self):
+        self.make_snapcraft_yaml("""name: test
+version: "1"
+summary: test
+description: test
+confinement: strict
+
+parts:
+  main:
+    plugin: nil
+""")
+        config = internal_yaml.Config()
+
+        self.assertEqual('main', config.get_part('main').name)
+        self.assertIsNone(config.get_part('missing'))
+
 
 class InitTestCase(tests.TestCase):
 
@@ -1224,6 +1294,49 @@ parts:
                 stage_dir=self.stage_dir,
                 arch_triplet=self.arch_triplet))
 
+    def test_parts_build_env_visits_shared_dependencies_once(self):
+        self.make_snapcraft_yaml("""name: test
+version: "1"
+summary: test
+description: test
+confinement: strict
+
+parts:
+  base:
+    plugin: nil
+  left:
+    plugin: nil
+    after: [base]
+  right:
+    plugin: nil
+    after: [base]
+  top:
+    plugin: nil
+    after: [left, right]
+""")
+        config = internal_yaml.Config()
+        base = config.get_part('base')
+
+        with unittest.mock.patch.object(
+                base, 'env', return_value=['BASE=1']) as mock_env:
+            env = config.build_env_for_part(config.get_part('top'))
+
+        mock_env.assert_called_once_with(self.stage_dir)
+        self.assertEqual(1, env.count('BASE=1'))
+
+    def test_parts_build_env_is_updated_once_staged(self):
+        config = internal_yaml.Config()
+        part1 = config.get_part('part1')
+        include_flag = '-I{}/include'.format(self.stage_dir)
+
+        os.makedirs(self.stage_dir)
+        env = config.build_env_for_part(part1)
+        self.assertFalse([e for e in env if include_flag in e])
+
+        os.mkdir(os.path.join(self.stage_dir, 'include'))
+        env = config.build_env_for_part(part1)
+        self.assertTrue([e for e in env if include_flag in e])
+
 
 class TestValidation(tests.TestCase):
 